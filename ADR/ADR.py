@@ -17,7 +17,7 @@
 ### BEGIN NODE INFO
 [info]
 name = ADR Server
-version = 0.33
+version = 0.34
 description =
 
 [startup]
@@ -43,7 +43,7 @@ import traceback
 import time
 
 from labrad.devices import DeviceServer, DeviceWrapper
-from labrad.server import setting
+from labrad.server import setting, Signal
 from labrad.units import Unit
 from twisted.internet import defer, reactor
 from twisted.internet.defer import inlineCallbacks, returnValue
@@ -58,6 +58,13 @@ CONFIG_PATH = ['', 'Servers', 'ADR']
 PS_MAX_CURRENT = 9.0 * Unit('A')
 K, V, s, torr, minutes, A, mA = Unit('K'), Unit('V'), Unit('s'), Unit('torr'), Unit('min'), Unit('A'), Unit('mA')
 kOhm, mV = Unit('kOhm'), Unit('mV')
+# readings kept in each ADR's history, a few hours at one reading per second
+HISTORY_LENGTH = 20000
+# (name, unit, number of values) of each variable in the history
+HISTORY_VARIABLES = [('temperatures', 'K', 8), ('voltages', 'V', 8),
+                     ('magCurrent', 'A', 1), ('magVoltage', 'V', 1),
+                     ('ruoxTemperature', 'K', 1)]
+NEW_READING_SIGNAL = 318201
 
 
 class Peripheral(object):
@@ -72,6 +79,38 @@ class Peripheral(object):
         yield self.server.select_device(self.ID, context=self.ctxt)
 
 
+class History(object):
+    """
+    Recent readings of the HISTORY_VARIABLES, kept in fixed-size numpy ring
+    buffers with a shared time axis. Once full, the oldest readings are
+    overwritten.
+    """
+    def __init__(self, variables=HISTORY_VARIABLES, length=HISTORY_LENGTH):
+        self.variables = variables
+        self.length = length
+        self.times = np.zeros(length)
+        self.values = dict((name, np.zeros((length, width))) for name, unit, width in variables)
+        self.count = 0  # readings added, including those overwritten
+
+    def add(self, t, readings):
+        """ Adds readings, a dict of variable name -> values, taken at time t. """
+        i = self.count % self.length
+        self.times[i] = t
+        for name, values in self.values.items():
+            values[i] = readings[name]
+        self.count += 1
+
+    def since(self, t):
+        """
+        Readings taken after time t, oldest first.
+        :return: (times, dict of variable name -> array of shape (n, width))
+        """
+        n = min(self.count, self.length)
+        order = (self.count - n + np.arange(n)) % self.length
+        order = order[np.searchsorted(self.times[order], t, side='right'):]
+        return self.times[order], dict((name, values[order]) for name, values in self.values.items())
+
+
 class ADRWrapper(DeviceWrapper):
     # INITIALIZATION #
 
@@ -86,7 +125,11 @@ class ADRWrapper(DeviceWrapper):
         # Each ADR makes LabRAD requests in its own context.
 
         self.cxn = args[0]
+        # signal to send new readings to, if any
+        self.notify = args[1] if len(args) > 1 else None
         self.ctxt = self.cxn.context()
+        self.history = History()
+        self.historyFailed = False
         self._refreshPeripheralLock = False
         # give us a blank log
         self.logData = []
@@ -385,6 +428,7 @@ class ADRWrapper(DeviceWrapper):
                 self.state('missingCriticalPeripheral',
                            magnet_response is None or lakeshore_response is None,
                            False)
+                self.record_history()
 
                 # check to see if we should start recording temp
                 if not self.state('recordTemp') and self.state('autoRecord') and self.should_start_recording():
@@ -705,6 +749,48 @@ class ADRWrapper(DeviceWrapper):
                         pass
         return self.stateVars[var]
 
+    def record_history(self):
+        """
+        Adds the latest readings to the history and sends them to listeners.
+        Errors are logged rather than raised, so they never hold up the cycle.
+        """
+        try:
+            self._record_history()
+        except Exception as e:
+            # log once until recording works again, not every cycle
+            if not self.historyFailed:
+                self.log("Exception recording history: %s" % e.__str__())
+                traceback.print_exc()
+            self.historyFailed = True
+        else:
+            self.historyFailed = False
+
+    def _record_history(self):
+        try:
+            ruox_temp = self.ruox_status()[0]['K']
+        except Exception:
+            ruox_temp = np.nan
+        readings = {
+            'temperatures': [x['K'] for x in self.state('temperatures')],
+            'voltages': [x['V'] for x in self.state('voltages')],
+            'magCurrent': self.state('magCurrent')['A'],
+            'magVoltage': self.state('magVoltage')['V'],
+            'ruoxTemperature': ruox_temp,
+        }
+        t = time.time()
+        self.history.add(t, readings)
+        if self.notify is not None:
+            self.notify((self.name, t * s, np.array(readings['temperatures']) * K,
+                         np.array(readings['voltages']) * V, readings['magCurrent'] * A,
+                         readings['magVoltage'] * V, ruox_temp * K))
+
+    def readings_since(self, t):
+        """ History since time t, with units, as returned by the Readings Since setting. """
+        times, values = self.history.since(t)
+        return (times * s, values['temperatures'] * K, values['voltages'] * V,
+                values['magCurrent'][:, 0] * A, values['magVoltage'][:, 0] * V,
+                values['ruoxTemperature'][:, 0] * K)
+
     # clear a state variable
     def clear(self, var):
         #del self.stateVars[var]
@@ -1004,6 +1090,10 @@ class ADRServer(DeviceServer):
     deviceName = 'ADR'
     deviceWrapper = ADRWrapper
 
+    onNewReading = Signal(NEW_READING_SIGNAL, 'signal: new reading',
+                          '(s{ADR name} v[s]{time} *v[K]{temperatures} *v[V]{voltages} '
+                          'v[A]{magnet current} v[V]{magnet voltage} v[K]{ruox temperature})')
+
     # def initServer(self):
     #	return DeviceServer.initServer(self)
 
@@ -1016,7 +1106,7 @@ class ADRServer(DeviceServer):
         Finds all ADR configurations in the registry at CONFIG_PATH and returns a list of
         (ADR_name,(),peripheralDictionary).
         INPUTS - none
-        OUTPUT - List of (ADRName,(connectionObject,context),peripheralDict) tuples.
+        OUTPUT - List of (ADRName,(connectionObject,newReadingSignal)) tuples.
         """
         device_list = []
         reg = self.client.registry
@@ -1036,7 +1126,7 @@ class ADRServer(DeviceServer):
                     if "node_" + node.lower() not in self.client.servers:
                         missing_nodes.append(node)
                 if not missing_nodes:
-                    device_list.append((name, (self.client,)))
+                    device_list.append((name, (self.client, self.onNewReading)))
                 else:
                     print "device %s missing nodes: %s" % (name, str(list(set(missing_nodes))))
                 yield reg.cd(1)
@@ -1210,6 +1300,20 @@ class ADRServer(DeviceServer):
         dev = self.selectedDevice(c)
         dev.mag_step(up)
 
+    # the 70's settings are for the history of readings
+    @setting(70, "Readings Since", since='v[s]',
+             returns=['(*v[s] *2v[K] *2v[V] *v[A] *v[V] *v[K])'])
+    def readings_since(self, c, since=0 * s):
+        """
+        Returns the readings taken after the given time (seconds since the
+        epoch), oldest first, as (times, temperatures, voltages, magnet
+        current, magnet voltage, ruox temperature). With no time, returns
+        the whole history. Pass the last time received to get only new
+        readings, or listen to 'signal: new reading' instead of polling.
+        """
+        dev = self.selectedDevice(c)
+        return dev.readings_since(since['s'])
+
 
 __server__ = ADRServer()
 
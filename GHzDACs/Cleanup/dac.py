@@ -20,6 +20,7 @@ not in the registry dict.
 
 """
 
+import collections
 import logging
 import numpy as np
 from twisted.internet.defer import inlineCallbacks, returnValue
@@ -94,6 +95,10 @@ class InvalidBoardVersion(Exception):
 # Time for master to delay before SRAM to ensure synchronization
 MASTER_SRAM_DELAY_US = 2
 
+# Number of compiled jump tables kept by DAC_Build15.compile_jump_table.
+# Sweeps typically reuse a handful of tables, so this is plenty.
+JT_CACHE_SIZE = 128
+
 
 class DAC(fpga.FPGA):
     MAC_PREFIX = '00:01:CA:AA:00:'
@@ -1026,11 +1031,25 @@ class DacRunner_Build15(DacRunner_Build7):
         self.dev = dev
         self.reps = reps
         self.start_delay = start_delay
+        self.board_delay = 0
         self.loop_delay = loop_delay
-        self.jump_table = self.dev.make_jump_table(jt_entries, jt_counters)
+        sram_len = len(sram) // 4 if sram is not None else None
+        self.jump_table = self.dev.compile_jump_table(jt_entries, jt_counters,
+                                                      sram_len=sram_len)
         self.sram = sram
         self.nPackets = 0  # we don't expect any packets back
-        self.seqTime = fpga.TIMEOUT_FACTOR * (100 * self.reps) * 10**-6 + 1  # TODO: what should we do here? issue #49
+
+    @property
+    def seqTime(self):
+        """Upper bound on the time to run all reps, in seconds.
+
+        Each rep waits for the start delay (including the board delay added
+        in runPacket), plays the jump table and then waits for the loop
+        delay.
+        """
+        delay_us = self.start_delay + self.board_delay + self.loop_delay
+        rep_time = delay_us * 1e-6 + self.jump_table.duration_ns * 1e-9
+        return fpga.TIMEOUT_FACTOR * (rep_time * self.reps) + 1
 
     def pageable(self):
         return False  # no paging for JT
@@ -1059,6 +1078,7 @@ class DacRunner_Build15(DacRunner_Build7):
         :param int sync: passed through to sync option for register packet
         :return: ndarray, ready to be tostring'ed to bytes for the DE server
         """
+        self.board_delay = delay
         start_delay = self.start_delay + delay
         regs = self.dev.regRun(self.reps, page, slave, start_delay, readback=False,
                                blockDelay=None, sync=sync, loop_delay=self.loop_delay)
@@ -1431,6 +1451,96 @@ class DAC_Build15(DAC_Build8):
             counters=counters
         )
 
+    @classmethod
+    def compile_jump_table(cls, jt_entries, counters=None, start_address_ns=0,
+                           sram_len=None, loop=False):
+        """Make a jump table, check it and serialize it for the board.
+
+        The table is executed (see jump_table.run_jump_table) to check that
+        it ends without running off the end of SRAM, and to get its exact
+        length including IDLE and CYCLE loops. Compiled tables are cached,
+        so calling this again with the same entries is cheap.
+
+        :param list[jump_table.JumpEntry] jt_entries: JT entries
+        :param list[int] counters: counter values, or None for all 0s
+        :param int start_address_ns: SRAM start address, in ns
+        :param int sram_len: number of SRAM words that will be loaded. If
+            given, the table may not play cells beyond the last derp written.
+        :param bool loop: allow the table to loop forever instead of ending
+        :return: compiled jump table
+        :rtype: jump_table.CompiledJumpTable
+        """
+        key = (cls.__name__, start_address_ns, tuple(counters or ()),
+               tuple(entry.key() for entry in jt_entries), sram_len, loop)
+        compiled = _compiled_jump_tables.pop(key, None)
+        if compiled is None:
+            jt = cls.make_jump_table(jt_entries, counters, start_address_ns)
+            cls.check_jump_table(jt)
+            compiled = jump_table.CompiledJumpTable(jt, cls.SRAM_LEN // 4)
+            cls.check_jump_table_run(compiled.run, sram_len, loop)
+            if len(_compiled_jump_tables) >= JT_CACHE_SIZE:
+                _compiled_jump_tables.popitem(last=False)
+        _compiled_jump_tables[key] = compiled
+        return compiled
+
+    @classmethod
+    def check_jump_table(cls, jt):
+        """Check entry count, jump targets and counter use of a jump table.
+
+        :param jump_table.JumpTable jt: the table to check
+        :raises ValueError: if the table can not be run on this board
+        """
+        jumps = jt.jumps
+        if len(jumps) > cls.JUMP_TABLE_COUNT - 1:
+            raise ValueError("Too many jump table entries: {} (max {})".format(
+                len(jumps), cls.JUMP_TABLE_COUNT - 1))
+        cycles = []
+        for i, entry in enumerate(jumps):
+            op = entry.operation
+            if isinstance(op, (jump_table.JUMP, jump_table.CYCLE)):
+                # hardware index 0 is the start entry
+                if not 1 <= op.jump_index <= len(jumps):
+                    raise ValueError(
+                        "Entry {}({}) jumps to entry {}, which does not "
+                        "exist".format(i, op, op.jump_index))
+            if isinstance(op, jump_table.CYCLE):
+                for j, other in cycles:
+                    overlap = (entry.to_addr <= other.from_addr and
+                               other.to_addr <= entry.from_addr)
+                    if other.operation.counter == op.counter and overlap:
+                        raise ValueError(
+                            "Nested CYCLE entries {} and {} both use "
+                            "counter {}".format(j, i, op.counter))
+                cycles.append((i, entry))
+
+    @classmethod
+    def check_jump_table_run(cls, run, sram_len=None, loop=False):
+        """Check the result of executing a jump table.
+
+        :param jump_table.JumpTableRun run: result of run_jump_table
+        :param int sram_len: number of SRAM words that will be loaded, or
+            None to allow the whole SRAM.
+        :param bool loop: allow the table to loop forever
+        :raises ValueError: if the table does not end properly or plays
+            SRAM that is not loaded.
+        """
+        if run.reason == 'overrun':
+            raise ValueError("Jump table runs off the end of SRAM without "
+                             "reaching END")
+        elif run.reason == 'limit':
+            raise ValueError("Jump table did not end after {} "
+                             "operations".format(jump_table.MAX_EXECUTED_OPS))
+        elif run.reason == 'loop' and not loop:
+            raise ValueError("Jump table loops forever and never reaches END")
+        if sram_len is not None:
+            # SRAM is written in whole derps
+            derps = -(-sram_len // cls.SRAM_WRITE_PKT_LEN)
+            loaded = derps * cls.SRAM_WRITE_PKT_LEN // 4
+            if run.last_cell >= loaded:
+                raise ValueError(
+                    "Jump table plays SRAM up to {} ns but only {} ns of SRAM "
+                    "is loaded".format(4 * (run.last_cell + 1), 4 * loaded))
+
     @classmethod
     def jt_run_sram(cls, start_addr_ns, end_addr_ns, loop=False):
         """ Get a simple JT to run the SRAM
@@ -1573,6 +1683,9 @@ def maxSRAM(cmds):
 
 #Memory sequence functions
 
+_compiled_jump_tables = collections.OrderedDict()
+
+
 class MemorySequence(list):
     @staticmethod
     def getOpcode(cmd):
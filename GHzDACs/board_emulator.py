@@ -0,0 +1,576 @@
+"""
+Pure python emulation of GHz FPGA boards and the direct ethernet server.
+
+dac_emulator.py spoofs a board on a real network adapter, which needs raw
+sockets and root access. The classes here instead model the boards in
+memory so that the FPGA server code (device wrappers, BoardGroup, the
+run_sequence pipeline) can be driven without any hardware:
+
+    DacEmulator - jump table DAC (build 15). Accepts register, SRAM and jump
+                  table writes, executes the jump table when started and
+                  answers the serial commands used by the bringup (LVDS,
+                  FIFO and BIST) with a consistent model of the DAC chips.
+    AdcEmulator - ADC build 7. Accepts register and SRAM (trigger and mixer
+                  table) writes and produces register readback, average and
+                  demodulator packets in the formats parsed by ADC_Build7.
+    EmulatedDirectEthernet - stands in for the direct ethernet server. It
+                  implements the settings used by the FPGA server (connect,
+                  listen, write, read, collect, triggers, ...) and routes
+                  written packets to the emulated boards by destination MAC.
+
+Everything happens synchronously in the calling thread, so packets sent to
+the emulated server return already-fired Deferreds. This makes it possible
+to run many sequences per second in the test suite.
+"""
+
+import collections
+import itertools
+import time
+
+import numpy as np
+from twisted.internet import defer
+from labrad import types as T
+from labrad.units import Value
+
+import servers.GHzDACs.Cleanup.dac as dac
+import servers.GHzDACs.Cleanup.adc as adc
+import servers.GHzDACs.jump_table as jump_table
+
+ADAPTER_MAC = '00:00:00:00:00:00'
+
+
+def _fromLittleEndian(data):
+    """Convert a sequence of little endian bytes to an int."""
+    return sum(int(b) << (8 * i) for i, b in enumerate(data))
+
+
+# Boards
+
+class DacEmulator(object):
+    """Emulates a jump table DAC board (build 15).
+
+    Attributes of interest to tests:
+        sram: ndarray of SRAM words
+        jumpTable: byte string of the last jump table write
+        lastRun: JumpTableRun for the last started sequence
+        executionCounter: number of executions since the last start
+        starts: list of (start mode, reps, start delay, loop delay) for every
+            register write that started the board
+        serial: dict of serial op (2=DAC A, 3=DAC B) -> {register: value}
+
+    The serial model is just detailed enough for the bringup routines to
+    succeed: the LVDS check bit is set while both MSD and MHD are below
+    lvdsEdge, the FIFO counter is (fifoCounter + PHOF) & 0xF (+4 with
+    inverted clock polarity) and the BIST checksums are computed from the
+    SRAM words played by the last run.
+    """
+
+    REG_PACKET_LEN = dac.DAC_Build15.REG_PACKET_LEN
+    SRAM_PACKET_LEN = 1026
+    JUMP_TABLE_LEN = dac.DAC_Build15.JUMP_TABLE_LEN
+    READBACK_LEN = dac.DAC_Build15.READBACK_LEN
+
+    def __init__(self, board, build=15, fifoCounter=3, lvdsEdge=8):
+        self.board = board
+        self.build = build
+        self.MAC = dac.DAC.macFor(board)
+        self.fifoCounter = fifoCounter
+        self.lvdsEdge = lvdsEdge
+        self.sram = np.zeros(dac.DAC_Build15.SRAM_LEN, dtype='<u4')
+        self.jumpTable = None
+        self.lastRun = None
+        self._runCache = (None, None)
+        self.executionCounter = 0
+        self.starts = []
+        self.serial = {1: {}, 2: {}, 3: {}}
+        self.clockInverted = {2: False, 3: False}
+        self.pllLocked = True
+
+    def handle(self, data):
+        """Process a packet sent to this board and return the responses."""
+        if len(data) == self.REG_PACKET_LEN:
+            return self._register(np.fromstring(data, dtype='u1'))
+        elif len(data) == self.SRAM_PACKET_LEN:
+            self._writeSram(data)
+        elif len(data) == self.JUMP_TABLE_LEN:
+            self.jumpTable = data
+        return []
+
+    def _writeSram(self, data):
+        derp = ord(data[0]) + (ord(data[1]) << 8)
+        words = np.fromstring(data[2:], dtype='<u4')
+        start = derp * len(words)
+        if start < len(self.sram):
+            self.sram[start:start + len(words)] = words[:len(self.sram) - start]
+
+    def _register(self, regs):
+        start, readback = int(regs[0]), int(regs[1])
+        if regs[46] & 0x80:
+            self.pllLocked = True
+        elif regs[46]:
+            # clock polarity: enable bits 4 (A) and 5 (B), invert bits 0, 1
+            for op, ofs in [(2, 0), (3, 1)]:
+                if regs[46] & (1 << (ofs + 4)):
+                    self.clockInverted[op] = bool(regs[46] & (1 << ofs))
+        serDAC = 0
+        if regs[47]:
+            serDAC = self._serial(int(regs[47]),
+                                  _fromLittleEndian(regs[48:51]))
+        reps = _fromLittleEndian(regs[13:15])
+        if start in (1, 3) and reps:
+            self.starts.append((start, reps, _fromLittleEndian(regs[43:45]),
+                                _fromLittleEndian(regs[15:17])))
+            self.run(reps)
+        if readback:
+            return [self._readback(serDAC)]
+        return []
+
+    def run(self, reps=1):
+        """Execute the jump table reps times.
+
+        Every repetition plays the same cells, so the table is executed once
+        and the result is cached until a new jump table is written.
+        """
+        if self.jumpTable is None:
+            raise RuntimeError("{} started without a jump table".format(
+                self.MAC))
+        data, run = self._runCache
+        if data != self.jumpTable:
+            run = jump_table.run_jump_table(self.jumpTable,
+                                            len(self.sram) // 4)
+            self._runCache = (self.jumpTable, run)
+        self.lastRun = run
+        self.executionCounter = reps & 0xFFFF
+        return run
+
+    def played(self):
+        """SRAM words played by the last run, one per ns."""
+        if self.lastRun is None:
+            return np.zeros(0, dtype='<u4')
+        cells = self.lastRun.cells()
+        return self.sram[(cells[:, None] * 4 + np.arange(4)).ravel()]
+
+    def _serial(self, op, data):
+        """Run one serial command and return the serDAC readback byte."""
+        regs = self.serial.setdefault(op, {})
+        if op == 1:
+            # PLL; the two lowest bits select the PLL latch
+            regs[data & 0x3] = data
+            return 0
+        addr = (data >> 8) & 0x1F
+        if not data & 0x8000:
+            regs[addr] = data & 0xFF
+            return 0
+        value = regs.get(addr, 0)
+        if addr == 0x05:
+            # LVDS check bit for the MSD/MHD set in register 4
+            msd, mhd = regs.get(0x04, 0) >> 4, regs.get(0x04, 0) & 0xF
+            check = int(msd < self.lvdsEdge and mhd < self.lvdsEdge)
+            return (value & 0xF0) | check
+        elif addr == 0x07:
+            phof = value & 0x3
+            counter = self.fifoCounter + phof
+            if self.clockInverted.get(op):
+                counter += 4
+            return ((counter & 0xF) << 4) | (value & 0xF)
+        elif 0x12 <= addr <= 0x15:
+            # BIST checksum byte, most significant first, register 0x11
+            # selects which checksum (LVDS/FIFO, even/odd words)
+            which = (regs.get(0x11, 0) >> 6) & 0x1
+            checksum = self._bistChecksum(op)[which]
+            return (checksum >> (8 * (0x15 - addr))) & 0xFF
+        return value
+
+    def _bistChecksum(self, op):
+        shift = 0 if op == 2 else 14
+        words = (self.played() >> shift) & 0x3FFF
+        return dac.DAC.bistChecksum([int(w) for w in words])
+
+    def _readback(self, serDAC):
+        a = np.zeros(self.READBACK_LEN, dtype='u1')
+        a[51] = self.build
+        a[52] = self.executionCounter & 0xFF
+        a[53] = (self.executionCounter >> 8) & 0xFF
+        a[56] = serDAC
+        a[58] = 0 if self.pllLocked else 0x80
+        return a.tostring()
+
+
+class AdcEmulator(object):
+    """Emulates an ADC board (build 7).
+
+    The demodulated value for a channel is the sum of the I and Q columns of
+    its mixer table over the trigger length, multiplied by signal[channel]
+    (complex, default 1) and with gaussian noise of standard deviation noise
+    added to I and Q. Override demodulate for other models. Average mode
+    returns the (I, Q) pairs in average, an int array of shape (4096, 2).
+
+    Bit readout mode (rchan = 0) is not emulated.
+    """
+
+    REG_PACKET_LEN = adc.ADC_Build7.REG_PACKET_LEN
+    SRAM_PACKET_LEN = adc.ADC_Build7.SRAM_RETRIGGER_PKT_LEN
+    READBACK_LEN = adc.ADC_Build7.REGISTER_READBACK_PKT_LEN
+    CHANNELS = adc.ADC_Build7.DEMOD_CHANNELS
+    CHANNELS_PER_PACKET = adc.ADC_Build7.DEMOD_CHANNELS_PER_PACKET
+    DEMOD_PACKET_LEN = 48
+    AVERAGE_PACKETS = adc.ADC_Build7.AVERAGE_PACKETS
+    AVERAGE_PACKET_LEN = adc.ADC_Build7.AVERAGE_PACKET_LEN
+
+    def __init__(self, board, build=7, noise=0.0):
+        self.board = board
+        self.build = build
+        self.MAC = adc.ADC.macFor(board)
+        # page 0 is the trigger table, pages 1-12 the mixer tables
+        self.sram = np.zeros((self.CHANNELS + 1, 1024), dtype='u1')
+        self.signal = np.ones(self.CHANNELS, dtype=complex)
+        self.noise = noise
+        n = self.AVERAGE_PACKETS * self.AVERAGE_PACKET_LEN // 4
+        self.average = np.zeros((n, 2), dtype=int)
+        self.executionCounter = 0
+        self.packetCounter = 0
+        self.pll = None
+        self.starts = []
+
+    def handle(self, data):
+        """Process a packet sent to this board and return the responses."""
+        self.packetCounter = (self.packetCounter + 1) & 0xFF
+        if len(data) == self.REG_PACKET_LEN:
+            return self._register(np.fromstring(data, dtype='u1'))
+        elif len(data) == self.SRAM_PACKET_LEN:
+            page = ord(data[0]) + (ord(data[1]) << 8)
+            if page < len(self.sram):
+                self.sram[page] = np.fromstring(data[2:], dtype='u1')
+        return []
+
+    def _register(self, regs):
+        mode = int(regs[0])
+        reps = _fromLittleEndian(regs[7:9])
+        if mode == adc.ADC.RUN_MODE_REGISTER_READBACK:
+            return [self._readback()]
+        elif mode in (adc.ADC.RUN_MODE_AVERAGE_AUTO,
+                      adc.ADC.RUN_MODE_AVERAGE_DAISY):
+            self.starts.append((mode, reps))
+            self.executionCounter = reps & 0xFFFF
+            return self._averagePackets()
+        elif mode in (adc.ADC.RUN_MODE_DEMOD_AUTO,
+                      adc.ADC.RUN_MODE_DEMOD_DAISY):
+            self.starts.append((mode, reps))
+            self.executionCounter = reps & 0xFFFF
+            return self._demodPackets(reps)
+        elif mode == 6:
+            self.pll = _fromLittleEndian(regs[3:6])
+        return []
+
+    def triggerTable(self):
+        """Decode the trigger table into (rcount, rdelay, rlen, rchan) rows.
+
+        This undoes the offsets applied by ADC_Branch2.makeTriggerTable. The
+        table ends at the first all-zero entry.
+        """
+        table = []
+        page = self.sram[0]
+        for ofs in range(0, len(page), 8):
+            entry = page[ofs:ofs + 8]
+            if not entry.any():
+                break
+            table.append((_fromLittleEndian(entry[0:2]) + 1,
+                          _fromLittleEndian(entry[2:4]) + 4,
+                          int(entry[4]) + 1,
+                          int(entry[5])))
+        return table
+
+    def mixerTable(self, channel):
+        """(I, Q) mixer table of a channel as an int array of shape (512, 2)."""
+        return self.sram[channel + 1].view('i1').reshape(-1, 2).astype(int)
+
+    def demodulate(self, channel, trigger, rlen):
+        """Complex demodulator output for one channel and retrigger."""
+        # rlen is in 4 ns cycles and the mixer table has one row per 2 ns
+        mixer = self.mixerTable(channel)[:2 * rlen]
+        total = mixer.sum(axis=0)
+        return self.signal[channel] * complex(total[0], total[1])
+
+    def _demodPackets(self, reps):
+        values = []
+        trigger = 0
+        for rcount, rdelay, rlen, rchan in self.triggerTable():
+            for _ in range(rcount):
+                for channel in range(rchan):
+                    values.append(self.demodulate(channel, trigger, rlen))
+                trigger += 1
+        if not values or not reps:
+            return []
+        values = np.array(values)
+        # iq[stat, readout, I/Q]
+        iq = np.empty((reps, len(values), 2))
+        iq[:, :, 0] = values.real
+        iq[:, :, 1] = values.imag
+        if self.noise:
+            iq += self.noise * np.random.randn(*iq.shape)
+        iq = np.clip(np.round(iq), -2**15, 2**15 - 1).astype('<i2')
+        # After the last retrigger the partially filled FIFO is sent, so each
+        # stat starts a new packet.
+        nPackets = -(-len(values) // self.CHANNELS_PER_PACKET)
+        padded = np.zeros((reps, nPackets * self.CHANNELS_PER_PACKET, 2),
+                          dtype='<i2')
+        padded[:, :len(values)] = iq
+        body = padded.reshape(reps, nPackets, -1).view('u1')
+        pkts = np.zeros((reps, nPackets, self.DEMOD_PACKET_LEN), dtype='u1')
+        pkts[:, :, :body.shape[2]] = body
+        # countrb is the 1-based readback (stat) number, countpack the
+        # packet number, both since the last start
+        stat = np.arange(1, reps + 1)[:, None]
+        pkts[:, :, 44] = stat & 0xFF
+        pkts[:, :, 45] = (stat >> 8) & 0xFF
+        pkts[:, :, 46] = np.arange(reps * nPackets).reshape(reps, -1) & 0xFF
+        return [p.tostring() for p in pkts.reshape(-1, self.DEMOD_PACKET_LEN)]
+
+    def _averagePackets(self):
+        data = np.asarray(self.average).astype('<i2').tostring()
+        n = self.AVERAGE_PACKET_LEN
+        return [data[i:i + n] for i in range(0, len(data), n)]
+
+    def _readback(self):
+        a = np.zeros(self.READBACK_LEN, dtype='u1')
+        a[0] = self.build
+        a[2] = self.executionCounter & 0xFF
+        a[3] = (self.executionCounter >> 8) & 0xFF
+        a[4] = self.packetCounter
+        return a.tostring()
+
+
+# Direct ethernet server
+
+class EmulatorTimeout(T.Error):
+    """A read or collect asked for more packets than have arrived."""
+
+
+class _PacketResponse(object):
+    """Results of an emulated packet, accessed like a LabRAD packet
+    response: by setting name as an attribute or item, by key or by index.
+    """
+
+    def __init__(self):
+        self._values = []
+        self._byName = {}
+        self._byKey = {}
+
+    def _add(self, name, key, value):
+        self._values.append(value)
+        self._byName[name] = value
+        if key is not None:
+            self._byKey[key] = value
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['_byName'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, long)):
+            return self._values[key]
+        if key in self._byKey:
+            return self._byKey[key]
+        return self._byName[key]
+
+
+class _ContextState(object):
+    def __init__(self):
+        self.port = None
+        self.destinationMac = None
+        self.sourceMac = None
+        self.length = None
+        self.listening = False
+        self.packets = collections.deque()
+        self.triggers = 0
+        self.waiters = []
+
+    def accepts(self, src, data):
+        return (self.listening and
+                self.sourceMac in (None, src) and
+                self.length in (None, len(data)))
+
+
+class EmulatedPacket(object):
+    """A packet for the emulated direct ethernet server.
+
+    Settings are recorded and run in order when the packet is sent. Every
+    setting returns the packet so that calls can be chained.
+    """
+
+    def __init__(self, server, context):
+        self._server = server
+        self._context = context
+        self._packet = []
+
+    def _add(self, name, args, key=None):
+        self._packet.append([name, list(args), key])
+        return self
+
+    def __setitem__(self, key, value):
+        for record in self._packet:
+            if record[2] == key:
+                record[1] = [value]
+                return
+        raise KeyError(key)
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not hasattr(self._server, '_do_' + name):
+            raise AttributeError(name)
+        return lambda *args, **kw: self._add(name, args, kw.get('key'))
+
+    def send(self, context=None):
+        if context is None:
+            context = self._context
+        return self._server._send(context, list(self._packet))
+
+
+class _EmulatedManager(object):
+    def __init__(self, server):
+        self.server = server
+
+    def expire_context(self, ID, context=None):
+        self.server._contexts.pop(context, None)
+        return defer.succeed(None)
+
+
+class _EmulatedConnection(object):
+    def __init__(self, server):
+        self.manager = _EmulatedManager(server)
+
+
+class EmulatedDirectEthernet(object):
+    """In-memory replacement for the direct ethernet server.
+
+    Pass the emulated boards to the constructor, or add them later with
+    addBoard. The object can be used wherever the FPGA server expects its
+    direct ethernet server wrapper, e.g. BoardGroup(fpgaServer, de, 0).
+
+    All boards are on a single adapter (port) and answer synchronously, so
+    reads and collects either succeed immediately or fail with
+    EmulatorTimeout. wait_for_trigger really waits: the rest of the packet
+    runs when enough triggers have been sent to its context.
+    """
+
+    ID = 0
+
+    def __init__(self, boards=(), name='Emulated Direct Ethernet'):
+        self.name = self._labrad_name = name
+        self._cxn = _EmulatedConnection(self)
+        self._contexts = {}
+        self._contextIds = itertools.count(1)
+        self.boards = {}
+        for board in boards:
+            self.addBoard(board)
+
+    def addBoard(self, board):
+        self.boards[board.MAC] = board
+
+    def context(self):
+        return (0, next(self._contextIds))
+
+    def packet(self, context=None):
+        return EmulatedPacket(self, context)
+
+    def adapters(self):
+        return defer.succeed([(0, 'Emulated adapter')])
+
+    def read(self, n=1, context=None):
+        d = self.packet(context=context).read(n).send()
+        return d.addCallback(lambda ans: ans.read)
+
+    def _state(self, context):
+        if context not in self._contexts:
+            self._contexts[context] = _ContextState()
+        return self._contexts[context]
+
+    def _deliver(self, src, data):
+        for state in self._contexts.values():
+            if state.accepts(src, data):
+                state.packets.append((src, ADAPTER_MAC, len(data), data))
+
+    def _send(self, context, records):
+        d = defer.Deferred()
+        self._resume(context, records, 0, _PacketResponse(), d, None)
+        return d
+
+    def _resume(self, context, records, index, response, d, waitStart):
+        state = self._state(context)
+        try:
+            while index < len(records):
+                name, args, key = records[index]
+                if name == 'wait_for_trigger':
+                    if state.triggers < args[0]:
+                        state.waiters.append((records, index, response, d,
+                                              waitStart or time.time()))
+                        return
+                    state.triggers -= args[0]
+                    elapsed = time.time() - waitStart if waitStart else 0.0
+                    value = Value(elapsed, 's')
+                else:
+                    value = getattr(self, '_do_' + name)(state, *args)
+                response._add(name, key, value)
+                index += 1
+        except Exception:
+            d.errback()
+            return
+        d.callback(response)
+
+    # settings
+
+    def _do_connect(self, state, port):
+        state.port = port
+
+    def _do_destination_mac(self, state, mac):
+        state.destinationMac = mac
+
+    def _do_require_source_mac(self, state, mac):
+        state.sourceMac = mac
+
+    def _do_source_mac(self, state, mac=None):
+        pass
+
+    def _do_require_length(self, state, length):
+        state.length = length
+
+    def _do_timeout(self, state, timeout):
+        pass
+
+    def _do_listen(self, state):
+        state.listening = True
+
+    def _do_write(self, state, data):
+        board = self.boards.get(state.destinationMac)
+        if board is not None:
+            for response in board.handle(data):
+                self._deliver(board.MAC, response)
+
+    def _do_collect(self, state, n=1):
+        if len(state.packets) < n:
+            raise EmulatorTimeout("collect: {} packets requested, {} "
+                                  "available".format(n, len(state.packets)))
+
+    def _do_read(self, state, n=1):
+        self._do_collect(state, n)
+        return [state.packets.popleft() for _ in range(n)]
+
+    def _do_discard(self, state, n=1):
+        self._do_collect(state, n)
+        for _ in range(n):
+            state.packets.popleft()
+
+    def _do_clear(self, state):
+        state.packets.clear()
+
+    def _do_send_trigger(self, state, context):
+        target = self._state(context)
+        target.triggers += 1
+        waiters, target.waiters = target.waiters, []
+        for records, index, response, d, waitStart in waiters:
+            self._resume(context, records, index, response, d, waitStart)
+
+    def _do_wait_for_trigger(self, state, n):
+        # handled in _resume; defined so that packets accept the setting
+        pass
@@ -0,0 +1,102 @@
+"""
+Reductions of ADC demodulation data.
+
+Run Sequence returns demodulated ADC data as an integer array with indices
+(channel, stat, retrigger, I/Q), where channel runs over the demod channels
+in the timing order. Most callers immediately reduce this array, so the
+functions here do that reduction on the server, right after the data is
+extracted, so that only the reduced result has to be sent over LabRAD.
+"""
+
+import numpy as np
+
+# Allowed values for the Result Reduction setting
+REDUCTIONS = ['none', 'mean', 'probabilities', 'histogram']
+
+DEFAULT_HISTOGRAM_BINS = 64
+
+
+def _checkDemod(data):
+    data = np.asarray(data)
+    if data.ndim != 4 or data.shape[3] != 2:
+        raise ValueError("Expected demod data with indices (channel, stat, "
+                         "retrigger, I/Q), got shape {}".format(data.shape))
+    return data
+
+
+def meanVariance(data):
+    """Mean and variance of I and Q over stats.
+
+    Returns a float array with indices (channel, retrigger, quantity) where
+    quantity runs over (mean I, mean Q, variance I, variance Q).
+    """
+    data = _checkDemod(data).astype(float)
+    mean = data.mean(axis=1)
+    var = data.var(axis=1)
+    return np.concatenate((mean, var), axis=2)
+
+
+def probabilities(data, lines):
+    """Probability of measuring each channel above its discrimination line.
+
+    lines is a list with one (angle, threshold) pair per channel. A point
+    is counted as 1 if its projection onto the unit vector at the given
+    angle (in radians) in the IQ plane is greater than the threshold, and as
+    0 otherwise.
+
+    Returns a float array with indices (channel, retrigger).
+    """
+    data = _checkDemod(data)
+    lines = np.asarray(lines, dtype=float).reshape(-1, 2)
+    if len(lines) != data.shape[0]:
+        raise ValueError("Need one discrimination line per channel: "
+                         "{} lines for {} channels".format(len(lines),
+                                                           data.shape[0]))
+    angles, thresholds = lines.T
+    # projection[channel, stat, retrigger]
+    projection = (data[..., 0] * np.cos(angles)[:, None, None] +
+                  data[..., 1] * np.sin(angles)[:, None, None])
+    return (projection > thresholds[:, None, None]).mean(axis=1)
+
+
+def histogram(data, bins=DEFAULT_HISTOGRAM_BINS, limit=None):
+    """Two dimensional IQ histogram for each channel and retrigger.
+
+    The bins are square and cover -limit to +limit on both axes. If limit is
+    None the largest absolute I or Q value in the data is used, so that no
+    points are dropped.
+
+    Returns an integer array with indices (channel, retrigger, I bin, Q bin).
+    """
+    data = _checkDemod(data)
+    nChannels, nStats, nTriggers, _ = data.shape
+    if limit is None:
+        limit = max(np.abs(data).max(), 1) if data.size else 1
+    edges = np.linspace(-limit, limit, bins + 1)
+    hist = np.zeros((nChannels, nTriggers, bins, bins), dtype=int)
+    for ch in range(nChannels):
+        for trig in range(nTriggers):
+            I = data[ch, :, trig, 0]
+            Q = data[ch, :, trig, 1]
+            hist[ch, trig], _, _ = np.histogram2d(I, Q, bins=[edges, edges])
+    return hist
+
+
+def reduce(data, mode, lines=None, bins=DEFAULT_HISTOGRAM_BINS, limit=None):
+    """Apply the named reduction to demod data.
+
+    mode is one of REDUCTIONS. 'none' returns the data unchanged.
+    """
+    if mode == 'none':
+        return data
+    elif mode == 'mean':
+        return meanVariance(data)
+    elif mode == 'probabilities':
+        if lines is None:
+            raise ValueError("Discrimination lines must be set to compute "
+                             "probabilities")
+        return probabilities(data, lines)
+    elif mode == 'histogram':
+        return histogram(data, bins, limit)
+    else:
+        raise ValueError("Unknown reduction '{}'".format(mode))
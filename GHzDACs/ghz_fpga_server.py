@@ -224,6 +224,7 @@ from labrad.server import setting
 import servers.GHzDACs.Cleanup.fpga as fpga
 import servers.GHzDACs.Cleanup.dac as dac
 import servers.GHzDACs.Cleanup.adc as adc
+import servers.GHzDACs.demod_stats as demod_stats
 
 from util import TimedLock, LoggingPacket
 LOGGING_PACKET=False
@@ -254,6 +255,13 @@ I2C_END = 0x400
 #       badly to slow down pipelining
 
 
+# Time to wait for boards to answer a detection ping, in seconds
+DETECTION_TIMEOUT = 1.0
+
+# Allowed values for the Result Format setting
+RESULT_FORMATS = ['labrad', 'binary']
+
+
 class TimeoutError(Exception):
     """Error raised when boards timeout."""
 
@@ -284,6 +292,10 @@ class BoardGroup(object):
         self.setupState = set()
         self.runWaitTimes = []
         self.prevTriggers = 0
+        # MAC -> (devName, args) for every board found by a previous
+        # detection. A refresh only pings MACs that are not in here.
+        self.knownBoards = {}
+        self.rescanRequested = False
     
     @inlineCallbacks
     def init(self):
@@ -301,18 +313,31 @@ class BoardGroup(object):
         
     def configure(self, name, boards):
         """Update configuration for this board group."""
+        if getattr(self, 'name', name) != name:
+            # cached device names include the board group name
+            self.knownBoards = {}
         self.name = name
         self.boardOrder = ['%s %s' % (name, boardName) for \
                               (boardName, delay) in boards]
         self.boardDelays = [delay for (boardName, delay) in boards]
         
     @inlineCallbacks
-    def detectBoards(self):
+    def detectBoards(self, rescan=False):
         """Detect boards on the ethernet adapter managed by this board group.
         
-        The autodetect operation is guarded by board group locks so that it
+        Boards found by earlier detections are cached in self.knownBoards and
+        by default only the MACs we have not seen yet are pinged. Known boards
+        (the only ones that can be running sequences) are not addressed, so
+        this does not need the board group locks and never stalls sequencing.
+        Boards that disappear stay in the cache until a rescan.
+        
+        If rescan is True the cache is discarded and every MAC is pinged.
+        This autodetect operation is guarded by board group locks so that it
         will not conflict with sequences running on this board group.
         """
+        if not rescan:
+            yield self._detectAll(skip=set(self.knownBoards))
+            returnValue(self.knownBoards.values())
         try:
             # acquire all locks so we can ping boards without
             # interfering with board group operations
@@ -323,16 +348,8 @@ class BoardGroup(object):
             yield self.runLock.acquire()
             yield self.readLock.acquire()
             
-            # detect each board type in its own context
-            detections = [self.detectDACs(), self.detectADCs()]
-            answer = yield defer.DeferredList(detections, consumeErrors=True)
-            found = []
-            for success, result in answer:
-                if success:
-                    found.extend(result)
-                else:
-                    print 'autodetect error:'
-                    result.printTraceback()
+            self.knownBoards = {}
+            yield self._detectAll()
             
             # Clear detection packets which may be buffered in device contexts
             # TODO: check that this actually clears packets
@@ -341,7 +358,7 @@ class BoardGroup(object):
             for dev in devices:
                 clears.append(dev.clear().send())
             
-            returnValue(found)
+            returnValue(self.knownBoards.values())
         finally:
             # release all locks once we're done with autodetection
             for i in xrange(NUM_PAGES):
@@ -351,7 +368,21 @@ class BoardGroup(object):
             self.runLock.release()
             self.readLock.release()
 
-    def detectDACs(self, timeout=1.0):
+    @inlineCallbacks
+    def _detectAll(self, skip=()):
+        """Detect DACs and ADCs concurrently, each in its own context."""
+        detections = [self.detectDACs(skip=skip), self.detectADCs(skip=skip)]
+        answer = yield defer.DeferredList(detections, consumeErrors=True)
+        found = []
+        for success, result in answer:
+            if success:
+                found.extend(result)
+            else:
+                print 'autodetect error:'
+                result.printTraceback()
+        returnValue(found)
+
+    def detectDACs(self, timeout=DETECTION_TIMEOUT, skip=()):
         """Try to detect DAC boards on this board group."""
         def callback(src, data):
             board = int(src[-2:], 16)
@@ -360,10 +391,11 @@ class BoardGroup(object):
             args = devName, self, self.server, self.port, board, build
             return (devName, args)
         macs = [dac.DAC.macFor(board) for board in range(256)]
+        macs = [mac for mac in macs if mac not in skip]
         return self._doDetection(macs, dac.DAC.regPing(),
-                                 dac.DAC.READBACK_LEN, callback)
+                                 dac.DAC.READBACK_LEN, callback, timeout)
     
-    def detectADCs(self, timeout=1.0):
+    def detectADCs(self, timeout=DETECTION_TIMEOUT, skip=()):
         """Try to detect ADC boards on this board group."""
         def callback(src, data):
             board = int(src[-2:], 16)
@@ -372,19 +404,23 @@ class BoardGroup(object):
             args = devName, self, self.server, self.port, board, build
             return (devName, args)
         macs = [adc.ADC.macFor(board) for board in range(256)]
+        macs = [mac for mac in macs if mac not in skip]
         return self._doDetection(macs, adc.ADC.regPing(),
-                                 adc.ADC.READBACK_LEN, callback)
+                                 adc.ADC.READBACK_LEN, callback, timeout)
 
     @inlineCallbacks
-    def _doDetection(self, macs, packet, respLength, callback, timeout=1.0):
+    def _doDetection(self, macs, packet, respLength, callback,
+                     timeout=DETECTION_TIMEOUT):
         """
         Try to detect a boards at the specified mac addresses.
         
         For each response of the correct length received within the timeout
         from one of the given mac addresses, the callback function will be
         called and should return data to be added to the list of found
-        devices.
+        devices. Found devices are also added to self.knownBoards.
         """
+        if not macs:
+            returnValue([])
         try:
             ctx = self.server.context()
             
@@ -408,6 +444,7 @@ class BoardGroup(object):
                     src, dst, eth, data = ans[0]
                     if src in macs:
                         devInfo = callback(src, data)
+                        self.knownBoards[src] = devInfo
                         found.append(devInfo)
                 except T.Error as e:
                     logging.error("timeout exception: {}".format(str(e)))
@@ -959,22 +996,23 @@ class FPGAServer(DeviceServer):
         removals = existing - configured
         keepers = existing - removals
         
-        # check each addition to see whether the desired server/port exists
-        for key in set(additions):
+        # check all additions and keepers to see whether the desired
+        # server/port exists. The checks for different adapters run
+        # concurrently.
+        keys = sorted(additions | keepers)
+        checks = [self.adapterExists(server, port) for server, port in keys]
+        exists = yield defer.gatherResults(checks)
+        for key, ok in zip(keys, exists):
+            if ok:
+                continue
             server, port = key
-            exists = yield self.adapterExists(server, port)
-            if not exists:
+            if key in additions:
                 print "Adapter '%s' (port %d) does not exist. Group will not be added." % (server, port)
                 additions.remove(key)
-        
-        # check each keeper to see whether the server/port still exists
-        for key in set(keepers):
-            server, port = key
-            exists = yield self.adapterExists(server, port)
-            if not exists:
+            else:
                 print "Adapter '%s' (port %d) does not exist. Group will be removed." % (server, port)
                 keepers.remove(key)
-                removals.add(key)                
+                removals.add(key)
         
         print 'Board groups to be added:', additions
         print 'Board groups to be removed:', removals
@@ -986,22 +1024,28 @@ class FPGAServer(DeviceServer):
             yield bg.shutdown()
         
         # add new board groups
+        newGroups = {}
         for server, port in additions:
             name, boards = config[server, port]
             print "Creating board group '%s': server='%s', port=%d" \
                       % (name, server, port)
             de = cxn.servers[server]
-            boardGroup = BoardGroup(self, de, port) #Sets attributes
-            yield boardGroup.init() #Gets context with direct ethernet
-            self.boardGroups[server, port] = boardGroup
-        
-        # update configuration of all board groups and detect devices
+            newGroups[server, port] = BoardGroup(self, de, port) #Sets attributes
+        #Get contexts with direct ethernet
+        yield defer.gatherResults([bg.init() for bg in newGroups.values()])
+        self.boardGroups.update(newGroups)
+        
+        # update configuration of all board groups and detect devices.
+        # Detection runs concurrently on all board groups. Each group only
+        # locks its own pipeline, and only if a full rescan was requested.
         detections = []
         groupNames = []
         for (server, port), boardGroup in self.boardGroups.items():
             name, boards = config[server, port]
             boardGroup.configure(name, boards)
-            detections.append(boardGroup.detectBoards()) #Board detection#
+            rescan = boardGroup.rescanRequested
+            boardGroup.rescanRequested = False
+            detections.append(boardGroup.detectBoards(rescan)) #Board detection#
             groupNames.append(name)
         answer = yield defer.DeferredList(detections, consumeErrors=True)
         found = []
@@ -1063,6 +1107,11 @@ class FPGAServer(DeviceServer):
         c['daisy_chain'] = []
         c['timing_order'] = None
         c['master_sync'] = 249
+        c['result_format'] = 'labrad'
+        c['reduction'] = 'none'
+        c['discrimination_lines'] = None
+        c['histogram_bins'] = demod_stats.DEFAULT_HISTOGRAM_BINS
+        c['histogram_limit'] = None
     
     ## remote settings
     
@@ -1121,6 +1170,24 @@ class FPGAServer(DeviceServer):
             devices = [name for name in devices if name.startswith(boardGroup)]
         return devices
     
+    @setting(13, 'Rescan Boards', boardGroup='s', returns='')
+    def rescan_boards(self, c, boardGroup=None):
+        """Forget cached boards and ping every MAC address again.
+        
+        A normal device refresh only pings MAC addresses that have not
+        answered before, so it does not disturb running sequences but will
+        not notice boards that were removed. This requests a full detection
+        on the given board group (or all board groups), which locks that
+        group's pipeline while it runs, and then refreshes the device list.
+        """
+        if boardGroup is None:
+            groups = self.boardGroups.values()
+        else:
+            groups = [self.getBoardGroup(boardGroup)]
+        for bg in groups:
+            bg.rescanRequested = True
+        yield self.refreshDeviceList()
+    
     ## Memory and SRAM upload
 
     @setting(20, 'SRAM', data='*w: SRAM Words to be written', returns='')
@@ -1376,7 +1443,8 @@ class FPGAServer(DeviceServer):
     @setting(50, 'Run Sequence', reps='w', getTimingData='b',
                              setupPkts='?{(((ww), s, ((s?)(s?)(s?)...))...)}',
                              setupState='*s',
-                             returns=['*4i','*3i',''])
+                             returns=['*4i', '*3i', '*3v', '*2v', '(s*ws)',
+                                      ''])
     def run_sequence(self, c, reps=30, getTimingData=True, setupPkts=[],
                      setupState=[]):
         """Executes a sequence on one or more boards.
@@ -1414,6 +1482,12 @@ class FPGAServer(DeviceServer):
 
             ADC boards must be either all in average mode or all in demodulate
             mode.
+
+            Demodulate mode data can be reduced on the server before it is
+            returned. See "Result Reduction".
+
+            If "Result Format" is set to 'binary', the same array is instead
+            returned as a cluster (data, shape, dtype). See packResults.
         """
         logging.info("Run sequence")
         logging.debug("Setup packets: " + str(setupPkts))
@@ -1460,6 +1534,12 @@ class FPGAServer(DeviceServer):
         # print "fpga server: buildRunner reps: %s" % (reps,)
         runners = [dev.buildRunner(reps, c.get(dev, {})) for dev in devs]
         
+        # check the result reduction fits the data before running anything,
+        # rather than failing after the run and losing the data
+        if c['reduction'] != 'none':
+            checkReduction(c['reduction'], c['discrimination_lines'],
+                           runners, timingOrder if getTimingData else [])
+
         # build setup requests
         setupReqs = processSetupPackets(self.client, setupPkts)
         logging.debug("Setup Reqs: " + str(setupReqs))
@@ -1481,6 +1561,13 @@ class FPGAServer(DeviceServer):
                         c[runner.dev]['ranges'] = runner.ranges
                 if ans is not None:
                     ans = np.asarray(ans)
+                    if c['reduction'] != 'none':
+                        ans = demod_stats.reduce(ans, c['reduction'],
+                                                 c['discrimination_lines'],
+                                                 c['histogram_bins'],
+                                                 c['histogram_limit'])
+                    if c['result_format'] == 'binary':
+                        ans = packResults(ans)
                 returnValue(ans)
             except TimeoutError as err:
                 # log attempt to stdout and file
@@ -1572,6 +1659,77 @@ class FPGAServer(DeviceServer):
             c['master_sync'] = sync
         return sync
 
+    @setting(56, 'Result Format', fmt='s', returns='s')
+    def sequence_result_format(self, c, fmt=None):
+        """Set or get the format of data returned by Run Sequence.
+        
+        'labrad' (the default) returns data as a LabRAD integer array.
+        
+        'binary' returns a cluster (data, shape, dtype) where data is the raw
+        byte string of the result array. Clients rebuild the array with
+        np.frombuffer(data, dtype=dtype).reshape(shape), which is much faster
+        than decoding a large LabRAD array element by element.
+        """
+        if fmt is None:
+            fmt = c['result_format']
+        else:
+            fmt = fmt.lower()
+            assert fmt in RESULT_FORMATS, 'unknown format: "%s"' % fmt
+            c['result_format'] = fmt
+        return fmt
+
+    @setting(57, 'Result Reduction', mode='s', returns='s')
+    def sequence_result_reduction(self, c, mode=None):
+        """Set or get the reduction applied to demod data by Run Sequence.
+        
+        The (channel, stat, retrigger, I/Q) array from ADC boards in demod
+        mode can be reduced on the server, so that only the reduced result
+        is sent back:
+        
+        'none' (default): return the full array.
+        'mean': *3v with indices (channel, retrigger, quantity), where the
+            quantities are (mean I, mean Q, variance I, variance Q).
+        'probabilities': *2v with indices (channel, retrigger) giving the
+            fraction of stats above each channel's discrimination line. See
+            "Discrimination Lines".
+        'histogram': *4i with indices (channel, retrigger, I bin, Q bin).
+            See "Histogram Range".
+        """
+        if mode is None:
+            mode = c['reduction']
+        else:
+            mode = mode.lower()
+            assert mode in demod_stats.REDUCTIONS, \
+                'unknown reduction: "%s"' % mode
+            c['reduction'] = mode
+        return mode
+
+    @setting(58, 'Discrimination Lines', lines='*(vv)', returns='*(vv)')
+    def sequence_discrimination_lines(self, c, lines=None):
+        """Set or get the state discrimination lines for each demod channel.
+        
+        One (angle, threshold) pair is given for each demod channel in the
+        timing order. A stat counts as 1 if its IQ point, projected onto the
+        unit vector at angle (radians), is greater than threshold.
+        """
+        if lines is None:
+            lines = c['discrimination_lines'] or []
+        else:
+            c['discrimination_lines'] = [(float(a), float(t))
+                                         for a, t in lines]
+        return lines
+
+    @setting(60, 'Histogram Range', bins='w', limit='v', returns='')
+    def sequence_histogram_range(self, c, bins, limit=None):
+        """Set the binning of IQ histograms.
+        
+        Histograms have bins x bins square bins covering -limit to +limit
+        in both I and Q. If limit is not given, the largest absolute value
+        in each run's data is used.
+        """
+        c['histogram_bins'] = bins
+        c['histogram_limit'] = limit
+
     @setting(59, 'Performance Data', returns='*((sw)(*v, *v, *v, *v, *v))')
     def sequence_performance_data(self, c):
         """Get data about the pipeline performance.
@@ -2163,6 +2321,46 @@ def processSetupPackets(cxn, setupPkts):
         pkts.append(p)
     return pkts
 
+def checkReduction(mode, lines, runners, timingOrder):
+    """Check that a result reduction can be applied to a sequence's data.
+    
+    Reductions need demodulated data, so every channel in the timing order
+    must be an ADC demod channel ('<device name>::<channel>') of a board
+    in demodulate mode, and 'probabilities' needs one discrimination line
+    per channel. Raises ValueError otherwise.
+    """
+    modes = dict((runner.dev.devName, getattr(runner, 'runMode', None))
+                 for runner in runners)
+    if not timingOrder:
+        raise ValueError("Result reduction '%s' needs timing data from "
+                         "ADC demod channels" % mode)
+    for name in timingOrder:
+        board = name.split('::')[0]
+        if '::' not in name or modes.get(board) != 'demodulate':
+            raise ValueError("Result reduction '%s' needs demodulated data, "
+                             "but timing order has '%s'" % (mode, name))
+    if mode == 'probabilities':
+        if lines is None:
+            raise ValueError("Discrimination lines must be set to compute "
+                             "probabilities")
+        if len(lines) != len(timingOrder):
+            raise ValueError("Need one discrimination line per channel: "
+                             "%d lines for %d channels" % (len(lines),
+                                                           len(timingOrder)))
+
+def packResults(data):
+    """Pack a result array into a (data, shape, dtype) cluster.
+    
+    Integer arrays are converted to little-endian 32 bit ints, matching the
+    element type of the LabRAD *i arrays normally returned, and float arrays
+    (reduced results) to little-endian doubles. The array is flattened to a
+    byte string in C order and recovered with
+    np.frombuffer(data, dtype=dtype).reshape(shape).
+    """
+    dtype = '<f8' if np.asarray(data).dtype.kind == 'f' else '<i4'
+    data = np.ascontiguousarray(data, dtype=dtype)
+    return (data.tostring(), [long(n) for n in data.shape], data.dtype.str)
+
 __server__ = FPGAServer()
 
 if __name__ == '__main__':
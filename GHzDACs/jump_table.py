@@ -9,6 +9,12 @@ IDLE_NUM_BITS = 15
 IDLE_MIN_CYCLES = 0
 IDLE_MAX_CYCLES = (2 ** IDLE_NUM_BITS) - 1
 
+CELL_NS = 4  # one SRAM cell (4 words) is played per FPGA cycle
+
+# Stop executing a jump table after this many operations. Real sequences
+# never get close; this only protects against runaway CYCLE counters.
+MAX_EXECUTED_OPS = 100000
+
 
 class JumpEntry(object):
     """A single entry in the jump table.
@@ -37,6 +43,10 @@ class JumpEntry(object):
         self.to_addr = to_addr
         self.operation = operation
 
+    def key(self):
+        """Hashable value identifying this entry, used for caching."""
+        return self.from_addr, self.to_addr, self.operation.key()
+
     def __str__(self):
         f_str = "from_addr: %d" % self.from_addr
         t_str = "to_addr: %d" % self.to_addr
@@ -65,6 +75,10 @@ class Operation(object):
     def __str__(self):
         raise NotImplementedError()
 
+    def key(self):
+        """Hashable value identifying this operation, used for caching."""
+        return (self.NAME,) + tuple(sorted(vars(self).items()))
+
     def as_bytes(self):
         """Get an array of bytes representing this operation.
 
@@ -352,6 +366,156 @@ class JumpTable(object):
         return s
 
 
+class CompiledJumpTable(object):
+    """A jump table serialized for the FPGA, with its execution trace.
+
+    Attributes:
+        table (JumpTable): the jump table.
+        data (str): byte string to write to the board.
+        run (JumpTableRun): result of executing the table once.
+    """
+
+    def __init__(self, table, sram_cells):
+        self.table = table
+        self.data = table.toString()
+        self.run = run_jump_table(self.data, sram_cells)
+
+    @property
+    def cycles(self):
+        """Number of FPGA cycles for one execution."""
+        return self.run.cycles
+
+    @property
+    def duration_ns(self):
+        """Length of one execution in ns."""
+        return self.run.cycles * CELL_NS
+
+    def toString(self):
+        return self.data
+
+
+# Execution
+
+def _from_little_endian(data):
+    """Convert a sequence of little endian bytes to an int."""
+    return sum(int(b) << (8 * i) for i, b in enumerate(data))
+
+
+def parse_jump_table(data):
+    """Decode a jump table byte string.
+
+    Returns (counters, start_addr, entries). entries is indexed by hardware
+    jump table index and contains (from_addr, to_addr, opcode) tuples. Entry
+    0 is the start entry, so JumpTable.jumps[0] is entries[1].
+    """
+    a = np.fromstring(data, dtype='u1')
+    counters = [_from_little_endian(a[4*i:4*i + 4]) for i in range(4)]
+    start_addr = _from_little_endian(a[16:19])
+    entries = []
+    for ofs in range(16, len(a), 8):
+        entries.append((_from_little_endian(a[ofs:ofs + 3]),
+                        _from_little_endian(a[ofs + 3:ofs + 6]),
+                        _from_little_endian(a[ofs + 6:ofs + 8])))
+    return counters, start_addr, entries
+
+
+class JumpTableRun(object):
+    """The SRAM cells played by one execution of a jump table.
+
+    Attributes:
+        segments (list of (cell, length, stride)): stride 1 means length
+            consecutive cells starting at cell were played, stride 0 means
+            cell was held for length cycles by an IDLE.
+        reason (str): why execution stopped. 'end' for an END operation,
+            'loop' if the table loops forever, 'overrun' if the SRAM pointer
+            ran off the end of SRAM without reaching the from address of the
+            active entry, and 'limit' if MAX_EXECUTED_OPS was reached.
+    """
+
+    def __init__(self, segments, reason):
+        self.segments = segments
+        self.reason = reason
+
+    @property
+    def cycles(self):
+        """Number of FPGA cycles taken by this execution."""
+        return sum(length for cell, length, stride in self.segments)
+
+    @property
+    def last_cell(self):
+        """Highest SRAM cell played."""
+        return max([cell + stride * (length - 1)
+                    for cell, length, stride in self.segments if length] or
+                   [-1])
+
+    def cells(self):
+        """Array of the played SRAM cells, one per FPGA cycle."""
+        if not self.segments:
+            return np.zeros(0, dtype=int)
+        return np.concatenate([cell + stride * np.arange(length)
+                               for cell, length, stride in self.segments])
+
+
+def run_jump_table(data, sram_cells, max_ops=MAX_EXECUTED_OPS):
+    """Execute a jump table byte string and return a JumpTableRun.
+
+    Only the active entry is checked against the SRAM pointer. An entry
+    fires on the cell after its from address (two cells after for END):
+
+    IDLE  - hold the current cell for the given number of extra cycles
+    NOP   - continue with the next entry
+    JUMP  - move the SRAM pointer to the to address and activate the given
+            entry
+    CYCLE - if the counter has not reached its count value, increment it and
+            jump as for JUMP, otherwise reset it and continue
+    CHECK - daisy chain bits are not known here, so the check never passes
+    END   - stop and idle on the current cell
+    """
+    counters, cell, entries = parse_jump_table(data)
+    counts = [0] * len(counters)
+    index = 1
+    segments = []
+    seen = set()
+    for _ in xrange(max_ops):
+        state = (cell, index, tuple(counts))
+        if state in seen:
+            return JumpTableRun(segments, 'loop')
+        seen.add(state)
+        if index >= len(entries):
+            segments.append((cell, max(sram_cells - cell, 0), 1))
+            return JumpTableRun(segments, 'overrun')
+        from_addr, to_addr, op = entries[index]
+        is_end = (op & 0x7) == 0x7
+        fire = from_addr + (2 if is_end else 1)
+        if not (cell <= fire < sram_cells):
+            segments.append((cell, max(sram_cells - cell, 0), 1))
+            return JumpTableRun(segments, 'overrun')
+        segments.append((cell, fire - cell + 1, 1))
+        if op & 0x1 == 0:
+            # IDLE
+            if op >> 1:
+                segments.append((fire, op >> 1, 0))
+            cell, index = fire + 1, index + 1
+        elif is_end:
+            return JumpTableRun(segments, 'end')
+        elif op & 0xF == 0xD:
+            # JUMP
+            cell, index = to_addr, (op >> 8) & 0x3F
+        elif op & 0x7 == 0x3:
+            # CYCLE
+            counter = (op >> 4) & 0x3
+            if counts[counter] != counters[counter]:
+                counts[counter] += 1
+                cell, index = to_addr, (op >> 8) & 0x3F
+            else:
+                counts[counter] = 0
+                cell, index = fire + 1, index + 1
+        else:
+            # NOP, or CHECK with the daisy chain bit not set
+            cell, index = fire + 1, index + 1
+    return JumpTableRun(segments, 'limit')
+
+
 # TEST FUNCTIONS
 
 def testNormal(stopAddr):
@@ -0,0 +1,174 @@
+"""
+
+This is intended to test servers.GHzDACs.board_emulator.py, and to run the
+device wrappers and BoardGroup of the GHz FPGA server against the emulated
+boards. Unlike test_fpga_server.py nothing here is mocked: the packets go
+through the emulated direct ethernet server to the emulated boards and back.
+
+"""
+
+import numpy as np
+import pytest
+from twisted.python.failure import Failure
+import servers.GHzDACs.board_emulator as emulator
+import servers.GHzDACs.ghz_fpga_server as fpga
+import servers.GHzDACs.jump_table as jump_table
+
+DAC_BOARD = 1
+ADC_BOARD = 2
+TRIGGER_TABLE = [(1, 50, 100, 2), (3, 100, 100, 2)]
+
+
+def _result(d):
+    """Get the result of a Deferred that has already fired."""
+    results = []
+    d.addBoth(results.append)
+    assert results, "Deferred has not fired"
+    if isinstance(results[0], Failure):
+        results[0].raiseException()
+    return results[0]
+
+
+def _connect(dev, de, boardGroup, board):
+    """Set up a device like DAC.connect and ADC.connect, without registry."""
+    dev.boardGroup = boardGroup
+    dev.server = de
+    dev.cxn = de._cxn
+    dev.ctx = de.context()
+    dev.port = 0
+    dev.board = board
+    dev.MAC = dev.macFor(board)
+    dev.devName = dev.name
+    dev.boardParams = {'fifoCounter': 3, 'lvdsSD': 0}
+    p = dev.makePacket()
+    p.connect(0)
+    p.destination_mac(dev.MAC)
+    p.require_source_mac(dev.MAC)
+    p.listen()
+    _result(p.send())
+
+
+def _adcInfo():
+    mixer0 = np.zeros((512, 2), dtype=int)
+    mixer0[:, 0], mixer0[:, 1] = 1, -1
+    mixer1 = np.zeros((512, 2), dtype=int)
+    mixer1[:, 0] = 2
+    return {
+        'runMode': 'demodulate',
+        'startDelay': 0,
+        'mode': 'iq',
+        'triggerTable': TRIGGER_TABLE,
+        0: {'mixerTable': mixer0},
+        1: {'mixerTable': mixer1},
+    }
+
+
+class TestBoardEmulator(object):
+
+    def setup_method(self, method):
+        self.dacBoard = emulator.DacEmulator(DAC_BOARD)
+        self.adcBoard = emulator.AdcEmulator(ADC_BOARD)
+        self.de = emulator.EmulatedDirectEthernet([self.dacBoard,
+                                                   self.adcBoard])
+        self.server = fpga.FPGAServer()
+        self.boardGroup = fpga.BoardGroup(self.server, self.de, 0)
+        _result(self.boardGroup.init())
+        self.boardGroup.configure('Test', [('DAC 1', 0), ('ADC 2', 0)])
+        self.dac = fpga.fpga.REGISTRY[('DAC', 15)](1, 'Test DAC 1')
+        self.adc = fpga.fpga.REGISTRY[('ADC', 7)](2, 'Test ADC 2')
+        _connect(self.dac, self.de, self.boardGroup, DAC_BOARD)
+        _connect(self.adc, self.de, self.boardGroup, ADC_BOARD)
+
+    def test_detect(self):
+        found = _result(self.boardGroup.detectBoards())
+        builds = dict((name, args[-1]) for name, args in found)
+        assert builds == {'Test DAC 1': 15, 'Test ADC 2': 7}
+
+    def test_jump_table(self):
+        entries = [self.dac.make_jump_table_entry('IDLE', [256, 1000]),
+                   self.dac.make_jump_table_entry('END', [512])]
+        jt = self.dac.make_jump_table(entries)
+        sram = np.arange(512, dtype='<u4').tostring()
+        _result(self.dac.load(jt, sram).send())
+        regs = self.dac.regRun(3000, 0, 0, 0, readback=False)
+        _result(self.dac._sendRegisters(regs, readback=False))
+
+        run = self.dacBoard.lastRun
+        assert run.reason == 'end'
+        assert run.cycles == (512 + 1000) // 4
+        played = self.dacBoard.played()
+        assert np.all(played[:256] == np.arange(256))
+        # the idle holds the last cell before 256 ns
+        assert np.all(played[256:1256] == np.tile(np.arange(252, 256), 250))
+        assert np.all(played[1256:] == np.arange(256, 512))
+        assert _result(self.dac.executionCount()) == 3000
+
+    def test_cycle(self):
+        waveform, jt = jump_table.testCycle(2)
+        self.dacBoard.jumpTable = jt.toString()
+        run = self.dacBoard.run()
+        cells = list(run.cells())
+        # cells 10-14 are played once and then repeated for each count
+        assert cells[:15] == range(15)
+        assert cells[15:25] == range(10, 15) * 2
+        assert cells[25:30] == range(15, 20)
+        # jump to 100 ns, back to 0 and end on cell 24//4 - 1
+        assert cells[30:35] == range(25, 30)
+        assert cells[35:] == range(6)
+        assert run.reason == 'end'
+
+    def test_loop(self):
+        jt = self.dac.jt_run_sram(0, 2000, loop=True)
+        self.dacBoard.jumpTable = jt.toString()
+        run = self.dacBoard.run()
+        assert run.reason == 'loop'
+        assert run.cycles == 2000 // 4
+
+    def test_bringup(self):
+        success = _result(self.dac.setLVDS(2, None, True))[0]
+        assert success
+        found, clkinv, PHOF, tries, target = \
+            _result(self.dac.setFIFO('A', 2, None))
+        assert found and PHOF == 0 and tries == 1
+        data = np.random.randint(0, 0x3FFF, 1000)
+        for cmd, shift in [(2, 0), (3, 14)]:
+            success, theory, lvds, fifo = \
+                _result(self.dac.runBIST(cmd, shift, data))
+            assert success
+
+    def test_demod(self):
+        info = _adcInfo()
+        data, pktCounters, readbackCounters = \
+            _result(self.adc.runDemod(info))
+        # (channel, stat, retrigger, I/Q)
+        assert data.shape == (2, 1, 4, 2)
+        assert np.all(data[0, ..., 0] == 200)
+        assert np.all(data[0, ..., 1] == -200)
+        assert np.all(data[1, ..., 0] == 400)
+        assert np.all(data[1, ..., 1] == 0)
+
+    def test_run_sequence(self):
+        """Run sequences through the BoardGroup pipeline."""
+        reps = 30
+        sram = np.zeros(512, dtype='<u4').tostring()
+        timingOrder = ['Test ADC 2::0', 'Test ADC 2::1']
+        for _ in range(100):
+            dacInfo = {
+                'jt_entries': [self.dac.make_jump_table_entry('END', [512])],
+                'jt_counters': [0, 0, 0, 0],
+                'sram': sram,
+            }
+            runners = [self.dac.buildRunner(reps, dacInfo),
+                       self.adc.buildRunner(reps, _adcInfo())]
+            ans = _result(self.boardGroup.run(runners, reps, [], set(), 249,
+                                              True, timingOrder))
+            assert len(ans) == 2
+            # (stat, retrigger, I/Q)
+            assert ans[0].shape == (reps, 4, 2)
+            assert np.all(ans[1][..., 0] == 400)
+        assert self.dacBoard.executionCounter == reps
+        assert [mode for mode, n in self.adcBoard.starts] == [5] * 100
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
@@ -0,0 +1,61 @@
+"""
+
+This is intended to test servers.GHzDACs.demod_stats.py
+
+"""
+
+import numpy as np
+import pytest
+import servers.GHzDACs.demod_stats as demod_stats
+
+
+def _data():
+    # (channel, stat, retrigger, I/Q)
+    data = np.zeros((2, 4, 3, 2), dtype=int)
+    data[0, :, :, 0] = np.array([10, 20, 30, 40])[:, None]
+    data[0, :, :, 1] = -5
+    data[1, :, :, 0] = np.array([-100, 100, 100, 100])[:, None]
+    data[1, :, :, 1] = np.array([0, 0, 50, 50])[:, None]
+    return data
+
+
+def test_mean_variance():
+    result = demod_stats.meanVariance(_data())
+    assert result.shape == (2, 3, 4)
+    assert np.allclose(result[0, :, 0], 25)
+    assert np.allclose(result[0, :, 1], -5)
+    assert np.allclose(result[0, :, 2], 125)
+    assert np.allclose(result[0, :, 3], 0)
+    assert np.allclose(result[1, :, 0], 50)
+
+
+def test_probabilities():
+    # channel 0: threshold on I, channel 1: threshold on Q
+    lines = [(0.0, 25.0), (np.pi/2, 25.0)]
+    result = demod_stats.probabilities(_data(), lines)
+    assert result.shape == (2, 3)
+    assert np.allclose(result[0], 0.5)
+    assert np.allclose(result[1], 0.5)
+    with pytest.raises(ValueError):
+        demod_stats.probabilities(_data(), lines[:1])
+
+
+def test_histogram():
+    data = _data()
+    hist = demod_stats.histogram(data, bins=4, limit=200)
+    assert hist.shape == (2, 3, 4, 4)
+    # every stat lands in exactly one bin
+    assert np.all(hist.sum(axis=(2, 3)) == data.shape[1])
+
+
+def test_reduce():
+    data = _data()
+    assert demod_stats.reduce(data, 'none') is data
+    with pytest.raises(ValueError):
+        demod_stats.reduce(data, 'probabilities')
+    with pytest.raises(ValueError):
+        demod_stats.reduce(data[..., 0], 'mean')
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
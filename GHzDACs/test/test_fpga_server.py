@@ -177,6 +177,58 @@ class TestFPGAServer(object):
             # check JT
             assert np.array_equal(matching_jt_packet, load_writes[0])
 
+    def test_compile_jump_table(self):
+        dev = self.dev
+        entries = [dev.make_jump_table_entry('IDLE', [256, 1000]),
+                   dev.make_jump_table_entry('END', [512])]
+        compiled = dev.compile_jump_table(entries, sram_len=512)
+        assert compiled.duration_ns == 512 + 1000
+        # same entries give the cached table
+        same = [dev.make_jump_table_entry('IDLE', [256, 1000]),
+                dev.make_jump_table_entry('END', [512])]
+        assert dev.compile_jump_table(same, sram_len=512) is compiled
+        with pytest.raises(ValueError):
+            # plays SRAM beyond the loaded derps
+            dev.compile_jump_table(entries, sram_len=256)
+        with pytest.raises(ValueError):
+            # jumps to a missing entry
+            dev.compile_jump_table(
+                [dev.make_jump_table_entry('JUMP', [256, 0, 5])])
+        with pytest.raises(ValueError):
+            # nested loops sharing counter 0
+            dev.compile_jump_table(
+                [dev.make_jump_table_entry('CYCLE', [200, 100, 1, 0]),
+                 dev.make_jump_table_entry('CYCLE', [400, 0, 1, 0]),
+                 dev.make_jump_table_entry('END', [512])],
+                counters=[3])
+        with pytest.raises(ValueError):
+            # never reaches END
+            dev.compile_jump_table(
+                [dev.make_jump_table_entry('JUMP', [256, 0, 1])])
+        looped = dev.compile_jump_table(
+            [dev.make_jump_table_entry('JUMP', [256, 0, 1])], loop=True)
+        assert looped.run.reason == 'loop'
+
+    def test_sequence_time(self):
+        reps = 1000
+        info = {
+            'jt_entries': [self.dev.make_jump_table_entry('IDLE', [256, 1000]),
+                           self.dev.make_jump_table_entry('END', [512])],
+            'jt_counters': [0, 0, 0, 0],
+            'sram': np.zeros(512, dtype='<u4').tostring(),
+            'startDelay': 100,
+            'loop_delay': 50,
+        }
+        runner = self.dev.buildRunner(reps, info)
+        runner.loadPacket(page=0, isMaster=True)
+        runner.runPacket(page=0, slave=0, delay=self.global_board_delay,
+                         sync=249)
+        delay_us = (100 + fpga.dac.MASTER_SRAM_DELAY_US +
+                    self.global_board_delay + 50)
+        rep_time = delay_us * 1e-6 + (512 + 1000) * 1e-9
+        expected = fpga.fpga.TIMEOUT_FACTOR * reps * rep_time + 1
+        assert abs(runner.seqTime - expected) < 1e-9
+
     def _fake_run_sequence(self):
         """ Emulate some of the logic of run_sequence for testing purposes.
         """
@@ -198,5 +250,37 @@ class TestFPGAServer(object):
             ))
             is_master = False
 
+
+def test_pack_results():
+    data = np.arange(2*5*3*2).reshape(2, 5, 3, 2) - 30
+    packed, shape, dtype = fpga.packResults(data)
+    assert list(shape) == [2, 5, 3, 2]
+    unpacked = np.frombuffer(packed, dtype=dtype).reshape(shape)
+    assert np.array_equal(unpacked, data)
+
+
+
+def test_check_reduction():
+    adc = mock.Mock(runMode='demodulate')
+    adc.dev.devName = 'Vince ADC 1'
+    avg = mock.Mock(runMode='average')
+    avg.dev.devName = 'Vince ADC 2'
+    dac = mock.Mock(spec=['dev'])
+    dac.dev.devName = 'Vince DAC 1'
+    runners = [adc, avg, dac]
+    order = ['Vince ADC 1::0', 'Vince ADC 1::1']
+    fpga.checkReduction('mean', None, runners, order)
+    fpga.checkReduction('probabilities', [(0, 1), (0.5, 2)], runners, order)
+    with pytest.raises(ValueError):
+        fpga.checkReduction('mean', None, runners, [])
+    with pytest.raises(ValueError):
+        fpga.checkReduction('mean', None, runners, ['Vince ADC 2'])
+    with pytest.raises(ValueError):
+        fpga.checkReduction('mean', None, runners, ['Vince ADC 2::0'])
+    with pytest.raises(ValueError):
+        fpga.checkReduction('probabilities', None, runners, order)
+    with pytest.raises(ValueError):
+        fpga.checkReduction('probabilities', [(0, 1)], runners, order)
+
 if __name__ == '__main__':
     pytest.main(['-v', __file__])
@@ -71,5 +71,42 @@ def test_table():
     assert np.array_equal(data[32:40], end.as_bytes())
 
 
+def test_run_end():
+    # END on cell 63 after 4 ns idle, i.e. after 256 ns of SRAM
+    end = jump_table.JumpEntry(256//4 - 3, 0, jump_table.END())
+    jt = jump_table.JumpTable(0, [end])
+    run = jump_table.run_jump_table(jt.toString(), 1024)
+    assert run.reason == 'end'
+    assert run.cycles == 64
+    assert run.last_cell == 63
+    assert list(run.cells()) == range(64)
+
+
+def test_run_idle_and_cycle():
+    idle = jump_table.JumpEntry(20//4 - 2, 0, jump_table.IDLE(10))
+    # play cells 10-14 three times using counter 1
+    cycle = jump_table.JumpEntry(60//4 - 2, 40//4, jump_table.CYCLE(1, 2))
+    end = jump_table.JumpEntry(100//4 - 3, 0, jump_table.END())
+    jt = jump_table.JumpTable(0, [idle, cycle, end], [0, 2, 0, 0])
+    run = jump_table.run_jump_table(jt.toString(), 1024)
+    assert run.reason == 'end'
+    assert run.cycles == 25 + 10 + 2 * 5
+    compiled = jump_table.CompiledJumpTable(jt, 1024)
+    assert compiled.toString() == jt.toString()
+    assert compiled.duration_ns == 4 * run.cycles
+
+
+def test_run_loop_and_overrun():
+    jump = jump_table.JumpEntry(100//4 - 2, 0, jump_table.JUMP(1))
+    run = jump_table.run_jump_table(
+        jump_table.JumpTable(0, [jump]).toString(), 1024)
+    assert run.reason == 'loop'
+    assert run.cycles == 25
+    end = jump_table.JumpEntry(2000//4 - 3, 0, jump_table.END())
+    run = jump_table.run_jump_table(
+        jump_table.JumpTable(0, [end]).toString(), 256)
+    assert run.reason == 'overrun'
+
+
 if __name__ == '__main__':
     pytest.main(['-v', __file__])
\ No newline at end of file
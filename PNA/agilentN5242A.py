@@ -17,7 +17,7 @@
 ### BEGIN NODE INFO
 [info]
 name = PNA_X
-version = 1.1
+version = 1.3
 description = Talks to the Agilent PNA-X
 
 [startup]
@@ -35,7 +35,6 @@ from labrad.server import setting
 from labrad.gpib import GPIBManagedServer, GPIBDeviceWrapper
 from twisted.internet.defer import inlineCallbacks, returnValue
 
-from struct import unpack
 import time
 import numpy
 
@@ -44,12 +43,46 @@ import labrad.units as units
 # the names of the measured parameters
 MEAS_PARAM = ['S11', 'S12', 'S21', 'S22']
 
+# numpy dtype of each trace transfer format, None for ASCII
+TRACE_FORMATS = {
+    'ASCII': None,
+    'REAL,32': '>f4',
+    'REAL,64': '>f8',
+}
+
 class PNAWrapper(GPIBDeviceWrapper):
     @inlineCallbacks
     def initialize(self):
+        # (sweep type, start, stop, sweep time, points) of a sweep started
+        # ahead of time by freq_sweep, or None
+        self.pendingSweep = None
         yield self.write('FORM:DATA REAL,64')
+        self.dataFormat = 'REAL,64'
         yield self.setupMeasurements(['S21'])
 
+    @inlineCallbacks
+    def setDataFormat(self, fmt):
+        """Select the trace transfer format, if it is not selected already."""
+        if fmt != self.dataFormat:
+            yield self.write('FORM:DATA %s' % fmt)
+            self.dataFormat = fmt
+
+    @inlineCallbacks
+    def queryTrace(self, cmd, fmt):
+        """Query trace data in the given format and return a numpy array.
+
+        Binary blocks are read and decoded by the GPIB bus server, so only
+        the values are sent over LabRAD.
+        """
+        yield self.setDataFormat(fmt)
+        if fmt == 'ASCII':
+            resp = yield self.query(cmd)
+            returnValue(numpy.fromstring(resp, sep=','))
+        p = self._packet()
+        p.query_array(cmd, TRACE_FORMATS[fmt])
+        resp = yield p.send()
+        returnValue(numpy.asarray(resp.query_array, dtype=float))
+
     @inlineCallbacks
     def setupMeasurements(self, desired_meas):
         resp = yield self.query('CALC:PAR:CAT?')
@@ -84,8 +117,14 @@ class AgilentPNAServer(GPIBManagedServer):
     deviceName = ['Agilent Technologies N5242A','Agilent Technologies N5230A','Agilent Technologies E8364B', 'Agilent Technologies N5232A']
     deviceWrapper = PNAWrapper
 
+    # seconds between operation complete polls while waiting for a sweep
+    pollInterval = 0.02
+    # extra seconds to wait for a sweep beyond its expected length
+    sweepTimeoutMargin = 30.0
+
     def initContext(self, c):
         c['meas'] = ['S21']
+        c['traceFormat'] = 'REAL,64'
         
     @setting(10, bw=['v[Hz]'], returns=['v[Hz]'])
     def bandwidth(self, c, bw=None):
@@ -119,6 +158,7 @@ class AgilentPNAServer(GPIBManagedServer):
             fs = tuple(T.Value(float(f), 'Hz') for f in resp.split(';'))
         else:
             yield dev.write('SENS:FREQ:STAR %f; STOP %f' % (fs[0]['Hz'], fs[1]['Hz']))
+            dev.pendingSweep = None
         returnValue(fs)
 
     @setting(13, p=['v[dBm]'], returns=['v[dBm]'])
@@ -197,6 +237,21 @@ class AgilentPNAServer(GPIBManagedServer):
                 yield dev.write('SENS:AVER OFF') # turns averaging off
         returnValue(av)
 
+    @setting(18, fmt=['s'], returns=['s'])
+    def trace_format(self, c, fmt=None):
+        """Get or set the trace transfer format for this context.
+
+        One of 'ASCII', 'REAL,32' or 'REAL,64' (the default). The binary
+        formats transfer 8 or 16 bytes per complex point instead of about
+        40 in ASCII; REAL,32 halves the transfer again at single precision.
+        """
+        if fmt is not None:
+            fmt = fmt.upper()
+            if fmt not in TRACE_FORMATS:
+                raise Exception('Trace format must be one of %s' % sorted(TRACE_FORMATS))
+            c['traceFormat'] = fmt
+        return c['traceFormat']
+
     @setting(40, att=['(v[dB], v[dB])'], returns=[''])
     def atten(self, c, att=None):
         """Get or set the x/y attenuation (ignored...)."""
@@ -248,27 +303,35 @@ class AgilentPNAServer(GPIBManagedServer):
         returnValue(offs)
 
 
-    @setting(100, log='b', returns='*v[Hz]*2c')
-    def freq_sweep(self, c, log=False):
+    @setting(100, log='b', next_range='(v[Hz], v[Hz])',
+             returns='*v[Hz]*2c')
+    def freq_sweep(self, c, log=False, next_range=None):
         """Initiate a frequency sweep.
 
         If log is False (the default), this will perform a
         linear sweep.  If log is True, the sweep will be logarithmic.
+
+        If next_range is given, the frequency range is set to it and the
+        next sweep is started as soon as the data of this one has been
+        read, so it runs while this data is sent back and processed. The
+        next call of freq_sweep with the same log setting then only waits
+        for that sweep to finish. Setting the frequency range in between
+        discards the sweep, other settings only apply to the sweep after it.
         """
         print 'starting'
         dev = self.selectedDevice(c)
 
-        resp = yield dev.query('SENS:FREQ:STAR?; STOP?')
-        fstar, fstop = [float(f) for f in resp.split(';')]
+        sweepType = 'LOG' if log else 'LIN'
+        pending, dev.pendingSweep = dev.pendingSweep, None
+        if pending is not None and pending[0] == sweepType:
+            sweepType, fstar, fstop, sweeptime, npoints = pending
+        else:
+            resp = yield dev.query('SENS:FREQ:STAR?; STOP?')
+            fstar, fstop = [float(f) for f in resp.split(';')]
+            sweeptime, npoints = yield self.startSweep(dev, sweepType)
         print 'fstar = ',fstar
         print 'fstop = ',fstop
-        print resp.split(";")
-        sweepType = 'LOG' if log else 'LIN'
-        sweeptime, npoints = yield self.startSweep(dev, sweepType)
-        if sweeptime > 1:
-            sweeptime *= self.sweepFactor(c)
-            print "sweeptime = ", sweeptime
-            yield util.wakeupCall(sweeptime)  #needs factor of 2 since it runs both forward and backward 
+        yield self.waitForSweep(dev, c, sweeptime)
 
         if log:
             # hack: should use numpy.logspace, but it seems to be broken
@@ -278,8 +341,13 @@ class AgilentPNAServer(GPIBManagedServer):
         else:
             freq = numpy.linspace(fstar, fstop, npoints)
             
-        # wait for sweep to finish
-        sparams = yield self.getSweepData(dev, c['meas'])
+        sparams = yield self.getSweepData(dev, c['meas'], c['traceFormat'])
+
+        if next_range is not None:
+            nstar, nstop = next_range[0]['Hz'], next_range[1]['Hz']
+            yield dev.write('SENS:FREQ:STAR %f; STOP %f' % (nstar, nstop))
+            nexttime, nextpoints = yield self.startSweep(dev, sweepType)
+            dev.pendingSweep = (sweepType, nstar, nstop, nexttime, nextpoints)
         returnValue((freq*units.Hz, sparams))
         
         
@@ -298,9 +366,7 @@ class AgilentPNAServer(GPIBManagedServer):
 
         sweepType = 'LOG' if log else 'LIN'
         sweeptime, npoints = yield self.startSweep(dev, sweepType)
-        if sweeptime > 1:
-            sweeptime *= self.sweepFactor(c)
-            yield util.wakeupCall(2*sweeptime)  #needs factor of 2 since it runs both forward and backward 
+        yield self.waitForSweep(dev, c, sweeptime)
 
         if log:
             ## hack: should use numpy.logspace, but it seems to be broken
@@ -311,7 +377,7 @@ class AgilentPNAServer(GPIBManagedServer):
             freq = numpy.linspace(fstar, fstop, npoints)
             
         # wait for sweep to finish
-        phase = yield self.getSweepDataPhase(dev, c['meas'])
+        phase = yield self.getSweepDataPhase(dev, c['meas'], c['traceFormat'])
         returnValue((freq, phase))
 
     @setting(101, returns='*v[Hz]*2c')
@@ -323,11 +389,9 @@ class AgilentPNAServer(GPIBManagedServer):
         pstar, pstop = [float(p) for p in resp.split(';')]
 
         sweeptime, npoints = yield self.startSweep(dev, 'POW')
-        if sweeptime > 1:
-            sweeptime *= self.sweepFactor(c)
-            yield util.wakeupCall(sweeptime)
+        yield self.waitForSweep(dev, c, sweeptime)
 
-        sparams = yield self.getSweepData(dev, c['meas'])
+        sparams = yield self.getSweepData(dev, c['meas'], c['traceFormat'])
 
         power = util.linspace(pstar, pstop, npoints)
         power = [T.Value(p, 'dBm') for p in power]
@@ -345,12 +409,10 @@ class AgilentPNAServer(GPIBManagedServer):
         pstar, pstop = [float(p) for p in resp.split(';')]
 
         sweeptime, npoints = yield self.startSweep(dev, 'POW')
-        if sweeptime > 1:
-            sweeptime *= self.sweepFactor(c)
-            yield util.wakeupCall(sweeptime)
+        yield self.waitForSweep(dev, c, sweeptime)
         power = util.linspace(pstar, pstop, npoints)
         power = [T.Value(p, 'dBm') for p in power]
-        phase = yield self.getSweepDataPhase(dev, c['meas'])
+        phase = yield self.getSweepDataPhase(dev, c['meas'], c['traceFormat'])
         returnValue((power, phase))
         
     @setting(111, name=['s'], returns=['*2v'])
@@ -367,11 +429,9 @@ class AgilentPNAServer(GPIBManagedServer):
         pstar, pstop = [float(p) for p in resp.split(';')]
 
         sweeptime, npoints = yield self.startSweep(dev, 'POW')
-        if sweeptime > 1:
-            sweeptime *= self.sweepFactor(c)
-            yield util.wakeupCall(sweeptime)
+        yield self.waitForSweep(dev, c, sweeptime)
 
-        sparams = yield self.getSweepData(dev, c['meas'])
+        sparams = yield self.getSweepData(dev, c['meas'], c['traceFormat'])
 
         power = util.linspace(pstar, pstop, npoints)
         power = [T.Value(p, 'dBm') for p in power]
@@ -416,11 +476,9 @@ class AgilentPNAServer(GPIBManagedServer):
         fstar, fstop = [float(f) for f in resp.split(';')]
 
         sweeptime, npoints = yield self.startSweep(dev, 'LIN')
-        if sweeptime > 1:
-            sweeptime *= self.sweepFactor(c)
-            yield util.wakeupCall(sweeptime)
+        yield self.waitForSweep(dev, c, sweeptime)
 
-        sparams = yield self.getSweepData(dev, c['meas'])
+        sparams = yield self.getSweepData(dev, c['meas'], c['traceFormat'])
 
         freq = util.linspace(fstar, fstop, npoints)
         freq = [T.Value(f, 'Hz') for f in freq]
@@ -483,22 +541,26 @@ class AgilentPNAServer(GPIBManagedServer):
         fstar, fstop = [float(f) for f in resp.split(';')]
 
         sweeptime, npoints = yield self.startSweep(dev, 'CW')
-        if sweeptime > 1:
-            sweeptime *= self.sweepFactor(c)
-            print sweeptime
-            yield util.wakeupCall(sweeptime)    
+        yield self.waitForSweep(dev, c, sweeptime)
 
 
         time = numpy.linspace(fstar, fstop, npoints)
         
         # wait for sweep to finish
-        sparams = yield self.getSweepData(dev, c['meas'])
+        sparams = yield self.getSweepData(dev, c['meas'], c['traceFormat'])
         returnValue((numpy.append(time, sweeptime), sparams))
 
     
     
     @inlineCallbacks
     def startSweep(self, dev, sweeptype):
+        """Start a group of sweeps, one per average.
+
+        Also sets *OPC, so that waitForSweep can tell when the group is
+        done. Returns the expected time of one sweep of the group times the
+        number of averages, and the number of points.
+        """
+        dev.pendingSweep = None
         yield dev.write('SENS:SWE:TIME:AUTO ON; :INIT:CONT ON; :OUTP ON')
         resp = yield dev.query('SENS:SWE:TIME?; POIN?')
         sweeptime, npoints = resp.split(';')
@@ -508,114 +570,86 @@ class AgilentPNAServer(GPIBManagedServer):
         # yield dev.write('ABORT;INIT:IMM')
         resp = yield dev.query('SENS:AVER:COUN?')
         sweeptime *= long(resp)
-        yield dev.write('ABORT;SENS:SWE:MODE GRO')
+        yield dev.write('ABORT;*CLS;SENS:SWE:MODE GRO;*OPC')
         print 'sweeptime = ',sweeptime
         print 'npoints = ',npoints
         returnValue((sweeptime, npoints))
 
     @inlineCallbacks
-    def getSweepData(self, dev, meas):
-        yield dev.query('*OPC?') # wait for sweep to finish
-        print 'Query Accepted'
-        sdata = yield self.getSParams(dev, meas)    
+    def waitForSweep(self, dev, c, sweeptime):
+        """Wait until the sweeps started by startSweep are done.
+
+        The *OPC sent by startSweep sets the operation complete bit of the
+        event status register when the group of sweeps is done. We wait for
+        the expected sweep time, which is the shortest the sweep can take,
+        and then poll *ESR? every pollInterval. Each poll is a short query,
+        so the bus stays free for other devices, and the data is read at
+        most pollInterval after the sweep ends.
+        """
+        start = time.time()
+        # each port that sends power takes its own sweep
+        timeout = 2 * sweeptime * self.sweepFactor(c) + self.sweepTimeoutMargin
+        yield util.wakeupCall(sweeptime)
+        while True:
+            esr = yield dev.query('*ESR?')
+            if int(esr) & 1:
+                break
+            if time.time() - start > timeout:
+                raise Exception('Sweep not done after %f s' % (time.time() - start))
+            yield util.wakeupCall(self.pollInterval)
+
+    @inlineCallbacks
+    def getSweepData(self, dev, meas, fmt):
+        sdata = yield self.getSParams(dev, meas, fmt)
         yield dev.write('OUTP OFF')
         returnValue(sdata)
         
     @inlineCallbacks
-    def getSweepDataPhase(self, dev, meas):
-        yield dev.query('*OPC?') # wait for sweep to finish
-        sdata = yield self.getPhaseData(dev, meas)
+    def getSweepDataPhase(self, dev, meas, fmt):
+        sdata = yield self.getPhaseData(dev, meas, fmt)
         yield dev.write('OUTP OFF')
         returnValue(sdata)
 
     @inlineCallbacks
-    def getSParams(self, dev, measurements):
-        sdata = [(yield self.getData(dev, m)) for m in measurements]
+    def getSParams(self, dev, measurements, fmt):
+        sdata = [(yield self.getData(dev, m, fmt)) for m in measurements]
         print 'Got Params'
         returnValue(sdata)
         
     @inlineCallbacks
-    def getPhaseData(self, dev, measurements):
-        sdata = [(yield self.getFormattedData(dev, m)) for m in measurements]
+    def getPhaseData(self, dev, measurements, fmt):
+        sdata = [(yield self.getFormattedData(dev, m, fmt)) for m in measurements]
         returnValue(sdata)
 
     def sweepFactor(self, c):
-        """Multiply the sweeptime by this factor, which
-        counts the number of ports that send power.
+        """Number of ports that send power, each of which needs its own
+        sweep, so the sweep takes this many times the sweep time.
         """
         ports = set(int(p[-1]) for p in c['meas'])
         return len(ports)
 
     @inlineCallbacks
-    def getData(self, dev, meas):
-        """Get binary sweep data from the PNA and parse it.
-
-        The data has the following format:
-
-            1 byte:  '#' (ignored)
-            1 byte:  h = header length
-            h bytes: d = data length
-            d bytes: binary sweep data, as pairs of 64-bit numbers
-            1 byte:  <newline> (ignored)
+    def getData(self, dev, meas, fmt):
+        """Get the complex sweep data (SDATA) of one measurement.
 
-        The 64-bit numbers are unpacked using the struct.unpack
-        function from the standard library.
+        The PNA sends the real and imaginary parts of each point in turn,
+        in the transfer format fmt (see Trace Format).
         """
         yield dev.write("CALC:PAR:SEL '%s'" % _parName(meas))
-        yield dev.write("CALC:DATA? SDATA")
-        # as of pyvisa 1.6 reading a set number of bytes no longer seems to work
-        # we still put in a number here because we want to use read_raw to avoid attempted conversion of non-ascii chars
-        data = yield dev.read(99999)
-        
-        # parse header for length of data
-        headerLen = long(data[1])        
-        dataLen = long(data[2:2+headerLen])
-        # parse data
-        dataStr = data[2+headerLen:]
-        nPoints = dataLen / 16
-        
-        _parse = lambda s: complex(*unpack('>dd', s))
-        data = [_parse(dataStr[16*n:16*(n+1)]) for n in range(nPoints)]
-        
-        returnValue(data)
+        values = yield dev.queryTrace("CALC:DATA? SDATA", fmt)
+        returnValue((values[0::2] + 1j*values[1::2]).tolist())
         
     @inlineCallbacks
-    def getFormattedData(self, dev, meas):
-        """Get binary sweep data from the PNA and parse it.
-
-        The data has the following format:
+    def getFormattedData(self, dev, meas, fmt):
+        """Get the phase (FDATA) of one measurement.
 
-            1 byte:  '#' (ignored)
-            1 byte:  h = header length
-            h bytes: d = data length
-            d bytes: binary sweep data, as pairs of 64-bit numbers
-            1 byte:  <newline> (ignored)
-
-        The 64-bit numbers are unpacked using the struct.unpack
-        function from the standard library.
+        FDATA has one value per point. Each point is returned as a list of
+        one value, the shape freq_sweep_phase has always returned.
         """
         yield dev.write("CALC:PAR:SEL '%s'" % _parName(meas))
         yield dev.write("CALC:FORM PHAS")
-        yield dev.write("CALC:DATA? FDATA")
-        yield dev.read(bytes=1L) # throw away first byte
-        
-        headerLen = long((yield dev.read(bytes=1L)))
-        dataLen = long((yield dev.read(bytes=headerLen)))
-
-        # read data in chunks
-        dataStr = ''
-        while len(dataStr) < dataLen:
-            chunk = min(10000, dataLen - len(dataStr))
-            dataStr += yield dev.read(bytes=long(chunk))
-            
-        yield dev.read(bytes=1L) # read last byte and discard
-
-        nPoints = dataLen / 8
-        
-        _parse = lambda s: unpack('>d', s)
-        data = [_parse(dataStr[8*n:8*(n+1)]) for n in range(nPoints)]
-        
-        returnValue(data)
+        values = yield dev.queryTrace("CALC:DATA? FDATA", fmt)
+        returnValue(values.reshape(-1, 1).tolist())
 
 
 __server__ = AgilentPNAServer()
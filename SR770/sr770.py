@@ -42,7 +42,6 @@ from labrad.units import Value, Unit
 
 Hz,MHz,V,nV = [Unit(s) for s in ['Hz', 'MHz', 'V', 'nV']]
 
-from struct import unpack
 import numpy as np
 import time
 
@@ -118,6 +117,32 @@ class SR770Wrapper(GPIBDeviceWrapper):
         self.SETTLING_TIME = Value(30,'s')
         self.AVERAGING_TIME = Value(10,'s')
         
+    @inlineCallbacks
+    def batch(self, ops):
+        """Run (kind, data) operations in one request to the GPIB bus.
+
+        See the GPIB Bus server's batch setting. Returns the list of replies.
+        """
+        p = self._packet()
+        p.batch(ops)
+        resp = yield p.send()
+        returnValue(resp.batch)
+
+    @inlineCallbacks
+    def setAndQuery(self, cmd, query):
+        """Write cmd if it is not None and return the response to query."""
+        ops = [('query', query)]
+        if cmd is not None:
+            ops.insert(0, ('write', cmd))
+        replies = yield self.batch(ops)
+        returnValue(replies[-1])
+
+    @inlineCallbacks
+    def queryBinary(self, cmd):
+        """Query binary data, without stripping whitespace bytes from it."""
+        replies = yield self.batch([('write', cmd), ('read raw', '')])
+        returnValue(replies[-1])
+
     #DEVICE SETUP AND OPERATION
     @inlineCallbacks
     def input_range(self,range):
@@ -128,9 +153,11 @@ class SR770Wrapper(GPIBDeviceWrapper):
                     raise Exception('Input range must be an even number in [-60,34]')
             else:
                 raise Exception('Input range must be an integer')
-            yield self.write('IRNG%d\n' %range)
-        #Readback input range
-        resp = yield self.query('IRNG?\n')
+            cmd = 'IRNG%d\n' %range
+        else:
+            cmd = None
+        #Set and readback input range
+        resp = yield self.setAndQuery(cmd, 'IRNG?\n')
         resp = int(resp)
         returnValue(resp)
         
@@ -146,8 +173,10 @@ class SR770Wrapper(GPIBDeviceWrapper):
                 coupling = inverseDict(COUPLINGS)[coupling.upper()]
             else:
                 raise Exception('Coupling not recognized')
-            yield self.write('ICPL%d\n' %coupling)
-        resp = yield self.query('ICPL?\n')
+            cmd = 'ICPL%d\n' %coupling
+        else:
+            cmd = None
+        resp = yield self.setAndQuery(cmd, 'ICPL?\n')
         returnValue(COUPLINGS[int(resp)])
 
     @inlineCallbacks
@@ -159,8 +188,10 @@ class SR770Wrapper(GPIBDeviceWrapper):
                 if grounding.upper() not in GROUNDINGS.values():
                     raise Exception('Grounding specified as string must be %s or %s' %tuple([u for u in GROUNDINGS.values()]))
                 grounding = inverseDict(GROUNDINGS)[grounding.upper()]
-            yield self.write('IGND%d\n' %grounding)
-        resp = yield self.query('IGND?\n')
+            cmd = 'IGND%d\n' %grounding
+        else:
+            cmd = None
+        resp = yield self.setAndQuery(cmd, 'IGND?\n')
         returnValue(GROUNDINGS[int(resp)])
         
     @inlineCallbacks
@@ -170,8 +201,7 @@ class SR770Wrapper(GPIBDeviceWrapper):
     #Averaging
     @inlineCallbacks
     def overlapPercentage(self,ov):
-        yield self.write('OVLP%f\n' %ov)
-        resp = yield self.query('OVLP?\n')
+        resp = yield self.setAndQuery('OVLP%f\n' %ov, 'OVLP?\n')
         returnValue(resp)
         
     #Status checks and wait functions
@@ -380,9 +410,11 @@ class SR770Server(GPIBManagedServer):
                 avg = units[avg.upper()]
             else:
                 raise Exception('avg type not recognized')
-            yield dev.write('AVGO%d\n' %avg)
-        #Readback averaging
-        resp = yield dev.query('AVGO?\n')
+            cmd = 'AVGO%d\n' %avg
+        else:
+            cmd = None
+        #Set and readback averaging
+        resp = yield dev.setAndQuery(cmd, 'AVGO?\n')
         avg = bool(int(resp))
         returnValue(avg)
 
@@ -396,8 +428,10 @@ class SR770Server(GPIBManagedServer):
                     raise Exception('Average number out of range. Must be >2 and <32767')
             else:
                 raise Exception('Number of averages must be an integer')
-            yield dev.write('NAVG %d \n' %av)
-        resp = yield dev.query('NAVG?\n')
+            cmd = 'NAVG %d \n' %av
+        else:
+            cmd = None
+        resp = yield dev.setAndQuery(cmd, 'NAVG?\n')
         av = int(resp)
         returnValue(av)
     
@@ -573,7 +607,7 @@ class SR770Server(GPIBManagedServer):
         """Get the trace."""
         dev = self.selectedDevice(c)
         #Read from device
-        bytes = yield dev.query('SPEB?%d\n' %trace)
+        bytes = yield dev.queryBinary('SPEB?%d\n' %trace)
         #Unpack binary data
         numeric = unpackBinary(bytes)
         returnValue(numeric)
@@ -605,7 +639,7 @@ class SR770Server(GPIBManagedServer):
         yield dev.start()
         yield dev.waitForAveraging()
         #Read from device
-        bytes = yield dev.query('SPEB?%d\n' %trace)
+        bytes = yield dev.queryBinary('SPEB?%d\n' %trace)
         #Convert to power spectral density
         numeric = unpackBinary(bytes)                               #Data at this point matches screen with...
         dbVoltsPkPerBin = scaleLogData(numeric, inputRange)         #SPECTRUM with UNITS= dbV Pk
@@ -658,11 +692,14 @@ def scaleLogData(data, inputLevel):
     return corrected
 
 def unpackBinary(data):
-    print 'unpackBinary in server, data length',len(data)
-    if len(data)==800:
-        return np.array(unpack('h'*400,data))
-    elif len(data)==799:
-        return np.array(unpack('h'*399,data[0:798]))
+    """Unpack SPEB? data, NUM_POINTS little endian 16 bit integers.
+
+    Anything after the last point, such as a terminator, is ignored.
+    """
+    if len(data) < 2*NUM_POINTS:
+        raise Exception('Expected %d bytes of spectrum data, got %d'
+                        %(2*NUM_POINTS, len(data)))
+    return np.frombuffer(data[:2*NUM_POINTS], dtype='<i2').astype(int)
 
 def inverseDict(d):
     outDict = dict([(value,key) for key,value in d.items()])
@@ -19,7 +19,7 @@
 ### BEGIN NODE INFO
 [info]
 name = Signal Analyzer SR780
-version = 2.0
+version = 2.1
 description = Talks to the Stanford Research Systems Signal Analyzer
 
 [startup]
@@ -37,7 +37,6 @@ from labrad.server import setting
 from labrad.gpib import GPIBManagedServer, GPIBDeviceWrapper
 from twisted.internet.defer import inlineCallbacks, returnValue
 
-from struct import unpack
 import numpy as np
 
 COUPLINGS = {0: 'DC',
@@ -58,6 +57,9 @@ WINDOWS = {
             'T4T4':10
             }
               
+# transfer formats for display data: DSPY? (ASCII) or DSPB? (binary)
+TRACE_FORMATS = ['ASCII', 'REAL,32']
+
 SPANS = {0:0.191,
               1:0.382,
               2:0.763,
@@ -95,6 +97,41 @@ class SR780Wrapper(GPIBDeviceWrapper):
         p.term_chars('\n')
         yield p.send()
 
+    @inlineCallbacks
+    def getDisplayData(self, disp, fmt):
+        """Get the data of a display as a numpy array.
+
+        In REAL,32 format the SR780 sends 4 byte little-endian floats with no
+        header, which are read raw so that no bytes are stripped.
+        """
+        length = int((yield self.query("DSPN? %d" % disp)))
+        if fmt == 'ASCII':
+            resp = yield self.query("DSPY? %d" % disp)
+            data = np.fromstring(resp.strip().rstrip(','), sep=',')
+        else:
+            raw = yield self.queryBinary("DSPB? %d" % disp)
+            if len(raw) < length*4:
+                raise Exception("Expected %d bytes of display data, got %d" % (length*4, len(raw)))
+            data = np.frombuffer(raw[:length*4], dtype='<f4').astype(float)
+        returnValue(data[:length])
+
+    @inlineCallbacks
+    def batch(self, ops):
+        """Run (kind, data) operations in one request to the GPIB bus.
+
+        See the GPIB Bus server's batch setting. Returns the list of replies.
+        """
+        p = self._packet()
+        p.batch(ops)
+        resp = yield p.send()
+        returnValue(resp.batch)
+
+    @inlineCallbacks
+    def queryBinary(self, cmd):
+        """Query binary data, without stripping whitespace bytes from it."""
+        replies = yield self.batch([('write', cmd), ('read raw', '')])
+        returnValue(replies[-1])
+
     @inlineCallbacks
     def clearStatusBytes(self):
         yield self.write("*CLS")
@@ -203,6 +240,9 @@ class SR780Server(GPIBManagedServer):
     deviceWrapper = SR780Wrapper
     deviceIdentFunc = 'identify_device'
 
+    def initContext(self, c):
+        c['traceFormat'] = 'REAL,32'
+
     @setting(1000, server='s', address='s')
     def identify_device(self, c, server, address):
         print 'identifying:', server, address
@@ -336,6 +376,17 @@ class SR780Server(GPIBManagedServer):
         ov = yield self.selectedDevice(c).overlapPercentage(ov)
         returnValue(ov)
     
+    @setting(20, fmt=['s'], returns=['s'])
+    def trace_format(self, c, fmt=None):
+        ''' Gets/sets the display data transfer format for this context,
+        'ASCII' or 'REAL,32' (the default). '''
+        if fmt is not None:
+            fmt = fmt.upper()
+            if fmt not in TRACE_FORMATS:
+                raise Exception('allowed formats are: %s' % TRACE_FORMATS)
+            c['traceFormat'] = fmt
+        return c['traceFormat']
+
     @setting(30, disp='w{display}', ms=['w', 's'], returns=['ws'])
     def measure(self, c, disp=0, ms=None):
         """Get or set the measurement.
@@ -519,18 +570,8 @@ class SR780Server(GPIBManagedServer):
         """Initiate a frequency sweep."""
         dev = self.selectedDevice(c)
 
-        length = yield dev.query("DSPN? 0")
-        length = int(length)
-        print length
-        data = yield dev.query("DSPB? 0")
-        print len(data)
-
-        if len(data) != length*4:
-            raise Exception("Lengths don't match, dude! %d isn't equal to %d" % (len(data), length*4))
-
-        print "unpacking..."
-
-        data = [unpack('<f', data[i*4:i*4+4])[0] for i in range(length)]
+        data = yield dev.getDisplayData(0, c['traceFormat'])
+        length = len(data)
         #Calculate frequencies from current span
         resp = yield dev.query('FSTR?0')
         fs = T.Value(float(resp), 'Hz')
@@ -551,19 +592,8 @@ class SR780Server(GPIBManagedServer):
         """
         dev = self.selectedDevice(c)
 
-        length = yield dev.query("DSPN? 0")
-        length = int(length)
-        print length
-        data = yield dev.query("DSPB? 0")
-        print len(data)
-
-        if len(data) != length*4:
-            raise Exception("Lengths don't match, dude! %d isn't equal to %d" % (len(data), length*4))
-
-        print "unpacking..."
-
-        data = [unpack('<f', data[i*4:i*4+4])[0] for i in range(length)]
-        data = np.array(data)
+        data = yield dev.getDisplayData(0, c['traceFormat'])
+        length = len(data)
         #Calculate frequencies from current span
         resp = yield dev.query('FSTR?0')
         fs = T.Value(float(resp), 'Hz')
@@ -17,7 +17,7 @@
 ### BEGIN NODE INFO
 [info]
 name = SR830
-version = 2.7
+version = 2.8
 description = 
 
 [startup]
@@ -31,9 +31,27 @@ timeout = 20
 """
 
 from labrad import types as T, gpib, units
-from labrad.server import setting
-from labrad.gpib import GPIBManagedServer
+from labrad.server import setting, Signal
+from labrad.gpib import GPIBManagedServer, GPIBDeviceWrapper
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import LoopingCall
+
+import time
+import numpy as np
+
+# data buffer sample rates for SRAT 0 to 13, in Hz
+SAMPLE_RATES = [0.0625 * 2**i for i in range(14)]
+# the data buffer holds this many points per channel, and stops when full
+BUFFER_POINTS = 16383
+# streaming restarts the data buffer once this many points are read
+BUFFER_RESTART = BUFFER_POINTS // 2
+# rows of (time, channel 1, channel 2) kept by the server while streaming
+STREAM_ROWS = 100000
+# DDEF commands for the values streamed on channels 1 and 2
+STREAM_DISPLAYS = {
+    'XY': 'DDEF 1,0,0;DDEF 2,0,0',
+    'RT': 'DDEF 1,1,0;DDEF 2,1,0',
+}
 
 def getTC(i):
     ''' converts from the integer label used by the SR830 to a time '''
@@ -59,9 +77,104 @@ def getSensitivity(i):
     else:
         return 10 * 10**(-9 + i/3)
 
+class RingBuffer(object):
+    """Fixed number of rows, overwriting the oldest when full.
+
+    Rows are numbered from 0 in the order they were added, so a reader can
+    ask for all rows after the last one it saw.
+    """
+    def __init__(self, size, width):
+        self.data = np.zeros((size, width))
+        self.count = 0
+
+    def extend(self, rows):
+        size = len(self.data)
+        self.count += len(rows)
+        rows = rows[-size:]
+        self.data[(self.count - len(rows) + np.arange(len(rows))) % size] = rows
+
+    def since(self, count):
+        """Rows added after row count, as far as they are still held."""
+        start = max(count, self.count - len(self.data), 0)
+        return self.data[np.arange(start, self.count) % len(self.data)]
+
+
+class SR830Wrapper(GPIBDeviceWrapper):
+    def initialize(self):
+        # LoopingCall reading the data buffer while streaming, or None
+        self.streamLoop = None
+        self.ring = RingBuffer(STREAM_ROWS, 3)
+        # values streamed on channels 1 and 2, a key of STREAM_DISPLAYS
+        self.streamDisplay = 'XY'
+        # Data Vault context the stream is saved in, or None, and the
+        # (path, name) of its dataset
+        self.streamDataVault = None
+        self.streamDataset = None
+
+    @inlineCallbacks
+    def batch(self, ops):
+        """Run (kind, data) operations in one request to the GPIB bus.
+
+        See the GPIB Bus server's batch setting. Returns the list of replies.
+        """
+        p = self._packet()
+        p.batch(ops)
+        resp = yield p.send()
+        returnValue(resp.batch)
+
+    @inlineCallbacks
+    def startBuffer(self, rate, display):
+        """Start filling the data buffer in one shot mode."""
+        yield self.write('%s;SRAT %d;SEND 0;REST;STRT' % (STREAM_DISPLAYS[display],
+                                                        SAMPLE_RATES.index(rate)))
+        self.streamRate = rate
+        self.streamDisplay = display
+        self.streamStart = time.time()
+        self.streamIndex = 0
+
+    @inlineCallbacks
+    def readBuffer(self):
+        """Read the points stored since the last read as rows of
+        (time, channel 1, channel 2).
+
+        Restarts the buffer once it is half full, since it stops when full.
+        The buffer is paused while the last points are read, so the stream
+        has a short gap there.
+        """
+        restart = self.streamIndex >= BUFFER_RESTART
+        if restart:
+            yield self.write('PAUS')
+        stored = int((yield self.query('SPTS?')))
+        start, n = self.streamIndex, stored - self.streamIndex
+        rows = np.zeros((0, 3))
+        if n > 0:
+            # TRCB? sends 4 byte little-endian floats with no header
+            ops = []
+            for channel in (1, 2):
+                ops.append(('write', 'TRCB? %d,%d,%d' % (channel, start, n)))
+                ops.append(('read raw', ''))
+            replies = yield self.batch(ops)
+            rows = np.empty((n, 3))
+            rows[:, 0] = self.streamStart + (start + np.arange(n)) / self.streamRate
+            rows[:, 1] = np.frombuffer(replies[1][:4*n], '<f4')
+            rows[:, 2] = np.frombuffer(replies[3][:4*n], '<f4')
+            self.streamIndex = stored
+        if restart:
+            yield self.write('REST;STRT')
+            self.streamStart = time.time()
+            self.streamIndex = 0
+        returnValue(rows)
+
+
 class SR830(GPIBManagedServer):
     name = 'SR830'
     deviceName = 'Stanford_Research_Systems SR830'
+    deviceWrapper = SR830Wrapper
+
+    # seconds between reads of the data buffer while streaming
+    streamInterval = 0.25
+
+    onStreamData = Signal(830001, 'signal: stream data', '(s*2v)')
 
     @inlineCallbacks
     def inputMode(self, c):
@@ -308,6 +421,105 @@ class SR830(GPIBManagedServer):
             returnValue(9*tc)
         else:# slope == 3:
             returnValue(10*tc)
+
+    @setting(50, 'Stream Start', rate='v[Hz]', display='s', returns='v[Hz]')
+    def stream_start(self, c, rate, display='XY'):
+        """Start streaming from the data buffer.
+
+        The buffer samples at the highest rate from 62.5 mHz to 512 Hz that
+        is not above rate, and records X and Y ('XY') or R and theta ('RT').
+        The server reads the buffer in binary every streamInterval and sends
+        new rows of (time, channel 1, channel 2) with the stream data signal,
+        keeps the last rows for Stream Read, and adds them to the Data Vault
+        dataset set by Stream Data Vault, if any. Returns the sample rate.
+        """
+        dev = self.selectedDevice(c)
+        display = display.upper()
+        if display not in STREAM_DISPLAYS:
+            raise Exception('display must be one of %s' % sorted(STREAM_DISPLAYS))
+        rates = [r for r in SAMPLE_RATES if r <= rate['Hz']]
+        if not rates:
+            raise Exception('Lowest sample rate is %g Hz' % SAMPLE_RATES[0])
+        yield self.stream_stop(c)
+        newDisplay = display != dev.streamDisplay
+        yield dev.startBuffer(rates[-1], display)
+        if newDisplay and dev.streamDataset is not None:
+            # the saved columns change, so they need a dataset of their own
+            yield self.newStreamDataset(c, dev)
+        dev.streamLoop = LoopingCall(self.readStream, dev)
+        d = dev.streamLoop.start(self.streamInterval, now=False)
+        d.addErrback(self.streamFailed, dev)
+        returnValue(rates[-1] * units.Hz)
+
+    @setting(51, 'Stream Stop')
+    def stream_stop(self, c):
+        """Stop streaming from the data buffer."""
+        dev = self.selectedDevice(c)
+        if dev.streamLoop is not None and dev.streamLoop.running:
+            dev.streamLoop.stop()
+            yield dev.write('PAUS')
+        dev.streamLoop = None
+
+    @setting(52, 'Stream Read', returns='*2v')
+    def stream_read(self, c):
+        """Get the rows of (time, channel 1, channel 2) streamed since the
+        last Stream Read in this context.
+
+        Time is in seconds since the epoch. Rows older than the last
+        100000 are dropped if this is not called often enough.
+        """
+        dev = self.selectedDevice(c)
+        key = ('streamRead', dev.name)
+        rows = dev.ring.since(c.get(key, 0))
+        c[key] = dev.ring.count
+        return rows
+
+    @setting(53, 'Stream Data Vault', path='*s', name='s', returns='')
+    def stream_data_vault(self, c, path=None, name='SR830 stream'):
+        """Save streamed data in a new Data Vault dataset in the given
+        directory, created if needed. Without a path, stop saving.
+
+        If Stream Start changes the display, a new dataset is made.
+        """
+        dev = self.selectedDevice(c)
+        dev.streamDataVault = None
+        dev.streamDataset = None
+        if path is None:
+            return
+        dev.streamDataset = (path, name)
+        yield self.newStreamDataset(c, dev)
+
+    @inlineCallbacks
+    def newStreamDataset(self, c, dev):
+        """Make a dataset for the stream with units for its display.
+
+        In 'RT' mode channel 2 is theta, which is in degrees.
+        """
+        dev.streamDataVault = None
+        path, name = dev.streamDataset
+        unit = str((yield self.outputUnit(c)))
+        unit2 = 'deg' if dev.streamDisplay == 'RT' else unit
+        ctx = self.client.context()
+        p = self.client.data_vault.packet(context=ctx)
+        p.cd(path, True)
+        p.new(name, ['time [s]'], [('Channel 1', '', unit), ('Channel 2', '', unit2)])
+        yield p.send()
+        dev.streamDataVault = ctx
+
+    @inlineCallbacks
+    def readStream(self, dev):
+        rows = yield dev.readBuffer()
+        if not len(rows):
+            return
+        dev.ring.extend(rows)
+        self.onStreamData((dev.name, rows))
+        if dev.streamDataVault is not None:
+            yield self.client.data_vault.add(rows, context=dev.streamDataVault)
+
+    def streamFailed(self, failure, dev):
+        print 'Streaming from %s failed:' % dev.name
+        failure.printTraceback()
+        dev.streamLoop = None
     
 
 __server__ = SR830()
@@ -17,7 +17,7 @@
 ### BEGIN NODE INFO
 [info]
 name = Agilent Infiniium Oscilloscope
-version = 0.2
+version = 0.3
 description = Talks to the Agilent DSO91304A 13GHz oscilloscope
 
 [startup]
@@ -37,7 +37,6 @@ from labrad.server import setting
 from labrad.gpib import GPIBManagedServer, GPIBDeviceWrapper
 from twisted.internet.defer import inlineCallbacks, returnValue
 import labrad.units as U
-from struct import unpack, calcsize
 
 import numpy, re
 
@@ -47,9 +46,50 @@ VERT_DIVISIONS = 8.0
 HORZ_DIVISIONS = 10.0
 SCALES = []
 
+class InfiniiumWrapper(GPIBDeviceWrapper):
+    def initialize(self):
+        # parsed waveform preambles by channel, kept until a setting changes
+        self.preambles = {}
+
+    def write(self, data, *args, **kw):
+        # the preamble holds the channel scale and offset and the timebase,
+        # so any command other than a waveform transfer one may change it
+        if not data.lstrip(':').upper().startswith('WAV'):
+            self.preambles.clear()
+        return GPIBDeviceWrapper.write(self, data, *args, **kw)
+
+    @inlineCallbacks
+    def getWaveforms(self, channels):
+        """Read the waveforms of several channels in one request to the bus.
+
+        Preambles are only queried for channels that have none cached.
+        Returns a list of (preamble, raw data) pairs, one per channel.
+        """
+        ops = []
+        if not self.preambles:
+            ops.append(('write', 'WAV:BYT MSBF;:WAV:FORM WORD'))
+        preambleOps = {}
+        dataOps = []
+        for channel in channels:
+            ops.append(('write', 'WAV:SOUR CHAN%d' %channel))
+            if channel not in self.preambles:
+                preambleOps[channel] = len(ops)
+                ops.append(('query', 'WAV:PRE?'))
+            dataOps.append(len(ops))
+            ops.append(('query block', 'WAV:DATA?'))
+        p = self._packet()
+        p.batch(ops)
+        resp = yield p.send()
+        replies = resp.batch
+        for channel, i in preambleOps.items():
+            self.preambles[channel] = _parsePreamble(replies[i])
+        returnValue([(self.preambles[channel], numpy.frombuffer(replies[i], '>i2'))
+                     for channel, i in zip(channels, dataOps)])
+
 class AgilentDSO91304AServer(GPIBManagedServer):
     name = 'Agilent Infiniium Oscilloscope'
     deviceName = ['Agilent Technologies DSO91304A', 'KEYSIGHT TECHNOLOGIES DSO90804A']
+    deviceWrapper = InfiniiumWrapper
         
     @setting(11, returns=[])
     def reset(self, c):
@@ -340,6 +380,23 @@ class AgilentDSO91304AServer(GPIBManagedServer):
             resp = yield dev.query('TIM:SCAL?')
         scale = float(resp)
         returnValue(scale)
+
+    @setting(153, segments = 'w', returns = ['w'])
+    def segments(self, c, segments = None):
+        """Get or set the number of segments per acquisition, 0 for normal
+        (not segmented) acquisition.
+        """
+        dev = self.selectedDevice(c)
+        if segments is not None:
+            if segments:
+                yield dev.write('ACQ:MODE SEGM;:ACQ:SEGM:COUN %d;:WAV:SEGM:ALL ON' %segments)
+            else:
+                yield dev.write('ACQ:MODE RTIM;:WAV:SEGM:ALL OFF')
+        mode = yield dev.query('ACQ:MODE?')
+        if mode.strip().upper().startswith('SEGM'):
+            resp = yield dev.query('ACQ:SEGM:COUN?')
+            returnValue(int(resp))
+        returnValue(0)
     
     #Data acquisition settings
     @setting(201, channel = 'i', start = 'i', stop = 'i', returns='*v[ns] {time axis} *v[mV] {scope trace}')
@@ -365,13 +422,14 @@ class AgilentDSO91304AServer(GPIBManagedServer):
         #Starting and stopping point
         #Transfer waveform preamble
         preamble = yield dev.query('WAV:PRE?')
-        #Transfer waveform data
-        binary = yield dev.query('WAV:DATA?')
+        #Transfer waveform data as a binary block, decoded by the GPIB bus
+        p = dev._packet()
+        p.query_array('WAV:DATA?', '>i%d' %wordLength)
+        resp = yield p.send()
         #Parse waveform preamble
         preambleDict = _parsePreamble(preamble)
         print preambleDict
-        #Parse binary
-        trace = _parseBinaryData(binary, wordLength = wordLength) * 1.0e3
+        trace = resp.query_array * 1.0e3
         #Convert from binary to volts
         traceVolts = ((trace*float(preambleDict['yStep'])+float(preambleDict['yOrigin'])))
         numPoints = int(preambleDict['numPoints'])
@@ -381,6 +439,29 @@ class AgilentDSO91304AServer(GPIBManagedServer):
 
         returnValue((time*U.ns*1e9, traceVolts*U.V))
 
+    @setting(202, channels = '*i', returns='*v[ns] {time axis} *2v[V] {scope traces}')
+    def get_traces(self, c, channels):
+        """Get the traces of several channels from the current acquisition.
+
+        All channels are read in one request to the GPIB bus, and waveform
+        preambles are reused until a setting is changed through this server.
+        Returns one row per channel, or with segmented acquisition one row
+        per segment, ordered by channel and then by segment.
+        """
+        if not channels:
+            raise Exception('No channels given')
+        dev = self.selectedDevice(c)
+        waveforms = yield dev.getWaveforms(channels)
+        rows = []
+        for preamble, data in waveforms:
+            numPoints = int(preamble['numPoints'])
+            volts = data*float(preamble['yStep']) + float(preamble['yOrigin'])
+            rows.append(volts.reshape(-1, numPoints))
+        preamble = waveforms[0][0]
+        numPoints = int(preamble['numPoints'])
+        time = float(preamble['xFirst']) + numpy.arange(numPoints)*float(preamble['xStep'])
+        returnValue((time*U.ns*1e9, numpy.vstack(rows)*U.V))
+
 def _parsePreamble(preamble):
     preambleVals = preamble.split(',')
     '''
@@ -448,30 +529,6 @@ def _parsePreamble(preamble):
     preambleDict['yUnit'] = unitType(preambleDict['yUnits'])
     return (preambleDict)
 
-def _parseBinaryData(data, wordLength):
-    """Parse binary data packed as string of RIBinary
-    """
-    formatChars = {'1':'b','2':'h', '4':'f'}
-    formatChar = formatChars[str(wordLength)]
-
-    #Get rid of header crap
-    #unpack binary data
-    if wordLength == 1:
-        lenHeader = int(data[1])
-        dat = data[(2+lenHeader):]
-        dat = numpy.array(unpack(formatChar*(len(dat)/wordLength),dat))
-    elif wordLength == 2:
-        lenHeader = int(data[1])
-        dat = data[(2+lenHeader):]
-        dat = dat[-calcsize('>' + formatChar*(len(dat)/wordLength)):]
-        dat = numpy.array(unpack('>' + formatChar*(len(dat)/wordLength),dat))
-    elif wordLength == 4:
-        lenHeader = int(data[1])
-        dat = data[(2+lenHeader):]
-        dat = dat[-calcsize('>' + formatChar*(len(dat)/wordLength)):]
-        dat = numpy.array(unpack('>' + formatChar*(len(dat)/wordLength),dat))      
-    return dat
-
 __server__ = AgilentDSO91304AServer()
 
 if __name__ == '__main__':
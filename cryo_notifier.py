@@ -18,7 +18,7 @@
 ### BEGIN NODE INFO
 [info]
 name = Cryo Notifier
-version = 2.2
+version = 2.4
 description = Send reminders to fill cryos
 
 [startup]
@@ -34,13 +34,34 @@ timeout = 5
 from labrad        import util, types as T
 from labrad.server import LabradServer, setting
 from labrad.units  import Unit, mV, ns, deg, MHz, V, GHz, rad, s
-import datetime, time
+import datetime, re, time
+from email.mime.text import MIMEText
 from twisted.python import log
 from twisted.internet import defer, reactor
 from twisted.internet.task import LoopingCall
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.mail.smtp import sendmail
 
+# send alerts to a local SMTP server instead of the Telecomm Server, e.g.
+# python -m smtpd -n -c DebuggingServer localhost:1025
 DEBUG = False
+DEBUG_SMTP = ('localhost', 1025)
+
+# message IDs for registry changes and DR Logger points
+REGISTRY_MESSAGE = 318101
+NEW_POINT_MESSAGE = 318102
+# seconds between checks of the timers, which need no LabRAD requests
+TIMER_CHECK_INTERVAL = 10.0
+# registry keys read by loadRegistryInfo
+CONFIG_KEYS = ['temperatures', 'timers', 'timers_enabled', 'notify_users',
+               'notify_email', 'sleepyTime']
+# DR Logger labels, e.g. 'Mix1 (Ruox) [K]'
+LABEL_RE = re.compile(r'^(.*) \((.*)\) \[(.*)\]$')
+# seconds alerts are collected before they are sent as one digest
+ALERT_DELAY = 30.0
+# most messages sent to one recipient in ALERT_WINDOW seconds
+ALERT_LIMIT = 4
+ALERT_WINDOW = 3600.0
 
 def td_to_seconds(td):
     '''
@@ -58,6 +79,10 @@ Registry keys:
     name1_reset = timestamp
     notify_users = ["user1, "user2"]
     timers_enabled = True
+
+The registry directory is watched for changes, and temperatures come from
+the DR Logger's 'new point' signal, so nothing is polled. Temperature
+bounds are named <DR name>:<thermometer>, e.g. Vince:Mix1.
 '''
 @inlineCallbacks
 def start_server(cxn, node_name, server_name):
@@ -74,6 +99,122 @@ def start_server(cxn, node_name, server_name):
         returnValue(True)
     raise RuntimeError("Unable to start server %s" % server_name)
 
+class TelecommTransport(object):
+    """Sends alerts through the Telecomm Server."""
+    def __init__(self, client):
+        self.client = client
+
+    def send(self, kind, recipient, subject, msg):
+        p = self.client.telecomm_server.packet()
+        if kind == 'email':
+            p.send_mail(recipient, subject, msg)
+        else:
+            p.send_sms(subject, msg, recipient)
+        return p.send()
+
+class SMTPTransport(object):
+    """Sends alerts as email straight to an SMTP server.
+
+    Meant for a local stand-in server when testing, so SMS recipients,
+    which are LabRAD user names, are sent email at the server's host.
+    """
+    def __init__(self, host='localhost', port=25, sender='labrad@localhost'):
+        self.host = host
+        self.port = port
+        self.sender = sender
+
+    def send(self, kind, recipient, subject, msg):
+        if '@' not in recipient:
+            recipient = '%s@%s' % (recipient, self.host)
+        mail = MIMEText(msg)
+        mail['Subject'] = subject
+        mail['From'] = self.sender
+        mail['To'] = recipient
+        return sendmail(self.host, self.sender, [recipient], mail.as_string(),
+                        port=self.port)
+
+class AlertQueue(object):
+    """Collects alerts and sends them to each recipient as digests.
+
+    Alerts are queued per (kind, recipient), where kind is 'email' or 'sms',
+    and an alert already waiting for a recipient is not queued again. The
+    queue is flushed ALERT_DELAY seconds after the first alert arrives, so
+    alerts raised together, as in a warm-up, go out in one message. A
+    recipient gets at most limit messages in any window seconds; alerts
+    for a recipient over the limit wait for the next flush they are
+    allowed in. Messages are sent with transport.send(kind, recipient,
+    subject, msg), which may return a Deferred.
+    """
+    subject = 'Cryo Alert'
+
+    def __init__(self, transport, delay=ALERT_DELAY, limit=ALERT_LIMIT,
+                 window=ALERT_WINDOW, clock=reactor):
+        self.transport = transport
+        self.delay = delay
+        self.limit = limit
+        self.window = window
+        self.clock = clock
+        self.pending = {} # (kind, recipient) -> alerts, in order
+        self.sent = {} # (kind, recipient) -> times of recent messages
+        self.call = None
+
+    def add(self, kind, recipients, alerts):
+        for recipient in recipients:
+            queued = self.pending.setdefault((kind, recipient), [])
+            queued.extend(a for a in alerts if a not in queued)
+        if self.pending:
+            self._schedule(self.delay)
+
+    def _schedule(self, delay):
+        """Flush in delay seconds, or sooner if a flush is already due."""
+        if self.call is None or not self.call.active():
+            self.call = self.clock.callLater(delay, self.flush)
+        elif self.call.getTime() > self.clock.seconds() + delay:
+            self.call.reset(delay)
+
+    def _recent(self, key, now):
+        """Times of messages to key still within the rate limit window."""
+        times = [t for t in self.sent.get(key, []) if t > now - self.window]
+        self.sent[key] = times
+        return times
+
+    def flush(self):
+        """Send the queued alerts that the rate limits allow.
+
+        Returns a Deferred that fires when they have been sent.
+        """
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+        now = self.clock.seconds()
+        ds = []
+        for key in sorted(self.pending):
+            times = self._recent(key, now)
+            if len(times) >= self.limit:
+                continue
+            times.append(now)
+            ds.append(self._send(key, self.pending.pop(key)))
+        if self.pending:
+            # try again when the oldest message leaves the window
+            retry = min(self.sent[key][0] for key in self.pending) + self.window
+            self._schedule(max(retry - now, self.delay))
+        return defer.DeferredList(ds)
+
+    def _send(self, (kind, recipient), alerts):
+        msg = "%s need attention." % ', '.join(alerts)
+        d = defer.maybeDeferred(self.transport.send, kind, recipient,
+                                self.subject, msg)
+        def failed(failure):
+            print "Sending %s to %s failed: %s" % (kind, recipient,
+                                                   failure.getErrorMessage())
+        d.addErrback(failed)
+        return d
+
+    def stop(self):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
 class CryoNotifier(LabradServer):
     """Mass email when someone forgets to fill cryos
     
@@ -86,6 +227,8 @@ class CryoNotifier(LabradServer):
     happens to be.
     """
     name = 'Cryo Notifier'
+    # ID of the DR Logger we listen to for new points
+    drLoggerID = None
     
     def temperatureCheckFunc(self, channel, temp):
         try:
@@ -144,19 +287,23 @@ class CryoNotifier(LabradServer):
     @inlineCallbacks
     def initServer(self):
         self.sent_notifications = set()
-        self.cold = False
+        if DEBUG:
+            transport = SMTPTransport(*DEBUG_SMTP)
+        else:
+            transport = TelecommTransport(self.client)
+        self.alerts = AlertQueue(transport)
+        # assume we are cold until a diode reading says otherwise
+        self.cold = True
         self.reg = self.client.registry
-        self.ruox = self.client.lakeshore_ruox
-        self.diodes = self.client.lakeshore_diodes
         #type of parameter -> {'data'->data, 'func'->func to check if notification needed}
         self.thingsToCheck = {"timers":
-                                 {"data": None,
+                                 {"data": [],
                                   "func": lambda channel, x: x<0},
                               "temperatures":
-                                 {"data": None,
+                                 {"data": {},
                                   "func": self.temperatureCheckFunc},
                               "sleepyTimers":
-                                 {"data": None,
+                                 {"data": [],
                                   "func": self.sleepyTimerCheckFunc}
                              }
         self.path = ['', 'Servers', self.name]
@@ -167,9 +314,98 @@ class CryoNotifier(LabradServer):
             self.node = 'node_'+self.path[0]
         print self.path
         yield start_server(self.client, self.node, 'Telecomm Server')
-        self.cb = LoopingCall(self.checkForAndSendAlerts)
-        self.cb.start(interval=10.0, now=True)
-        
+        yield self.loadRegistryInfo()
+        yield self.update_timers()
+        yield self.watchRegistry()
+        yield self.watchServers()
+        self.cb = LoopingCall(self.checkTimers)
+        self.cb.start(interval=TIMER_CHECK_INTERVAL, now=True)
+
+    @inlineCallbacks
+    def watchRegistry(self):
+        """Get a message whenever a key in our registry directory changes."""
+        self.regCtx = self.client.context()
+        self._cxn.addListener(self.registryChanged, source=self.reg.ID,
+                              context=self.regCtx, ID=REGISTRY_MESSAGE)
+        p = self.reg.packet(context=self.regCtx)
+        p.cd(self.path)
+        p.notify_on_change(REGISTRY_MESSAGE, True)
+        yield p.send()
+
+    @inlineCallbacks
+    def watchServers(self):
+        """Listen for DR Logger points if it is running already.
+
+        serverConnected starts listening again whenever it (re)connects.
+        """
+        if 'DR Logger' in self.client.servers:
+            yield self.watchDRLogger()
+
+    def serverConnected(self, ID, name):
+        """Listen for DR Logger points when it (re)connects."""
+        if name == 'DR Logger':
+            d = self.client.refresh()
+            d.addCallback(lambda _: self.watchDRLogger())
+            d.addErrback(log.err)
+
+    @inlineCallbacks
+    def watchDRLogger(self):
+        dr = self.client.dr_logger
+        # the DR Logger gets a new ID when it reconnects, so replace the
+        # listener for its old one rather than adding another
+        if self.drLoggerID is not None:
+            self._cxn.removeListener(self.newPoint, source=self.drLoggerID,
+                                     ID=NEW_POINT_MESSAGE)
+        self._cxn.addListener(self.newPoint, source=dr.ID, ID=NEW_POINT_MESSAGE)
+        self.drLoggerID = dr.ID
+        yield dr.signal__new_point(NEW_POINT_MESSAGE)
+
+    def registryChanged(self, c, (name, isDir, addOrChange)):
+        """Reload just what changed in the registry, then recheck the timers."""
+        if isDir:
+            return
+        if name in CONFIG_KEYS:
+            d = self.loadRegistryInfo()
+            d.addCallback(lambda _: self.update_timers())
+        elif name.endswith('_reset') or name.endswith('_count'):
+            d = self.update_timers()
+        else:
+            return
+        d.addCallback(lambda _: self.checkTimers())
+        d.addErrback(log.err)
+
+    def newPoint(self, c, (drName, point)):
+        """Check the temperatures in a point from the DR Logger."""
+        temps = {}
+        for label, value in point:
+            m = LABEL_RE.match(label)
+            if m is None:
+                continue
+            name, legend, unit = m.groups()
+            if unit != 'K':
+                continue
+            temps['%s:%s' % (drName, name)] = value*Unit('K')
+            if legend == 'Diode' and name == '4Kout':
+                self.cold = value < 10.0
+        self.thingsToCheck['temperatures']['data'].update(temps)
+        # only thermometers with a bound are checked
+        items = [(t, v) for t, v in temps.items() if t in self.temperatureBounds]
+        self.sendAlerts(self.findAlerts('temperatures', items)).addErrback(log.err)
+
+    def checkTimers(self):
+        '''
+        Timed callback to check timers and send notifications.
+
+        Timers are kept up to date from registry change messages, so this
+        only looks at the clock.
+        '''
+        self.update_remaining_times()
+        alerts = []
+        for thingToCheck in ['timers', 'sleepyTimers']:
+            data = self.thingsToCheck[thingToCheck]['data']
+            alerts.extend(self.findAlerts(thingToCheck, data))
+        return self.sendAlerts(alerts).addErrback(log.err)
+
     @setting(5, returns='*(sv[s])') 
     def query_timers(self, c):
         '''
@@ -178,20 +414,19 @@ class CryoNotifier(LabradServer):
         disabled all timers will list zero.
         '''
         if self.enabled:
-            yield self.loadRegistryInfo()
-            yield self.update_timers()
+            self.update_remaining_times()
             rv = self.thingsToCheck["timers"]["data"]
         else:
             rv = [(t, 0) for t in self.timers]
-        returnValue(rv)
+        return rv
         
-    @setting(6, returns='*(sv[s])')
+    @setting(6, returns='*(sv[K])')
     def query_temperatures(self, c):
         '''
         Returns the list of temperatures and their current values.
         '''
-        rv = self.thingsToCheck['temperatures']['data']
-        returnValue(rv)
+        rv = sorted(self.thingsToCheck['temperatures']['data'].items())
+        return rv
     
     @setting(10, timer_name='s', message='s', returns='v[s]')
     def reset_timer(self, c, timer_name, message=''):
@@ -227,11 +462,8 @@ class CryoNotifier(LabradServer):
     
     @setting(12, returns='*(s,w)')
     def query_counters(self, c):
-        if self.enabled:
-            yield self.loadRegistryInfo()
-            yield self.update_timers()
         rv = self.counters.items()
-        returnValue(rv)
+        return rv
         
     @setting(15, username='s', returns='b')
     def validate_user(self, c, username):
@@ -282,53 +514,12 @@ class CryoNotifier(LabradServer):
         self.timerSettings = dict(ans['timers'])
         self.temperatureBounds = dict(ans['temperatures'])
     
-    @inlineCallbacks
-    def update_temperatures(self):
-        data = {}
-        #Check to see if we're still cold
-        try:
-            p = self.client.lakeshore_diodes.packet()
-            p.select_device()
-            p.temperatures()
-            ans = yield p.send()
-            # only keep the ones we're interested in
-            names = ["4Kin", "4Kout", "77K",]# "Ret", "Mix", "Xchg", "Still", "Pot"]
-            data.update(dict(zip(names, ans['tempetratures'])))
-            self.cold = ans['temperatures'][1]['K'] < 10.0
-        except Exception:
-            #Assume we are cold if we can't reach the lakeshore server
-            self.cold = True
-        p = self.ruox.packet()
-        p.select_device(key='device') #This is BAD. We should actually pick a device
-        try:
-            p.named_temperatures(key='temps')
-            resp = yield p.send()
-            data.update(dict([(x[0],x[1][0]) for x in resp['temps']]))
-        except AttributeError:
-            p.temperatures(key='temps')
-            resp = yield p.send()
-            data.update(dict(zip(['Mix1', 'Mix2', 'Still', 'Pot', 'Xchg'],
-                            [x[0] for x in resp['temps']])))
-
-        nodeName = resp['device'].split(' ')[0]
-        #Now we do something really ugly. We need to be able to handle the fact
-        #that the temperature bound data in the registry comes with cryostat
-        #names attached, eg Vince:Mix1. However the named temperatures from the
-        #ruox server come as Mix1, without the cryostat name. To handle this we
-        #figure out what _node_ the ruox server is on and add that to the name.
-        #This is really pretty bad but I can't think of a good way to fix it.
-        #The next person to service this server (heh) can take up where I left
-        #off. Upgrade the temperature checking facilities to more rationally
-        #sort the data.
-        data = dict([(nodeName+':'+k,v) for k,v in data.items()])
-        self.thingsToCheck['temperatures']['data'] = data
-    
     @inlineCallbacks
     def update_timers(self):
         """Helper function to read timers.
         
-        Sets self.currentData["temperatures"] to a dict mapping timer names ->
-        remaining time. Remaining times are Values with time units.
+        Reads the reset time and counter of each timer from the registry,
+        then updates the remaining times.
         """
         now = datetime.datetime.now()
         p = self.reg.packet()
@@ -344,70 +535,69 @@ class CryoNotifier(LabradServer):
                 (self.timerSettings[timer_name].inUnitsOf('s'),
                  ans[timer_name])
             self.counters[timer_name] = ans[timer_name+"-count"]
+        self.update_remaining_times()
+
+    def update_remaining_times(self):
+        """Set the time left on each timer from its last reset.
+
+        Sets self.thingsToCheck["timers"]["data"] to a list of (timer name,
+        remaining time). Remaining times are Values with time units.
+        """
+        now = datetime.datetime.now()
         remaining_time = [(name, (x[0] - td_to_seconds(now-x[1])*s )) \
                               for name, x in self.timers.iteritems()]
         self.thingsToCheck['timers']['data'] = remaining_time
         rt_sleepy = [(name + ' Overnight', x) for name, x in remaining_time]
         self.thingsToCheck['sleepyTimers']['data'] = rt_sleepy
     
-    @inlineCallbacks
-    def checkForAndSendAlerts(self):
+    def findAlerts(self, thingToCheck, items):
         '''
-        Timed callback to check timers and send notifications.
+        Check (name, value) items of one kind against its rule.
+
+        Returns the names with a problem that have not been notified yet,
+        and forgets those whose problem has gone away.
         '''
-        yield self.loadRegistryInfo()
-        yield self.update_timers()
-        yield self.update_temperatures()
-        
         if not (self.enabled and self.cold):
-            return
-        
+            return []
+        thereIsProblem = self.thingsToCheck[thingToCheck]['func']
         alerts = []
-        for thingToCheck in self.thingsToCheck:
-            data = dict(self.thingsToCheck[thingToCheck]['data'])
-            thereIsProblem = self.thingsToCheck[thingToCheck]['func']
-            for t in data:
-                if thereIsProblem(t, data[t]):
-                    if t not in self.sent_notifications:
-                        self.sent_notifications.add(t)
-                        alerts.append(t)
-                    else:
-                        pass
-                else:
-                    self.sent_notifications.discard(t)
+        for t, value in items:
+            if thereIsProblem(t, value):
+                if t not in self.sent_notifications:
+                    self.sent_notifications.add(t)
+                    alerts.append(t)
+            else:
+                self.sent_notifications.discard(t)
+        return alerts
+
+    def sendAlerts(self, alerts):
+        """Queue alerts for every user by SMS and email.
+
+        Returns a Deferred so callers can chain on it; the queue sends
+        them later as digests.
+        """
         if alerts:
             print "Alerts exist on: ", alerts
             print "Notifying the following users: ", self.users
-            #SMS notifications
-            yield self.sendSMSNotifications("Cryo Alert", "%s cryos need to be filled." % (alerts,))
-            yield self.sendEmailNotifications("Cryo Alert", "%s cryos need to be filled." % (alerts,))
-    
-    @inlineCallbacks
-    def sendEmailNotifications(self, subj, msg):
-        """Notify all users via email"""
-        try:
-            print "sending email notifications to: ", self.email
-            if not DEBUG:
-                p = self.client.telecomm_server.packet()
-                p.send_mail(self.email, subj, msg)
-                yield p.send()
-        except Exception:
-            print "Sending mail to users %s failed" % self.email
-    
-    @inlineCallbacks
-    def sendSMSNotifications(self, subj, msg):
-        """Notify all users via SMS"""
-        #Try each user separately in case one fails
-        print("Sending SMS notifications to %s"%self.users)
-        for u in self.users:
-            try:
-                if not DEBUG:
-                    p = self.client.telecomm_server.packet()
-                    p.send_sms(subj, msg, u)
-                    yield p.send()
-            except Exception:
-                print("SMS attempt for user %s failed" % u)
-    
+            self.alerts.add('sms', self.users, alerts)
+            self.alerts.add('email', self.email, alerts)
+        return defer.succeed(None)
+
+    @setting(30, returns='*(ss*s)')
+    def queued_alerts(self, c):
+        """Returns (kind, recipient, alerts) for each unsent digest."""
+        return [(kind, recipient, alerts) for (kind, recipient), alerts
+                in sorted(self.alerts.pending.items())]
+
+    @setting(31, returns='')
+    def flush_alerts(self, c):
+        """Send queued alerts now, subject to the rate limits."""
+        yield self.alerts.flush()
+
+    def stopServer(self):
+        if hasattr(self, 'alerts'):
+            self.alerts.stop()
+
 __server__ = CryoNotifier()
 
 if __name__ == '__main__':
@@ -216,6 +216,39 @@ class CsvNumpyData(CsvListData):
             nrows = len(self.data) if self.data.size > 0 else 0
             return pos < nrows
 
+READ_CHUNK_BYTES = 1 << 20 # bytes of a data file read at a time by readChunks
+
+def readChunks(filename, cols, start=0, stop=None, chunk_bytes=READ_CHUNK_BYTES):
+    """Read the rows of a csv data file a chunk at a time.
+
+    Yields arrays with the rows from start up to, but not including, stop.
+    Unlike the backends, this never holds the whole file in memory, so it
+    can be used to stream out large datasets. Only complete lines are read,
+    so the file can be appended to meanwhile.
+    """
+    if not use_numpy:
+        raise RuntimeError("Reading data in chunks requires numpy.")
+    row = 0
+    rest = ''
+    with open(filename, 'rb') as f:
+        while stop is None or row < stop:
+            block = f.read(chunk_bytes)
+            if not block:
+                break
+            block = rest + block
+            end = block.rfind('\n') + 1
+            lines, rest = block[:end], block[end:]
+            n = lines.count('\n')
+            lo = max(start - row, 0)
+            hi = n if stop is None else min(n, stop - row)
+            row += n
+            if lo >= hi:
+                continue
+            if lo > 0 or hi < n:
+                lines = '\n'.join(lines.split('\n')[lo:hi])
+            data = np.fromstring(lines.rstrip().replace('\n', ','), sep=',')
+            yield data.reshape(-1, cols)
+
 def create_backend(filename, cols):
     """Make a data object that manages in-memory and on-disk storage for a dataset.
 
@@ -19,7 +19,7 @@
 ### BEGIN NODE INFO
 [info]
 name = DR Logger
-version = 0.1
+version = 0.3
 description = Log the DR temperatures, pressures, etc. 
 
 [startup]
@@ -34,17 +34,26 @@ timeout = 20
 
 import time
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredList, inlineCallbacks, returnValue
 from twisted.internet.task import LoopingCall
 
 from labrad import types as T
-from labrad.server import setting
+from labrad.server import setting, Signal
 from labrad.gpib import DeviceWrapper, DeviceServer
 from labrad.errors import NoSuchDeviceError, Error
 from labrad.units import Unit, Value
 
 CONFIG_PATH = ['', 'Servers', 'DR Logger']
 DIODE_LIST = ["4Kin", "4Kout", "77K", "Ret", "Mix", "Xchg", "Still", "Pot"]
+# seconds to wait for a watched server, unless given in its 'timeout' option
+DEFAULT_TIMEOUT = 10.0
+# seconds between writes of the buffered rows to the data vault
+DEFAULT_FLUSH_PERIOD = 60.0
+# most rows kept while the data vault can't be written, about a day
+MAX_BUFFERED_ROWS = 86400
+# ID of the signal sent with each row
+NEW_POINT_SIGNAL = 318001
 
 
 class NoMKSDataError(Error):
@@ -55,6 +64,15 @@ class ServerNotFoundError(Error):
     pass
 
 
+class WatcherTimeoutError(Error):
+    pass
+
+
+def _seconds(t):
+    """ A time option in seconds, given either as a Value or a number. """
+    return t['s'] if isinstance(t, Value) else float(t)
+
+
 class WatchedServer(object):
     """Proxy for another server from which we pull data
 
@@ -65,8 +83,18 @@ class WatchedServer(object):
         device (str or int): Specific hardware device to access through the
             proxied server. If None (the default) we select the first available
             device, which is the pylabrad default.
+        timeout (float): Seconds to wait for a point before giving up on it.
+        interval (float): Seconds between points, from the 'interval' option
+            or the class default. If None, the DR logger's time interval.
+        latency (float): Seconds the last point took, or None if it failed.
+        values (list of Value): The last point taken.
+        acquired (float): When the last point was taken, as time.time().
+        error (str): Why the last poll failed, or None if it did not.
+        clock (IReactorTime): Schedules the poll timeouts.
     """
     server_name = 'none'
+    interval = None
+    clock = reactor
 
     def __init__(self, name, cxn, ctx, options):
         self.name = name
@@ -75,6 +103,15 @@ class WatchedServer(object):
         self.options = dict(options)
         self.server = None
         self.active = False
+        timeout = self.options.get('timeout', DEFAULT_TIMEOUT)
+        self.timeout = _seconds(timeout)
+        if 'interval' in self.options:
+            self.interval = _seconds(self.options['interval'])
+        self.latency = None
+        self.values = None
+        self.acquired = 0
+        self.error = 'No point taken yet'
+        self._pending = False
 
     def get_variables(self):
         """ Get the variables (for the data vault) logged by this server.
@@ -139,6 +176,60 @@ class WatchedServer(object):
             else:
                 raise err
 
+    def poll(self):
+        """ Take a single data point, giving up after self.timeout.
+
+        A point that is still outstanding from a previous poll is not asked
+        for again, so a hung server does not get a pile of requests.
+        :return: deferred list of values, as for take_point.
+        """
+        result = Deferred()
+        if self._pending:
+            self.latency = None
+            result.errback(WatcherTimeoutError(
+                "'{}' has not answered the last poll".format(self.name)))
+            return result
+        self._pending = True
+        start = time.time()
+
+        def timedOut():
+            self.latency = None
+            result.errback(WatcherTimeoutError(
+                "'{}' timed out after {} s".format(self.name, self.timeout)))
+
+        def finished(r):
+            self._pending = False
+            if timeoutCall.active():
+                timeoutCall.cancel()
+                self.latency = time.time() - start
+                result.callback(r)
+
+        def failed(failure):
+            self._pending = False
+            if timeoutCall.active():
+                timeoutCall.cancel()
+                self.latency = None
+                result.errback(failure)
+
+        timeoutCall = self.clock.callLater(self.timeout, timedOut)
+        self.take_point().addCallbacks(finished, failed)
+        return result
+
+    @inlineCallbacks
+    def sample(self):
+        """ Poll, keeping the point or the error for the DR logger's rows.
+
+        Never fails, so that it can be run in a LoopingCall.
+        """
+        try:
+            self.values = yield self.poll()
+            self.acquired = time.time()
+            self.error = None
+        except T.Error as err:
+            self.error = err.msg
+        except Exception as err:
+            self.error = repr(err)
+
 
 # noinspection PyAttributeOutsideInit
 class MKS(WatchedServer):
@@ -147,6 +238,7 @@ class MKS(WatchedServer):
     a He flow.
     """
     server_name = 'mks_gauge_server'
+    interval = 1.0
 
     @inlineCallbacks
     def _take_point(self):
@@ -194,6 +286,7 @@ class MKSHack(MKS):
 
 class Diodes(WatchedServer):
     server_name = 'lakeshore_diodes'
+    interval = 5.0
 
     @inlineCallbacks
     def _take_point(self):
@@ -206,6 +299,7 @@ class Diodes(WatchedServer):
 
 class Ruox(WatchedServer):
     server_name = 'lakeshore_ruox'
+    interval = 10.0
 
     @inlineCallbacks
     def _take_point(self):
@@ -245,21 +339,32 @@ class DRLogger(DeviceWrapper):
     Attributes:
         name (str): Name of this DR setup. Assigned by pylabrad's device server
             code.
-        watchers (list of WatchedServer): Server proxies we watch.
+        watchers (list of WatchedServer): Server proxies we watch. Each is
+            polled at its own interval. Every timeInterval a row is made
+            from the latest point of each watcher, followed by the time each
+            point was acquired, relative to the row's time.
+        buffer (list of list of float): Rows not yet written to the data
+            vault. They are written together every flushPeriod seconds, and
+            kept for the next flush if writing fails, up to
+            MAX_BUFFERED_ROWS.
+        variables (list of str): Labels of the values in each row after the
+            time, as given to the data vault.
     """
     @inlineCallbacks
     def connect(self, *args, **kwargs):
         """Connect to a DR device
 
         Args:
-            args (tuple of (cxn,)): A tuple with a single element, which is a
-                LabRAD connection.
+            args (tuple of (cxn, notify)): A LabRAD connection, and
+                optionally a function called with (name, [(label, value)])
+                for each row, to send the server's 'new point' signal.
         kwargs (dict):
             Maps hardware types (e.g. 'ruox') to configuration data. See
             DRLoggerServer.findDevices for format.
         """
         print "Creating DR Logger for %s" % self.name
         self.cxn = args[0]
+        self.notify = args[1] if len(args) > 1 else None
         self.ctx = self.cxn.context()
         self.watchers = []
         self.data_vault = None
@@ -267,7 +372,13 @@ class DRLogger(DeviceWrapper):
         self.dvPath = kwargs.pop('dvPath', ['', 'DR', self.name])
         self.datasetName = kwargs.pop('datasetName', '%s log - [t]' % self.name)
         self.timeInterval = kwargs.pop('timeInterval', 1.0)
+        self.flushPeriod = _seconds(kwargs.pop('flushPeriod', DEFAULT_FLUSH_PERIOD))
         self.currentDay = ''
+        # rows not yet written to the data vault
+        self.buffer = []
+        self.writeErrors = []
+        self.lastRow = 0
+        self.variables = None
         # now make our watchers
         for k, v in kwargs.iteritems():
             server_name = v[0]
@@ -290,22 +401,33 @@ class DRLogger(DeviceWrapper):
         self.isLogging = False
         yield self.logging(True)  # start logging
 
+    def _startLoop(self, func, interval, now):
+        loop = LoopingCall(func)
+        self.loops.append((loop, loop.start(interval, now=now)))
+
     @inlineCallbacks
     def logging(self, start):
         if not self.isLogging and start:
-            # start the loop
+            # start the loops: one per watcher, one to assemble rows from
+            # their latest points, and one to write the rows
             self.isLogging = True
-            self.loop = LoopingCall(self.take_point)
-            self.loopDone = self.loop.start(self.timeInterval, now=True)
-            print 'loop started'
+            self.loops = []
+            for w in self.watchers:
+                self._startLoop(w.sample, w.interval or self.timeInterval, True)
+            self._startLoop(self.record_row, self.timeInterval, False)
+            self._startLoop(self.flush, self.flushPeriod, False)
+            print 'loops started'
         elif self.isLogging and not start:
-            # stop the loop
-            try:
-                self.loop.stop()
-                yield self.loopDone
-            except AssertionError:
-                pass
-            print 'loop stopped'
+            # stop the loops
+            for loop, done in self.loops:
+                try:
+                    loop.stop()
+                    yield done
+                except AssertionError:
+                    pass
+            self.loops = []
+            yield self.flush()
+            print 'loops stopped'
             self.isLogging = False
 
     @inlineCallbacks
@@ -322,61 +444,117 @@ class DRLogger(DeviceWrapper):
         name = self.datasetName.replace('[t]', time.strftime("%Y-%m-%d %H:%M"))
         self.currentDay = time.strftime("%d")
         indeps = ['time [s]']
-        deps = []
-        for w in self.watchers:
-            r = yield w.get_variables()
-            deps.extend(r)
+        deps = yield self.get_variables()
+        self.variables = deps
         print "Indep vars: %s" % str(indeps)
         print "Dependent vars: %s" % str(deps)
 
         yield self.data_vault.new(name, indeps, deps, context=self.ctx)
 
+    @inlineCallbacks
+    def get_variables(self):
+        """ Labels of the values in each row after the time. """
+        deps = []
+        for w in self.watchers:
+            r = yield w.get_variables()
+            deps.extend(r)
+        deps.extend('%s (Acquired) [s]' % w.server_name for w in self.watchers)
+        returnValue(deps)
+
     @inlineCallbacks
     def take_point(self):
+        """ Poll all watchers now, and record a row with their points. """
+        yield DeferredList([w.sample() for w in self.watchers])
+        yield self.record_row()
+
+    @inlineCallbacks
+    def record_row(self):
+        """ Add a row with the latest point of each watcher to the buffer.
+
+        A watcher whose last poll failed has NaN for its values, and its
+        acquired time shows when its last good point was taken. Nothing is
+        recorded until every watcher has taken a point, since until then
+        the row's length isn't known, or if no watcher has a new point
+        since the last row.
+        """
         try:
-            # gather data
-            data = [time.time() * Unit('s')]
-            errors = []
-            for w in self.watchers:
-                try:
-                    r = yield w.take_point()
-                    data.extend(r)
-                except T.Error as err:
-                    errors.append((w.server_name, err.msg))
-            if errors:
-                self.errors = errors
+            now = time.time()
+            errors = [(w.server_name, w.error) for w in self.watchers
+                      if w.error is not None]
+            self.errors = errors + self.writeErrors
+            if any(w.values is None for w in self.watchers):
                 returnValue(None)
+            if not any(w.acquired > self.lastRow for w in self.watchers):
+                returnValue(None)
+            self.lastRow = now
             # strip units
-            data = [x[x.unit] for x in data]
-            # did the day roll over?
+            data = [now]
+            for w in self.watchers:
+                if w.error is None:
+                    data.extend(x[x.unit] for x in w.values)
+                else:
+                    data.extend([float('nan')] * len(w.values))
+            data.extend(w.acquired - now for w in self.watchers)
+            # did the day roll over? Rows still buffered belong in the old
+            # dataset, so only start a new one once they are written.
             if self.currentDay != time.strftime("%d"):
-                self.new_dataset()
-            try:
-                # make dataset if first time
-                if self.data_vault is None:
-                    print("Making new dataset")
+                yield self.flush()
+                if not self.buffer:
+                    self.new_dataset()
+                    self.currentDay = time.strftime("%d")
+            self.buffer.append(data)
+            if self.notify is not None:
+                if self.variables is None:
+                    self.variables = yield self.get_variables()
+                self.notify((self.name, zip(self.variables, data[1:])))
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+
+    @inlineCallbacks
+    def flush(self):
+        """ Write the buffered rows to the data vault in one request. """
+        if not self.buffer:
+            returnValue(None)
+        rows, self.buffer = self.buffer, []
+        errors = []
+        written = False
+        try:
+            # make dataset if first time
+            if self.data_vault is None:
+                print("Making new dataset")
+                yield self.make_dataset()
+            # add data
+            yield self.data_vault.add(rows, context=self.ctx)
+            written = True
+        except T.Error as err:
+            print("Error when writing data to data vault: {}".format(err))
+            if 'NoDatasetError' in err.msg:
+                try:
                     yield self.make_dataset()
-                # add data
-                yield self.data_vault.add(data, context=self.ctx)
-            except T.Error as err:
-                print("Error when writing data to data vault: {}".format(err))
-                if 'NoDatasetError' in err.msg:
-                    try:
-                        yield self.make_dataset()
-                        yield self.data_vault.add(data, context=self.ctx)
-                    except T.Error as err:
-                        errors.append(("Data Vault", str(err)))
-                else:
-                    errors.append(("General", str(err)))
-            self.errors = errors
+                    yield self.data_vault.add(rows, context=self.ctx)
+                    written = True
+                except T.Error as err:
+                    errors.append(("Data Vault", str(err)))
+            else:
+                errors.append(("General", str(err)))
         except Exception as e:
             import traceback
             traceback.print_exc()
+        if not written:
+            # keep the rows for the next flush, dropping the oldest if the
+            # data vault has been unavailable for a long time
+            self.buffer = (rows + self.buffer)[-MAX_BUFFERED_ROWS:]
+        self.writeErrors = errors
 
 
 class DRLoggerServer(DeviceServer):
     """Log DR temperatures and pressures
 
+    Each row logged is also sent with the 'new point' signal, as the DR
+    name and a list of (label, value), with labels as in the dataset, e.g.
+    'Mix1 (Ruox) [K]', and values in the label's units.
+
     Registry format:
         >> Servers >> DR Logger >> <DR name> (e.g. 'Ivan')
             <thing to measure> -> (<server>, <node>, <options>):
@@ -392,13 +570,16 @@ class DRLoggerServer(DeviceServer):
     deviceName = 'DR'
     deviceWrapper = DRLogger
 
+    onNewPoint = Signal(NEW_POINT_SIGNAL, 'signal: new point',
+                        '(s{DR name} *(s{label} v{value}))')
+
     @inlineCallbacks
     def findDevices(self):
         """Get device configurations from registry
 
         all configurations in CONFIG_PATH and returns
 
-        Returns list of (drName, (cxn,), serverDict).
+        Returns list of (drName, (cxn, notify), serverDict).
             serverDict is a mapping from a device type (i.e. 'mks', 'ruox', or
             'diodes') to a tuple of either
             (server name, node name, options) or
@@ -429,7 +610,7 @@ class DRLoggerServer(DeviceServer):
                 if "node_" + node.lower() not in self.client.servers:
                     missingNodes.append(node)
             if not missingNodes:
-                deviceList.append((drName, (self.client,), serverDict))
+                deviceList.append((drName, (self.client, self.onNewPoint), serverDict))
             else:
                 print "device %s missing nodes %s" % (drName, str(list(set(missingNodes))))
             yield reg.cd(1)
@@ -459,11 +640,15 @@ class DRLoggerServer(DeviceServer):
         dev = self.selectedDevice(c)
         if ti is not None:
             dev.timeInterval = ti['s']
-            if dev.isLogging:
-                yield dev.logging(False)
-                yield dev.logging(True)
+            yield self.restart(dev)
         returnValue(Value(dev.timeInterval, 's'))
 
+    @inlineCallbacks
+    def restart(self, dev):
+        if dev.isLogging:
+            yield dev.logging(False)
+            yield dev.logging(True)
+
     @setting(14, 'Errors', returns='*(s, s)')
     def errors(self, c):
         """ Retrieve outstanding errors.
@@ -480,6 +665,49 @@ class DRLoggerServer(DeviceServer):
         """
         return time.time()
 
+    @setting(16, 'Latencies', returns='*(s, v[s])')
+    def latencies(self, c):
+        """ Time taken by the last point from each watched server.
+
+        Given as (server name, latency) pairs. The latency is NaN if the
+        last point failed or timed out.
+        """
+        dev = self.selectedDevice(c)
+        return [(w.server_name,
+                 Value(w.latency if w.latency is not None else float('nan'), 's'))
+                for w in dev.watchers]
+
+    @setting(17, 'Watcher Interval', server='s', ti='v[s]', returns='v[s]')
+    def watcher_interval(self, c, server, ti=None):
+        """ Get/set the interval between points from one watched server.
+
+        The server is given by name, e.g. 'lakeshore_ruox'.
+        """
+        dev = self.selectedDevice(c)
+        for w in dev.watchers:
+            if w.server_name == server:
+                break
+        else:
+            raise ServerNotFoundError("Not watching '{}'".format(server))
+        if ti is not None:
+            w.interval = ti['s']
+            yield self.restart(dev)
+        returnValue(Value(w.interval or dev.timeInterval, 's'))
+
+    @setting(18, 'Flush Period', period='v[s]', returns='v[s]')
+    def flush_period(self, c, period=None):
+        """ Get/set how often logged rows are written to the data vault. """
+        dev = self.selectedDevice(c)
+        if period is not None:
+            dev.flushPeriod = period['s']
+            yield self.restart(dev)
+        returnValue(Value(dev.flushPeriod, 's'))
+
+    @setting(19, 'Flush')
+    def flush_data(self, c):
+        """ Write logged rows to the data vault now. """
+        yield self.selectedDevice(c).flush()
+
 
 __server__ = DRLoggerServer()
 
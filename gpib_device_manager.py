@@ -19,6 +19,11 @@
 #     device registration would fail if the server had a custom IDN handling
 #     function because this setting could not be properly accessed through the
 #     LabRAD manager at the time of execution.
+# 1.4 Cache identified devices in the registry so that reconnecting bus
+#     servers don't re-identify every device. Identification with ident
+#     functions is serialized per bus server instead of globally.
+
+import time
 
 from twisted.internet.defer import DeferredList, DeferredLock
 from twisted.internet.reactor import callLater
@@ -31,7 +36,7 @@ from labrad.units import Unit,Value
 ### BEGIN NODE INFO
 [info]
 name = GPIB Device Manager
-version = 1.3
+version = 1.4
 description = Manages discovery and lookup of GPIB devices
 
 [startup]
@@ -46,6 +51,9 @@ timeout = 5
 
 UNKNOWN = '<unknown>'
 
+# Registry directory where identified devices are cached
+IDENT_CACHE_PATH = ['', 'Servers', 'GPIB Device Manager', 'Ident Cache']
+
 def parseIDNResponse(s):
     """Parse the response from *IDN? to get mfr and model info."""
     mfr, model, ver, rev = s.split(',')
@@ -63,7 +71,10 @@ class GPIBDeviceManager(LabradServer):
     by the device manager to properly identify the device.
     """
     name = 'GPIB Device Manager'
-    
+
+    # Cached identifications older than this many seconds are redone
+    identCacheTTL = 7 * 24 * 3600
+
     @inlineCallbacks
     def initServer(self):
         """Initialize the server after connecting to LabRAD."""
@@ -71,7 +82,10 @@ class GPIBDeviceManager(LabradServer):
         self.deviceServers = {} # maps device name to list of interested servers.
                                 # each interested server is {'target':<>,'context':<>,'messageID':<>}
         self.identFunctions = {} # maps server to (setting, ctx) for ident
-        self.identLock = DeferredLock()
+        self.identLocks = {} # maps bus server to lock for ident functions
+        self.identCache = {} # maps (server, channel) to (name, idn, time)
+        self.registryCtx = self.client.context()
+        yield self.loadIdentCache()
         
         # named messages are sent with source ID first, which we ignore
         connect_func = lambda c, (s, payload): self.gpib_device_connect(*payload)
@@ -84,7 +98,64 @@ class GPIBDeviceManager(LabradServer):
 
         # do an initial scan of the available GPIB devices
         yield self.refreshDeviceLists()
-        
+
+    def identLock(self, server):
+        """Lock serializing identification of devices on one bus server."""
+        return self.identLocks.setdefault(server, DeferredLock())
+
+    @inlineCallbacks
+    def loadIdentCache(self):
+        """Load cached identifications from the registry."""
+        reg = self.client.registry
+        try:
+            p = reg.packet(context=self.registryCtx)
+            p.cd(IDENT_CACHE_PATH, True)
+            p.dir()
+            ans = yield p.send()
+            keys = ans.dir[1]
+            if keys:
+                p = reg.packet(context=self.registryCtx)
+                for key in keys:
+                    p.get(key, key=key)
+                ans = yield p.send()
+                for key in keys:
+                    server, channel, name, idn, hasIdn, t = ans[key]
+                    self.identCache[server, channel] = (
+                        name, idn if hasIdn else None, t)
+        except Exception, e:
+            print 'Failed to load ident cache:', e
+        print 'Loaded %d cached identifications' % len(self.identCache)
+
+    def cachedIdent(self, server, channel):
+        """Get the cached (name, idn) of a device, or None if not cached."""
+        entry = self.identCache.get((server, channel))
+        if entry is None:
+            return None
+        name, idn, t = entry
+        if time.time() - t > self.identCacheTTL:
+            self.forgetIdent(server, channel)
+            return None
+        return name, idn
+
+    def cacheIdent(self, server, channel, name, idn):
+        """Store the identification of a device, in memory and the registry."""
+        t = time.time()
+        self.identCache[server, channel] = (name, idn, t)
+        p = self.client.registry.packet(context=self.registryCtx)
+        p.cd(IDENT_CACHE_PATH, True)
+        p.set(_cacheKey(server, channel),
+              (server, channel, name, idn or '', idn is not None, t))
+        p.send().addErrback(lambda f: _printFailure('cache ident', f))
+
+    def forgetIdent(self, server, channel):
+        """Remove the cached identification of a device."""
+        if self.identCache.pop((server, channel), None) is None:
+            return
+        p = self.client.registry.packet(context=self.registryCtx)
+        p.cd(IDENT_CACHE_PATH, True)
+        p.del_(_cacheKey(server, channel))
+        p.send().addErrback(lambda f: _printFailure('forget ident', f))
+
     @inlineCallbacks
     def refreshDeviceLists(self):
         """Ask all GPIB bus servers for their available GPIB devices."""
@@ -109,9 +180,16 @@ class GPIBDeviceManager(LabradServer):
         print 'Device Connect:', gpibBusServer, channel
         if (gpibBusServer, channel) in self.knownDevices:
             return
-        device, idnResult = yield self.lookupDeviceName(gpibBusServer, channel)
-        if device == UNKNOWN:
-            device = yield self.identifyDevice(gpibBusServer, channel, idnResult)
+        cached = self.cachedIdent(gpibBusServer, channel)
+        if cached is not None:
+            device, idnResult = cached
+            print 'Using cached identification:', device
+        else:
+            device, idnResult = yield self.lookupDeviceName(gpibBusServer, channel)
+            if device == UNKNOWN:
+                device = yield self.identifyDevice(gpibBusServer, channel, idnResult)
+            if device != UNKNOWN:
+                self.cacheIdent(gpibBusServer, channel, device, idnResult)
         self.knownDevices[gpibBusServer, channel] = (device, idnResult)
         # forward message if someone cares about this device
         if device in self.deviceServers:
@@ -160,23 +238,34 @@ class GPIBDeviceManager(LabradServer):
                 if name is not None:
                     returnValue(name)
             returnValue(UNKNOWN)
-        return self.identLock.run(_doIdentifyDevice)
+        return self.identLock(server).run(_doIdentifyDevice)
 
     def identifyDevicesWithServer(self, identifier):
-        """Try to identify all unknown devices with a new server."""
+        """Try to identify all unknown devices with a new server.
+
+        Devices on different bus servers are identified concurrently.
+        """
         @inlineCallbacks
-        def _doServerIdentify():
-            #yield self.client.refresh()
-            for (server, channel), (device, idn) in list(self.knownDevices.items()):
+        def _doServerIdentify(server, channels):
+            for channel in channels:
+                device, idn = self.knownDevices.get((server, channel),
+                                                    (None, None))
                 if device != UNKNOWN:
                     continue
                 name = yield self.tryIdentFunc(server, channel, idn, identifier)
                 if name is None:
                     continue
                 self.knownDevices[server, channel] = (name, idn)
+                self.cacheIdent(server, channel, name, idn)
                 if name in self.deviceServers:
                     self.notifyServers(name, server, channel, True)
-        return self.identLock.run(_doServerIdentify)        
+        unknown = {}
+        for (server, channel), (device, idn) in list(self.knownDevices.items()):
+            if device == UNKNOWN:
+                unknown.setdefault(server, []).append(channel)
+        return DeferredList([self.identLock(server).run(_doServerIdentify,
+                                                        server, channels)
+                             for server, channels in unknown.items()])
 
     @inlineCallbacks
     def tryIdentFunc(self, server, channel, idn, identifier):
@@ -270,6 +359,30 @@ class GPIBDeviceManager(LabradServer):
                 str(self.deviceServers),
                 str(self.identFunctions))
     
+    @setting(20, 'Forget Identification', server='s', address='s',
+             returns='w')
+    def forget_identification(self, c, server=None, address=None):
+        """Remove cached device identifications.
+
+        With no arguments the whole cache is cleared, with just a server
+        all devices on that bus server are forgotten. Forgotten devices are
+        identified again the next time they connect. Use this after swapping
+        the instrument at an address. Returns the number of devices removed.
+        """
+        keys = [(s, a) for (s, a) in list(self.identCache.keys())
+                if (server is None or s == server) and
+                   (address is None or a == address)]
+        for s, a in keys:
+            self.forgetIdent(s, a)
+        return long(len(keys))
+
+    @setting(21, 'Ident Cache TTL', ttl='v[s]', returns='v[s]')
+    def ident_cache_ttl(self, c, ttl=None):
+        """Get or set how long cached identifications are trusted."""
+        if ttl is not None:
+            self.identCacheTTL = ttl['s']
+        return Value(self.identCacheTTL, 's')
+
     def notifyServers(self, device, server, channel, isConnected):
         """Notify all registered servers about a device status change."""
         for s in self.deviceServers[device]:
@@ -323,6 +436,13 @@ class GPIBDeviceManager(LabradServer):
         for src in deletions:
             del self.identFunctions[src]
 
+def _cacheKey(server, channel):
+    """Registry key for the cached identification of a device."""
+    return '%s %s' % (server, channel)
+
+def _printFailure(action, failure):
+    print 'Failed to %s: %s' % (action, failure.getErrorMessage())
+
 __server__ = GPIBDeviceManager()
 
 if __name__ == '__main__':
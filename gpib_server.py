@@ -37,10 +37,14 @@
 # connections work, and should be improved.
 
 from labrad.server import LabradServer, setting
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue, DeferredLock
 from twisted.internet.reactor import callLater
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
 from labrad.errors import DeviceNotSelectedError
 import labrad.units as units
+import numpy as np
 import visa
 
 
@@ -48,7 +52,7 @@ import visa
 ### BEGIN NODE INFO
 [info]
 name = GPIB Bus
-version = 1.3.2-no-refresh
+version = 1.4.0-no-refresh
 description = Gives access to GPIB devices via pyvisa.
 instancename = %LABRADNODE% GPIB Bus
 
@@ -63,15 +67,68 @@ timeout = 20
 """
 
 
+# Operations accepted by the Batch setting
+BATCH_OPS = ['write', 'query', 'read', 'read raw', 'query block',
+             'read block']
+
+
+def parseBlockHeader(data):
+    """Find the payload of an IEEE 488.2 definite length block.
+
+    A block is '#<n><length><payload>', where n is a single digit giving the
+    number of digits in length. Leading whitespace is ignored. Returns
+    (offset, length) of the payload in data.
+    """
+    start = len(data) - len(data.lstrip())
+    if data[start:start + 1] != '#' or len(data) < start + 2:
+        raise ValueError("Response is not a binary block: {!r}".format(
+            data[:20]))
+    n = int(data[start + 1])
+    if n == 0:
+        raise ValueError("Indefinite length blocks are not supported")
+    header = data[start + 2:start + 2 + n]
+    if len(header) < n or not header.isdigit():
+        raise ValueError("Bad binary block header: {!r}".format(
+            data[start:start + 2 + n]))
+    return start + 2 + n, int(header)
+
+
+def readBlock(instr):
+    """Read a definite length block from instr and return its payload.
+
+    Reads as many chunks as needed to get the whole payload, then drops the
+    header and any trailing terminator. The payload itself is returned byte
+    for byte, nothing is stripped.
+    """
+    buf = bytearray(instr.read_raw())
+    # the header is at most 11 characters, plus any leading whitespace
+    offset, length = parseBlockHeader(str(buf[:64]))
+    while len(buf) < offset + length:
+        buf.extend(instr.read_raw())
+    return str(buf[offset:offset + length])
+
+
 class GPIBBusServer(LabradServer):
-    """Provides direct access to GPIB-enabled devices."""
+    """Provides direct access to GPIB-enabled devices.
+
+    VISA calls block, so all device I/O runs in a thread pool. Calls to one
+    device are queued and run one at a time in the order they arrive, while
+    different devices are talked to in parallel. A slow read from one
+    instrument therefore no longer holds up the rest of the bus.
+    """
     name = '%LABRADNODE% GPIB Bus'
 
     refreshInterval = 10
     defaultTimeout = 1.0 * units.s
+    # Maximum number of devices doing I/O at the same time
+    poolSize = 10
 
     def initServer(self):
         self.devices = {}
+        self.deviceLocks = {}
+        self.pool = ThreadPool(minthreads=0, maxthreads=self.poolSize,
+                               name='GPIB Bus')
+        self.pool.start()
         # start refreshing only after we have started serving
         # this ensures that we are added to the list of available
         # servers before we start sending messages
@@ -94,6 +151,8 @@ class GPIBBusServer(LabradServer):
         if hasattr(self, 'refresher'):
             self.refresher.stop()
             yield self.refresherDone
+        if hasattr(self, 'pool'):
+            self.pool.stop()
 
     def refreshDevices(self):
         """Refresh the list of known devices on this bus.
@@ -145,6 +204,35 @@ class GPIBBusServer(LabradServer):
         instr = self.devices[c['addr']]
         return instr
 
+    @inlineCallbacks
+    def callDevice(self, addr, func, *args, **kw):
+        """Call a blocking function for the device at addr in the pool.
+
+        Calls for the same address run one at a time in the order they were
+        made. Calls for different addresses run in parallel, up to the size
+        of the thread pool. Returns a Deferred that fires with the result.
+        """
+        # Locks are never removed, so a device that disappears and comes
+        # back can't end up with two queues.
+        lock = self.deviceLocks.setdefault(addr, DeferredLock())
+        yield lock.acquire()
+        try:
+            result = yield deferToThreadPool(reactor, self.pool, func,
+                                             *args, **kw)
+        finally:
+            lock.release()
+        returnValue(result)
+
+    def queryBlock(self, c, data):
+        """Write data and read a binary block from the selected device."""
+        instr = self.getDevice(c)
+
+        def doQuery():
+            instr.write(data)
+            return readBlock(instr)
+
+        return self.callDevice(c['addr'], doQuery)
+
     @setting(0, addr='s', returns='s')
     def address(self, c, addr=None):
         """Get or set the GPIB address for this context.
@@ -166,7 +254,8 @@ class GPIBBusServer(LabradServer):
     @setting(3, data='s', returns='')
     def write(self, c, data):
         """Write a string to the GPIB bus."""
-        self.getDevice(c).write(data)
+        instr = self.getDevice(c)
+        yield self.callDevice(c['addr'], instr.write, data)
 
     @setting(4, n_bytes='w', returns='s')
     def read(self, c, n_bytes=None):
@@ -177,10 +266,10 @@ class GPIBBusServer(LabradServer):
         """
         instr = self.getDevice(c)
         if n_bytes is None:
-            ans = instr.read_raw()
+            ans = yield self.callDevice(c['addr'], instr.read_raw)
         else:
-            ans = instr.read_raw(n_bytes)
-        return str(ans).strip()
+            ans = yield self.callDevice(c['addr'], instr.read_raw, n_bytes)
+        returnValue(str(ans).strip())
 
     @setting(5, data='s', returns='s')
     def query(self, c, data):
@@ -190,9 +279,91 @@ class GPIBBusServer(LabradServer):
         device will occur while the query is in progress.
         """
         instr = self.getDevice(c)
-        instr.write(data)
-        ans = instr.read_raw()
-        return str(ans).strip()
+
+        def doQuery():
+            instr.write(data)
+            return instr.read_raw()
+
+        ans = yield self.callDevice(c['addr'], doQuery)
+        returnValue(str(ans).strip())
+
+    @setting(6, ops='*(ss)', returns='*s')
+    def batch(self, c, ops):
+        """Run a list of operations back to back on the device.
+
+        Each operation is a (kind, data) cluster, where kind is one of:
+            write - write data to the device
+            query - write data, then read the response
+            read - read the response, data is ignored
+            read raw - as read, but the response is not stripped so that
+                binary data comes back intact
+            query block - write data, then read a binary block as in the
+                query block setting
+            read block - read a binary block, data is ignored
+
+        Returns one string per operation, empty for writes. Like query, the
+        batch is atomic, and the whole batch costs one request to the bus
+        server instead of one per command.
+        """
+        instr = self.getDevice(c)
+        for kind, data in ops:
+            if kind not in BATCH_OPS:
+                raise ValueError("Unknown batch operation '{}', must be one "
+                                 "of {}".format(kind, BATCH_OPS))
+
+        def doBatch():
+            replies = []
+            for kind, data in ops:
+                if kind in ('write', 'query', 'query block'):
+                    instr.write(data)
+                if kind == 'write':
+                    replies.append('')
+                    continue
+                if kind in ('query block', 'read block'):
+                    replies.append(readBlock(instr))
+                    continue
+                ans = str(instr.read_raw())
+                replies.append(ans if kind == 'read raw' else ans.strip())
+            return replies
+
+        replies = yield self.callDevice(c['addr'], doBatch)
+        returnValue(replies)
+
+    @setting(7, returns='s')
+    def read_block(self, c):
+        """Read an IEEE 488.2 definite length block, #<n><length><bytes>.
+
+        Returns the payload bytes exactly, without the header or terminator.
+        Unlike read, nothing is stripped, so binary data is not corrupted.
+        """
+        instr = self.getDevice(c)
+        ans = yield self.callDevice(c['addr'], readBlock, instr)
+        returnValue(ans)
+
+    @setting(8, data='s', returns='s')
+    def query_block(self, c, data):
+        """Write data and read the response as a definite length block.
+
+        This query is atomic, see query and read block.
+        """
+        ans = yield self.queryBlock(c, data)
+        returnValue(ans)
+
+    @setting(9, data='s', dtype='s', returns='*v')
+    def query_array(self, c, data, dtype='>f4'):
+        """Make a block query and decode the payload as a numeric array.
+
+        dtype is a numpy dtype string giving the byte order and type of each
+        point, for example '>i2' for big endian 16 bit integers or '<f8' for
+        little endian doubles. The default matches REAL,32 data in the
+        default (big endian) byte order of most instruments.
+        """
+        dtype = np.dtype(dtype)
+        ans = yield self.queryBlock(c, data)
+        if len(ans) % dtype.itemsize:
+            raise ValueError("Block of {} bytes is not a whole number of {} "
+                             "byte points".format(len(ans), dtype.itemsize))
+        returnValue(np.frombuffer(ans, dtype=dtype).astype(float))
 
     @setting(20, returns='*s')
     def list_devices(self, c):
@@ -204,6 +375,18 @@ class GPIBBusServer(LabradServer):
         """ manually refresh devices """
         self.refreshDevices()
 
+    @setting(22, size='w', returns='w')
+    def pool_size(self, c, size=None):
+        """Get or set the maximum number of devices doing I/O at once.
+
+        I/O to any one device is always serialized, whatever the pool size.
+        """
+        if size is not None:
+            if size < 1:
+                raise ValueError("Pool size must be at least 1")
+            self.pool.adjustPoolsize(maxthreads=size)
+        return long(self.pool.max)
+
 
 __server__ = GPIBBusServer()
 
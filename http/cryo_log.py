@@ -2,18 +2,24 @@
 from __future__ import division
 
 from twisted.web.server import Site, NOT_DONE_YET
+from twisted.web import http
 from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
 from twisted.web.resource import Resource, IResource
-from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
-from twisted.web.template import flattenString, Element, renderer, XMLFile, tags
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred, DeferredList
+from twisted.web.template import flattenString, Element, renderer, tags
 from twisted.python.filepath import FilePath
 from labrad.server import LabradServer, setting
 import functools
 import inspect
+import json
 import labrad
 import datetime
+import time
 from zope.interface import implements
 
+from http_server import CachedXMLFile, RenderCache, request_key
+
 from twisted.cred.portal import IRealm, Portal
 from twisted.cred.checkers import InMemoryUsernamePasswordDatabaseDontUse as pwdb
 from twisted.web.static import File
@@ -23,7 +29,7 @@ from twisted.web.guard import DigestCredentialFactory, HTTPAuthSessionWrapper
 ### BEGIN NODE INFO
 [info]
 name = HTTP Server
-version = 1.0
+version = 1.1
 description = Cryo status information over HTTP
 
 [startup]
@@ -66,34 +72,229 @@ def render_safe(render_method):
         wrapper.__doc__ = "Wrapped by render_safe"
     return renderer(wrapper)
 
+# seconds between background refreshes of the status snapshot
+REFRESH_INTERVAL = 5.0
+# longest a JSON request waits for the snapshot to change
+LONG_POLL_TIMEOUT = 30.0
+# most recent fill log entries kept in the snapshot
+MAX_LOG_ENTRIES = 100
+# message ID for changes to the fill log in the registry
+LOG_CHANGE_MESSAGE = 318201
+# seconds a timer's deadline may move between refreshes without counting as
+# a change, since it is worked out from the time left when we ask
+DEADLINE_SLACK = 2
+
+class CryoStatusCache(object):
+    '''
+    Snapshot of the cryo status, shared by all requests.
+
+    The instrument servers and the cryo notifier are queried once every
+    REFRESH_INTERVAL in the background, rather than once per request. The
+    fill log is read in full once, and after that only the keys the
+    registry reports as changed are read.
+
+    The snapshot is made of sections, each with its data, an error message
+    if it could not be updated, and the version at which it last changed.
+    The version is bumped whenever any section changes, and requests
+    waiting for a change are then answered.  Timers are kept as their
+    deadlines, in seconds since the epoch, which only change when a timer
+    is reset, rather than as the time left, which changes every refresh.
+    '''
+    sections = ['timers', 'ruox', 'diodes', 'pressures', 'log']
+
+    def __init__(self, cxn):
+        self._cxn = cxn
+        self.log_path = ['', 'Servers', 'Cryo Notifier', 'Log' ]
+        self.version = 0
+        self.snapshot = dict((name, {'data': [], 'error': 'Not loaded yet', 'version': 0})
+                             for name in self.sections)
+        self.log_entries = {}
+        self.waiters = []
+
+    @inlineCallbacks
+    def start(self):
+        yield self.watch_log()
+        self.loop = LoopingCall(self.refresh)
+        self.loop.start(REFRESH_INTERVAL, now=True)
+
+    def update(self, name, data=None, error=None):
+        '''Set a section, returning whether it changed.'''
+        section = self.snapshot[name]
+        if error is None and data == section['data'] and section['error'] is None:
+            return False
+        if error is not None and error == section['error']:
+            return False
+        self.version += 1
+        section['version'] = self.version
+        section['error'] = error
+        if error is None:
+            section['data'] = data
+        return True
+
+    def failed(self, name, error):
+        if self.update(name, error=str(error)):
+            self.changed()
+
+    def changed(self):
+        '''Answer the requests waiting for a change.'''
+        waiters, self.waiters = self.waiters, []
+        for d in waiters:
+            d.callback(self.version)
+
+    def wait(self, since, timeout=LONG_POLL_TIMEOUT):
+        '''
+        Deferred that fires with the version once it is newer than since,
+        or after timeout seconds.
+        '''
+        if self.version > since:
+            d = Deferred()
+            d.callback(self.version)
+            return d
+        d = Deferred()
+        self.waiters.append(d)
+        def expire():
+            if d in self.waiters:
+                self.waiters.remove(d)
+                d.callback(self.version)
+        call = reactor.callLater(timeout, expire)
+        def cancel(result):
+            if call.active():
+                call.cancel()
+            return result
+        d.addBoth(cancel)
+        return d
+
+    def forget(self, d):
+        '''Stop waiting, e.g. because the client went away.'''
+        if d in self.waiters:
+            self.waiters.remove(d)
+
+    def changes(self, since):
+        '''Sections that changed after version since.'''
+        return dict((name, section) for name, section in self.snapshot.items()
+                    if section['version'] > since)
+
+    @inlineCallbacks
+    def refresh(self):
+        fetchers = [self.fetch_timers, self.fetch_ruox, self.fetch_diodes,
+                    self.fetch_pressures]
+        names = self.sections[:len(fetchers)]
+        results = yield DeferredList([f() for f in fetchers], consumeErrors=True)
+        changed = False
+        for name, (success, result) in zip(names, results):
+            if success:
+                changed |= self.update(name, result)
+            else:
+                changed |= self.update(name, error=str(result.value))
+        if changed:
+            self.changed()
+
+    @inlineCallbacks
+    def fetch_diodes(self):
+        server = self._cxn.lakeshore_diodes
+        p  = server.packet()
+        p.select_device()
+        p.temperatures()
+        result = yield p.send()
+        returnValue([("%d: " % (idx+1,), temp['K'])
+                     for idx, temp in enumerate(result['temperatures'])])
+
+    @inlineCallbacks
+    def fetch_ruox(self):
+        server = self._cxn.lakeshore_ruox
+        p  = server.packet()
+        p.select_device()
+        p.named_temperatures()
+        result = yield p.send()
+        returnValue([("%s: " % (name,), temp['K'])
+                     for name, (temp, dt) in result['named_temperatures']])
+
+    @inlineCallbacks
+    def fetch_timers(self):
+        p = self._cxn.cryo_notifier.packet()
+        p.query_timers()
+        result = yield p.send()
+        now = time.time()
+        old = dict(self.snapshot['timers']['data'])
+        timers = []
+        for (name, t) in result['query_timers']:
+            if t['s'] == 0:
+                # the notifier gives every timer zero when timing is off
+                deadline = None
+            else:
+                deadline = int(round(now + t['s']))
+                if old.get(name) is not None and abs(deadline - old[name]) <= DEADLINE_SLACK:
+                    deadline = old[name]
+            timers.append((name, deadline))
+        returnValue(timers)
+
+    @inlineCallbacks
+    def fetch_pressures(self):
+        p = self._cxn.mks_gauge_server.packet()
+        p.get_gauge_list()
+        p.get_readings()
+        result = yield p.send()
+        returnValue([(name, str(val)) for (name, val) in
+                     zip(result['get_gauge_list'], result['get_readings'])])
+
+    @inlineCallbacks
+    def watch_log(self):
+        '''Read the fill log, and ask the registry to tell us when it changes.'''
+        self.log_ctx = self._cxn.context()
+        self._cxn._cxn.addListener(self.log_changed, source=self._cxn.registry.ID,
+                                   context=self.log_ctx, ID=LOG_CHANGE_MESSAGE)
+        try:
+            p = self._cxn.registry.packet(context=self.log_ctx)
+            p.cd(self.log_path)
+            p.dir()
+            p.notify_on_change(LOG_CHANGE_MESSAGE, True)
+            rv = yield p.send()
+            subdirs, keys = rv['dir']
+            keys = sorted(keys, reverse=True)[:MAX_LOG_ENTRIES]
+            yield self.fetch_log(keys)
+        except Exception as e:
+            self.failed('log', e)
+
+    @inlineCallbacks
+    def fetch_log(self, keys):
+        if keys:
+            p = self._cxn.registry.packet(context=self.log_ctx)
+            for k in keys:
+                p.get(k, key=k)
+            values = yield p.send()
+            for k in keys:
+                self.log_entries[k] = values[k]
+        keys = sorted(self.log_entries, reverse=True)
+        for k in keys[MAX_LOG_ENTRIES:]:
+            del self.log_entries[k]
+        data = [(k,) + tuple(self.log_entries[k]) for k in keys[:MAX_LOG_ENTRIES]]
+        if self.update('log', data):
+            self.changed()
+
+    def log_changed(self, c, (name, isDir, addOrChange)):
+        if isDir:
+            return
+        if addOrChange:
+            d = self.fetch_log([name])
+        else:
+            self.log_entries.pop(name, None)
+            d = self.fetch_log([])
+        d.addErrback(lambda failure: self.failed('log', failure.value))
+
 class CryoStatusPage(Element):
-    loader = XMLFile('cryo_log.xml')
-    def __init__(self, cxn, request):
+    loader = CachedXMLFile(FilePath(__file__).sibling('cryo_log.xml'))
+    def __init__(self, cache, request):
         super(CryoStatusPage, self).__init__()
-        self._cxn = cxn
+        self.cache = cache
         self.cryo_name = request.args.get('cryo', [''])[-1]
         self.max_entries = int(request.args.get('maxentries', ['25'])[-1])
-        self.log_path = ['', 'Servers', 'Cryo Notifier', 'Log' ]
 
-    @inlineCallbacks
-    def get_log(self):
-        p = self._cxn.registry.packet()
-        p.cd(self.log_path)
-        p.dir()
-        p.cd([''])
-        rv = yield p.send()
-        subdirs, keys = rv['dir']
-        keys = sorted(keys, reverse=True)[:self.max_entries]
-        p = self._cxn.registry.packet()
-        p.cd(self.log_path)
-        for k in keys:
-            p.get(k, key=k)
-        p.cd([''])
-        values = yield p.send()
-        result = []
-        for k in keys:
-            result.append((k,) + values[k])
-        returnValue(result)
+    def section(self, name):
+        '''Data of a section of the snapshot, raising its error if it has one.'''
+        section = self.cache.snapshot[name]
+        if section['error'] is not None:
+            raise Exception(section['error'])
+        return section['data']
 
     @render_safe
     def name(self, request, tag):
@@ -109,62 +310,34 @@ class CryoStatusPage(Element):
         else:
             return tag("Unknown")
 
-    @render_safe
-    @inlineCallbacks
-    def Diode(self, request, tag):
-        '''
-        This function has to be different than RuOx because lakeshore_dioes and lakeshore_ruox
-        return data in different formats.  ruox returns a timestamp along with the temperature,
-        diodes does not.
-        '''
-        server = self._cxn.lakeshore_diodes 
-        p  = server.packet()
-        p.select_device()
-        p.temperatures()
-        result = yield p.send()
+    def temperatures(self, name, tag):
         rv = []
-        for idx, temp in enumerate(result['temperatures']):
-            val = temp['K']
+        for channel, val in self.section(name):
             if val<1:
                 val = val*1000
                 unit_str = 'mK'
             else:
                 unit_str = 'K'
-            rv.append(tag.clone().fillSlots(channel="%d: " % (idx+1,), temp="%.3f %s" % (val, unit_str)))
-        returnValue(rv)
-       
+            rv.append(tag.clone().fillSlots(channel=channel, temp="%.3f %s" % (val, unit_str)))
+        return rv
+
+    @render_safe
+    def Diode(self, request, tag):
+        return self.temperatures('diodes', tag)
 
     @render_safe
-    @inlineCallbacks
     def RuOx(self, request, tag):
-        server = self._cxn.lakeshore_ruox
-        p  = server.packet()
-        p.select_device()
-        p.named_temperatures()
-        result = yield p.send()
-        rv = []
-        for idx, (name, (temp, dt)) in enumerate(result['named_temperatures']):
-            val = temp['K']
-            if val<1:
-                val = val*1000
-                unit_str = 'mK'
-            else:
-                unit_str = 'K'
-            rv.append(tag.clone().fillSlots(channel="%s: " % (name,), temp="%.3f %s" % (val, unit_str)))
-        returnValue(rv)
+        return self.temperatures('ruox', tag)
 
     @render_safe
-    @inlineCallbacks
     def timeouts(self, request, tag):
-        p = self._cxn.cryo_notifier.packet()
-        p.query_timers()
-        result = yield p.send()
         rv = []
-        for (name, t) in result['query_timers']:
+        now = time.time()
+        for (name, deadline) in self.section('timers'):
             if self.cryo_name.lower() not in name.lower():
                 continue
+            t = 0 if deadline is None else int(deadline - now)
 
-            t = int(t['s'])
             warning = t < 3600
             sign = '' if t > 0 else '-'
             t = abs(t)
@@ -175,24 +348,18 @@ class CryoStatusPage(Element):
             if warning:
                 time_str = tags.font(time_str, color="#FF0000")
             rv.append(tag.clone().fillSlots(name=name, time=time_str))
-        returnValue(rv)
+        return rv
 
     @render_safe
-    @inlineCallbacks
     def MKS(self, request, tag):
-        p = self._cxn.mks_gauge_server.packet()
-        p.get_gauge_list()
-        p.get_readings()
-        result = yield p.send()
         rv = []
-        for (name, val) in zip(result['get_gauge_list'], result['get_readings']):
-            rv.append(tag.clone().fillSlots(channel=name, pressure=str(val)))
-        returnValue(rv)
+        for (name, val) in self.section('pressures'):
+            rv.append(tag.clone().fillSlots(channel=name, pressure=val))
+        return rv
 
     @render_safe
-    @inlineCallbacks
     def logentries(self, request, tag):
-        logdata = yield self.get_log()
+        logdata = self.section('log')[:self.max_entries]
         rv = [tag.clone().fillSlots(
                 timestamp=tags.b("Fill Time"), 
                 cryo_name=tags.b("Cryo"), 
@@ -208,7 +375,7 @@ class CryoStatusPage(Element):
             except ValueError:
                 pass
             rv.append(tag.clone().fillSlots(timestamp=timestamp, cryo_name=cryo_name, comments=tags.pre(comments)))
-        returnValue(rv)
+        return rv
 
 
 class RootStatusResource(Resource):
@@ -230,23 +397,75 @@ class RootStatusResource(Resource):
         pass
 
 class StatusResource(Resource):
+    '''
+    Renders a page from the status cache.  The ETag is the version of the
+    snapshot and the refresh interval we are in, since the time left on the
+    timers is worked out when the page is rendered, so a client that
+    already has the page gets 304 Not Modified.  Pages are rendered once
+    per ETag and set of query arguments.
+    '''
     isLeaf=True
-    def __init__(self, page_factory, cxn=None):
+    def __init__(self, page_factory, cache=None):
         self.factory = page_factory
-        self.cxn = cxn
+        self.cache = cache
+        self.pages = RenderCache(ttl=60.0)
     def _delayedRender(self, request, data):
         request.write(data)
         request.finish()
-    def set_cxn(self, cxn):
-        self.cxn = cxn
+    def set_cache(self, cache):
+        self.cache = cache
     def render_GET(self, request):
-        if self.cxn is None:
+        if self.cache is None:
             return "Unable to connect to labrad.  Sorry"
-        d = flattenString(None, self.factory(self.cxn, request))
+        request.setHeader('Cache-Control', 'no-cache')
+        tick = int(time.time() // REFRESH_INTERVAL)
+        if request.setETag('"%d-%d"' % (self.cache.version, tick)) == http.CACHED:
+            return ''
+        key = (self.cache.version, tick) + request_key(request)
+        d = self.pages.get(key, lambda: flattenString(None, self.factory(self.cache, request)))
         d.addCallback(lambda data: self._delayedRender(request, data))
         return NOT_DONE_YET
 
-#root = StatusResource(CryoStatusPage, cxn)
+class JSONStatusResource(Resource):
+    '''
+    The status snapshot as JSON:
+
+        {"version": n, "sections": {name: {"version": v, "data": [...], "error": e}}}
+
+    The timers are [name, deadline] pairs, with the deadline in seconds
+    since the epoch, or null if timing is off; the time left is the
+    deadline less the current time.
+
+    With ?since=<version>, only the sections that changed after that
+    version are sent.  If none have, the request is held until one does,
+    or for LONG_POLL_TIMEOUT seconds, so a client can follow the status by
+    repeating the request with the version of the last response.
+    '''
+    isLeaf=True
+    def __init__(self, cache):
+        self.cache = cache
+    def encode(self, since):
+        return json.dumps({'version': self.cache.version,
+                           'sections': self.cache.changes(since)})
+    def _respond(self, request, since):
+        request.write(self.encode(since))
+        request.finish()
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'application/json')
+        request.setHeader('Cache-Control', 'no-cache')
+        if 'since' not in request.args:
+            return self.encode(-1)
+        try:
+            since = int(request.args['since'][-1])
+        except ValueError:
+            request.setResponseCode(400)
+            return json.dumps({'error': "since must be a version number."})
+        d = self.cache.wait(since)
+        request.notifyFinish().addErrback(lambda _: self.cache.forget(d))
+        d.addCallback(lambda _: self._respond(request, since))
+        return NOT_DONE_YET
+
+#root = StatusResource(CryoStatusPage, CryoStatusCache(cxn))
 
 # The next bit here implements authentication  Uncomment it and set the username
 # and password as you see fit to password protect the page.  However, a better
@@ -289,9 +508,13 @@ class HTTPServer(LabradServer):
     """
     name = 'HTTP Server'
 
-    #@inlineCallbacks
+    @inlineCallbacks
     def initServer(self):
-        root = StatusResource(CryoStatusPage, self.client)
+        self.cache = CryoStatusCache(self.client)
+        yield self.cache.start()
+        root = Resource()
+        root.putChild('', StatusResource(CryoStatusPage, self.cache))
+        root.putChild('json', JSONStatusResource(self.cache))
         factory = Site(root)
         reactor.listenTCP(8880, factory)
 
@@ -0,0 +1,222 @@
+#!/usr/bin/python
+from __future__ import division
+
+import json
+import os
+import sys
+import urllib
+
+import numpy as np
+from twisted.internet.interfaces import IPullProducer
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+from zope.interface import implements
+
+# the datavault package lives next to the http directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import datavault
+from datavault import backend, util
+
+#
+# Read-only HTTP/JSON access to the data vault's files, for web dashboards.
+# Mounted at /data by http_server.py:
+#
+#   /data/<dir>/<dir>/             sessions and datasets in a directory
+#   /data/<dir>/<dataset>          title and columns of a dataset
+#   /data/<dir>/<dataset>/rows     the rows of a dataset
+#
+# Datasets can be given by name or number.  Rows take these parameters:
+#
+#   start, stop   range of rows, as for a python slice (default all)
+#   columns       comma separated column indices (default all)
+#   step          send every step'th row from start (default 1)
+#   format        'json' (default) or 'binary', little-endian float64 rows
+#
+# JSON has no NaN or infinity, so non-finite values are sent as null.
+#
+# Rows are read from the csv file a chunk at a time and written as the
+# client takes them, so large datasets are never held in memory.
+#
+
+class GatewayError(Exception):
+    def __init__(self, code, msg):
+        Exception.__init__(self, msg)
+        self.code = code
+
+def read_info(infofile):
+    '''Title and column labels of a dataset, without touching its files.'''
+    S = util.DVSafeConfigParser()
+    S.read(infofile)
+    gen = 'General'
+    independents = []
+    for i in range(S.getint(gen, 'Independent')):
+        sec = 'Independent %d' % (i+1)
+        independents.append(dict(label=S.get(sec, 'Label', raw=True),
+                                 units=S.get(sec, 'Units', raw=True)))
+    dependents = []
+    for i in range(S.getint(gen, 'Dependent')):
+        sec = 'Dependent %d' % (i+1)
+        dependents.append(dict(category=S.get(sec, 'Category', raw=True),
+                               label=S.get(sec, 'Label', raw=True),
+                               units=S.get(sec, 'Units', raw=True)))
+    return dict(title=S.get(gen, 'Title', raw=True),
+                created=S.get(gen, 'Created'),
+                modified=S.get(gen, 'Modified'),
+                independents=independents,
+                dependents=dependents)
+
+def column_labels(info):
+    labels = ['%s [%s]' % (i['label'], i['units']) for i in info['independents']]
+    labels += ['%s (%s) [%s]' % (d['category'], d['label'], d['units'])
+               for d in info['dependents']]
+    return labels
+
+def select_rows(chunks, start, step, columns):
+    '''Every step'th row from start, and only the given columns.'''
+    row = start
+    for chunk in chunks:
+        selected = chunk[(start - row) % step::step]
+        row += len(chunk)
+        if columns is not None:
+            selected = selected[:, columns]
+        if len(selected):
+            yield selected
+
+def json_rows(chunk):
+    '''Rows of a chunk as a JSON list, without the brackets.'''
+    finite = np.isfinite(chunk)
+    if finite.all():
+        rows = chunk.tolist()
+    else:
+        rows = chunk.astype(object)
+        rows[~finite] = None
+        rows = rows.tolist()
+    return json.dumps(rows, allow_nan=False)[1:-1]
+
+class RowProducer(object):
+    '''
+    Writes rows to a request as the client takes them, a chunk at a time.
+    '''
+    implements(IPullProducer)
+
+    def __init__(self, request, chunks, fmt, labels):
+        self.request = request
+        self.chunks = chunks
+        self.fmt = fmt
+        self.labels = labels
+        self.first = True
+
+    def start(self):
+        if self.fmt == 'json':
+            self.request.write('{"columns": %s, "rows": [' % json.dumps(self.labels))
+        self.request.registerProducer(self, False)
+
+    def resumeProducing(self):
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            if self.fmt == 'json':
+                self.request.write(']}')
+            self.request.unregisterProducer()
+            self.request.finish()
+            return
+        if self.fmt == 'json':
+            rows = json_rows(chunk)
+            self.request.write(rows if self.first else ', ' + rows)
+        else:
+            self.request.write(chunk.astype('<f8').tostring())
+        self.first = False
+
+    def stopProducing(self):
+        self.chunks.close()
+
+class DataVaultResource(Resource):
+    '''
+    The resource tree at /data, see the top of this module.
+    '''
+    isLeaf=True
+    def __init__(self, datadir):
+        Resource.__init__(self)
+        self.datadir = datadir
+
+    def render_GET(self, request):
+        try:
+            path = [urllib.unquote(p) for p in request.postpath]
+            if path and path[-1] == '':
+                return self.json(request, self.list_dir(path[:-1]))
+            if path and path[-1] == 'rows':
+                return self.rows(request, path[:-2], path[-2])
+            if not path or self.is_dir(path):
+                # directories are listed at their url with a trailing /
+                request.redirect(request.uri.split('?')[0] + '/')
+                return ''
+            return self.json(request, self.info(path[:-1], path[-1]))
+        except GatewayError as e:
+            request.setResponseCode(e.code)
+            return self.json(request, {'error': str(e)})
+
+    def json(self, request, data):
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps(data)
+
+    def is_dir(self, path):
+        return os.path.isdir(datavault.filedir(self.datadir, [''] + path))
+
+    def list_dir(self, path):
+        if not self.is_dir(path):
+            raise GatewayError(404, "Directory '%s' not found." % '/'.join(path))
+        files = sorted(os.listdir(datavault.filedir(self.datadir, [''] + path)))
+        return dict(path=path,
+                    sessions=[datavault.filename_decode(f[:-4]) for f in files if f.endswith('.dir')],
+                    datasets=[datavault.filename_decode(f[:-4]) for f in files if f.endswith('.csv')])
+
+    def find(self, path, name):
+        '''Base filename of a dataset, given by name or number.'''
+        session_dir = datavault.filedir(self.datadir, [''] + path)
+        if name.isdigit() and os.path.isdir(session_dir):
+            for f in os.listdir(session_dir):
+                if f.endswith('.csv') and f[:5].isdigit() and int(f[:5]) == int(name):
+                    return os.path.join(session_dir, f[:-4])
+        file_base = os.path.join(session_dir, datavault.filename_encode(name))
+        if not os.path.exists(file_base + '.csv'):
+            raise GatewayError(404, "Dataset '%s' not found." % '/'.join(path + [name]))
+        return file_base
+
+    def info(self, path, name):
+        file_base = self.find(path, name)
+        info = read_info(file_base + '.ini')
+        info['name'] = datavault.filename_decode(os.path.basename(file_base))
+        info['columns'] = column_labels(info)
+        return info
+
+    def rows(self, request, path, name):
+        file_base = self.find(path, name)
+        labels = column_labels(read_info(file_base + '.ini'))
+        ncols = len(labels)
+        args = dict((k, v[-1]) for k, v in request.args.items())
+        try:
+            start = int(args.get('start', 0))
+            stop = int(args['stop']) if 'stop' in args else None
+            step = int(args.get('step', 1))
+            columns = None
+            if args.get('columns'):
+                columns = [int(c) for c in args['columns'].split(',')]
+        except ValueError as e:
+            raise GatewayError(400, str(e))
+        fmt = args.get('format', 'json')
+        if fmt not in ('json', 'binary'):
+            raise GatewayError(400, "Unknown format '%s'." % fmt)
+        if start < 0 or step < 1 or (stop is not None and stop < start):
+            raise GatewayError(400, "Bad row range.")
+        if columns is not None:
+            if not all(0 <= c < ncols for c in columns):
+                raise GatewayError(400, "Columns must be from 0 to %d." % (ncols - 1))
+            labels = [labels[c] for c in columns]
+        chunks = backend.readChunks(file_base + '.csv', ncols, start, stop)
+        if fmt == 'json':
+            request.setHeader('Content-Type', 'application/json')
+        else:
+            request.setHeader('Content-Type', 'application/octet-stream')
+            request.setHeader('X-Columns', json.dumps(labels))
+        RowProducer(request, select_rows(chunks, start, step, columns), fmt, labels).start()
+        return NOT_DONE_YET
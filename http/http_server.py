@@ -4,19 +4,22 @@ from __future__ import division
 from twisted.web.server import Site, NOT_DONE_YET
 from twisted.internet import reactor
 from twisted.web.resource import Resource, IResource, NoResource
-from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
-from twisted.web.template import flattenString, renderer
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred, maybeDeferred, succeed
+from twisted.web.template import flattenString, renderer, XMLFile
+from twisted.python.filepath import FilePath
 from labrad.server import LabradServer, setting
 import functools
+import os
 import inspect
 import labrad
+import labrad.util
 from zope.interface import implements
 
 """
 ### BEGIN NODE INFO
 [info]
 name = HTTP Server
-version = 1.0
+version = 1.2
 description = Cryo status information over HTTP
 
 [startup]
@@ -59,6 +62,79 @@ def render_safe(render_method):
         wrapper.__doc__ = "Wrapped by render_safe"
     return renderer(wrapper)
 
+# seconds a rendered page is reused, unless the page module sets render_ttl
+RENDER_TTL = 2.0
+
+class CachedXMLFile(XMLFile):
+    '''
+    Template loader that parses its file once, rather than on every render
+    as XMLFile does, and again only if the file changes.  Flattening never
+    modifies the loaded tags, so they can be shared by every render.
+    '''
+    def __init__(self, path):
+        if not isinstance(path, FilePath):
+            path = FilePath(path)
+        XMLFile.__init__(self, path)
+        self.filepath = path
+        self._loaded = None
+        self._mtime = None
+
+    def load(self):
+        self.filepath.restat()
+        mtime = self.filepath.getModificationTime()
+        if self._loaded is None or mtime != self._mtime:
+            self._loaded = XMLFile.load(self)
+            self._mtime = mtime
+        return self._loaded
+
+class RenderCache(object):
+    '''
+    Rendered pages, kept for ttl seconds.
+
+    Requests for a page that is being rendered wait for that render rather
+    than starting their own, so simultaneous requests cost one render, even
+    with a ttl of zero.
+    '''
+    def __init__(self, ttl=RENDER_TTL, clock=reactor):
+        self.ttl = ttl
+        self.clock = clock
+        self.pages = {} # key -> (expiry time, data)
+        self.waiting = {} # key -> deferreds waiting for a render
+
+    def get(self, key, render):
+        '''
+        Deferred rendered page for key, calling render() if it is not cached.
+        '''
+        now = self.clock.seconds()
+        if key in self.pages and self.pages[key][0] > now:
+            return succeed(self.pages[key][1])
+        d = Deferred()
+        if key in self.waiting:
+            self.waiting[key].append(d)
+            return d
+        self.waiting[key] = [d]
+        rendered = maybeDeferred(render)
+        rendered.addCallbacks(self._rendered, self._failed,
+                              callbackArgs=(key,), errbackArgs=(key,))
+        return d
+
+    def _rendered(self, data, key):
+        now = self.clock.seconds()
+        for k in [k for k, (expires, _) in self.pages.items() if expires <= now]:
+            del self.pages[k]
+        if self.ttl > 0:
+            self.pages[key] = (now + self.ttl, data)
+        for d in self.waiting.pop(key):
+            d.callback(data)
+
+    def _failed(self, failure, key):
+        for d in self.waiting.pop(key):
+            d.errback(failure)
+
+def request_key(request):
+    '''Cache key for the query arguments of a request.'''
+    return tuple(sorted((k, tuple(v)) for k, v in request.args.items()))
+
 class RootStatusResource(Resource):
     '''
     The idea here is to have multiple status pages, each with their
@@ -78,8 +154,9 @@ class RootStatusResource(Resource):
         # 
         # if name=="" we should instead return a dictionary of all known modules
         try:
-            page_factory = __import__("modules.%s"%name, globals=globals(), fromlist=['page_factory']).page_factory
-            child = StatusResource(page_factory, self.cxn)
+            module = __import__("modules.%s"%name, globals=globals(), fromlist=['page_factory'])
+            ttl = getattr(module, 'render_ttl', RENDER_TTL)
+            child = StatusResource(module.page_factory, self.cxn, ttl)
             self.putChild(name, child)
             print "successfully registered resource %s" % name
             return child
@@ -94,20 +171,29 @@ class StatusResource(Resource):
     Generic class for a LabRAD based status page.  It takes a twisted template 'Element' subclass
     and the labrad client connection and uses them to generate a response page.  twisted templates
     can return deferreds, so they work well with LabRAD calls.
+
+    Rendered pages are cached for ttl seconds per set of query arguments.
+    A ttl of None turns the cache off.
     '''
     isLeaf=True
-    def __init__(self, page_factory, cxn=None):
+    def __init__(self, page_factory, cxn=None, ttl=RENDER_TTL):
         self.factory = page_factory
         self.cxn = cxn
+        self.cache = RenderCache(ttl) if ttl is not None else None
     def _delayedRender(self, request, data):
         request.write(data)
         request.finish()
     def set_cxn(self, cxn):
         self.cxn = cxn
+    def render_page(self, request):
+        return flattenString(None, self.factory(self.cxn, request))
     def render_GET(self, request):
         if self.cxn is None:
             return "Unable to connect to labrad.  Sorry"
-        d = flattenString(None, self.factory(self.cxn, request))
+        if self.cache is None:
+            d = self.render_page(request)
+        else:
+            d = self.cache.get(request_key(request), lambda: self.render_page(request))
         d.addCallback(lambda data: self._delayedRender(request, data))
         return NOT_DONE_YET
 
@@ -117,14 +203,40 @@ class HTTPServer(LabradServer):
 
     Currently there are no exported labrad settings.  This is only a server to allow it to
     be easily started and stopped by the node.  
+
+    Data vault datasets are served read-only under /data, see datavault_gateway,
+    if the data vault's repository is on this node.
     """
     name = 'HTTP Server 2'
 
+    @inlineCallbacks
     def initServer(self):
         root = RootStatusResource(self.client)
+        datadir = yield self.dataVaultRepository()
+        if datadir is not None:
+            from datavault_gateway import DataVaultResource
+            root.putChild('data', DataVaultResource(datadir))
         factory = Site(root)
         reactor.listenTCP(8881, factory)
 
+    @inlineCallbacks
+    def dataVaultRepository(self):
+        """Data vault repository for this node from the registry, as the data vault finds it."""
+        path = ['', 'Servers', 'Data Vault', 'Repository']
+        reg = self.client.registry
+        for key in (labrad.util.getNodeName(), '__default__'):
+            try:
+                p = reg.packet()
+                p.cd(path)
+                p.get(key, 's')
+                ans = yield p.send()
+            except Exception:
+                continue
+            if os.path.isdir(ans.get):
+                returnValue(ans.get)
+        print "Data vault repository not found on this node; not serving /data."
+        returnValue(None)
+
 __server__ = HTTPServer()
 
 if __name__ == '__main__':
@@ -1,20 +1,25 @@
 #!/usr/bin/python
 
 from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
-from twisted.web.template import flattenString, Element, renderer, XMLFile, tags
+from twisted.web.template import flattenString, Element, renderer, tags
+from twisted.python.filepath import FilePath
 import datetime
 
-from http_server import render_safe
+from http_server import render_safe, CachedXMLFile
 
 #
 # This file can be used as a template for new status pages.  All you need to is
 # to create a class which can be flattened by twisted.web.template.flattenString
 # and assign it to the module global "page_factory".  Then drop it in the
 # labrad/servers/http/modules directory and it will automatically be served up.   
+# Load templates with CachedXMLFile so they are parsed once, and set the
+# module global "render_ttl" to change how long rendered pages are reused.
 #
 
+render_ttl = 5.0
+
 class CryoStatusPage(Element):
-    loader = XMLFile('cryo_log.xml')
+    loader = CachedXMLFile(FilePath(__file__).sibling('cryo_log.xml'))
     def __init__(self, cxn, request):
         super(CryoStatusPage, self).__init__()
         self._cxn = cxn
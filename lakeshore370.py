@@ -26,6 +26,10 @@
 # Version 2.5.1 Jim Wenner  2014/04/09  If using interpolation, resistances no
 #                                       longer must be monotonically increasing
 # Version 2.6   pomalley    2014/07/10  Made unitses more better
+# Version 2.7                           Calibrations are compiled when loaded
+#                                       and convert whole arrays at once.
+#                                       Added Convert Resistances and
+#                                       Convert Temperatures
 #
 # How to set your Lakeshore 370's Resistance vs. Temperature Curve:
 # Previously, conversion of a resistance to a temperature happened with a hard
@@ -82,7 +86,7 @@
 ### BEGIN NODE INFO
 [info]
 name = Lakeshore RuOx
-version = 2.6.1
+version = 2.7
 description = 
 
 [startup]
@@ -127,6 +131,143 @@ def temp2res(t):
     except Exception:
         return units.Ohm * 0.0
 
+
+def _finite(x):
+    """Replace values that could not be converted by 0, like res2temp."""
+    x = np.array(x, dtype=float)
+    x[~np.isfinite(x)] = 0.0
+    return x
+
+
+def _magnitude(value, unit):
+    """Registry values may or may not have units."""
+    if isinstance(value, U.Value):
+        return value[unit]
+    return float(value)
+
+
+class Calibration(object):
+    """Converts between resistance in Ohm and temperature in K.
+
+    Calibrations are compiled from the registry entries once, when they are
+    loaded, and convert whole arrays at once. Values that cannot be
+    converted come back as 0.
+    """
+    def temperatures(self, r):
+        with np.errstate(all='ignore'):
+            return _finite(self._temperatures(np.asarray(r, dtype=float)))
+
+    def resistances(self, t):
+        with np.errstate(all='ignore'):
+            return _finite(self._resistances(np.asarray(t, dtype=float)))
+
+
+class DefaultCalibration(Calibration):
+    """The res2temp and temp2res functions."""
+    def _temperatures(self, r):
+        return ((np.log(r) - 6.02) / 1.76) ** (-1/.345)
+
+    def _resistances(self, t):
+        return np.exp(1.76*(t**(-0.345)) + 6.02)
+
+    def __str__(self):
+        return "DEFAULT"
+
+
+class InterpolationCalibration(Calibration):
+    """Log-log interpolation of a table of resistances and temperatures."""
+    def __init__(self, resistances, temperatures):
+        self.res = np.asarray(resistances, dtype=float)
+        self.temp = np.asarray(temperatures, dtype=float)
+        order = np.argsort(self.res)
+        self.logRes = np.log(self.res[order])
+        self.logTempByRes = np.log(self.temp[order])
+        order = np.argsort(self.temp)
+        self.logTemp = np.log(self.temp[order])
+        self.logResByTemp = np.log(self.res[order])
+
+    def _temperatures(self, r):
+        return np.exp(np.interp(np.log(r), self.logRes, self.logTempByRes))
+
+    def _resistances(self, t):
+        return np.exp(np.interp(np.log(t), self.logTemp, self.logResByTemp))
+
+    def __str__(self):
+        return "INTERPOLATION --  Resistances: %s -- Temperatures: %s" % \
+            (self.res, self.temp)
+
+
+class VRHoppingCalibration(Calibration):
+    """Variable-range hopping model, R = R0 exp((T0/T)**(1/4))."""
+    def __init__(self, r0, t0):
+        self.r0 = _magnitude(r0, 'Ohm')
+        self.t0 = _magnitude(t0, 'K')
+
+    def _temperatures(self, r):
+        return self.t0 / np.log(r / self.r0)**4
+
+    def _resistances(self, t):
+        return self.r0 * np.exp((self.t0 / t)**.25)
+
+    def __str__(self):
+        return "Variable-range hopping model: r0: %s, t0: %s" % (self.r0, self.t0)
+
+
+class FunctionCalibration(Calibration):
+    """Python expressions from the registry, r -> t and t -> r.
+
+    The expressions are compiled once and evaluated on whole arrays with
+    numpy standing in for math, so math.log(r) becomes np.log(r). If an
+    expression uses something numpy does not have, it is evaluated point by
+    point with math instead.
+    """
+    def __init__(self, function, inverse):
+        self.function = function
+        self.inverse = inverse
+        self._function = compile(function, '<calibration function>', 'eval')
+        self._inverse = compile(inverse, '<calibration inverse>', 'eval')
+
+    def _evaluate(self, code, name, x):
+        try:
+            y = eval(code, {'math': np, 'np': np}, {name: x})
+            return np.broadcast_to(y, x.shape)
+        except Exception:
+            def single(v):
+                try:
+                    return eval(code, {'math': math, 'np': np}, {name: v})
+                except Exception:
+                    return np.nan
+            return np.array([single(v) for v in x.flat]).reshape(x.shape)
+
+    def _temperatures(self, r):
+        return self._evaluate(self._function, 'r', r)
+
+    def _resistances(self, t):
+        return self._evaluate(self._inverse, 't', t)
+
+    def __str__(self):
+        return "FUNCTION: %s -- Inverse: %s" % (self.function, self.inverse)
+
+
+def compileCalibration(calibration):
+    """Compile a calibration as returned by loadSingleCalibration.
+
+    Returns None for DEFAULT, which means fall back to the next calibration.
+    """
+    kind = calibration[0]
+    if kind == INTERPOLATION:
+        return InterpolationCalibration(calibration[1], calibration[2])
+    elif kind == VRHOPPING:
+        return VRHoppingCalibration(calibration[1], calibration[2])
+    elif kind == FUNCTION:
+        return FunctionCalibration(calibration[1], calibration[2])
+    elif kind == DEFAULT:
+        return None
+    raise Exception('Invalid calibration type %s' % (kind,))
+
+
+DEFAULT_CALIBRATION = DefaultCalibration()
+
 class RuOxWrapper(GPIBDeviceWrapper):
     
     @inlineCallbacks
@@ -234,23 +375,23 @@ class RuOxWrapper(GPIBDeviceWrapper):
     def printCalibration(self, channel):
         str = ''
         try:
-            if self.calibrations[channel][0] == INTERPOLATION:
-                str = "INTERPOLATION --  Resistances: %s -- Temperatures: %s"%\
-                (self.calibrations[channel][1], self.calibrations[channel][2])
-            elif self.calibrations[channel][0] == VRHOPPING:
-                str = "Variable-range hopping model: r0: %s, t0: %s" % (self.calibrations[channel][1], self.calibrations[channel][2])
-            elif self.calibrations[channel][0] == FUNCTION:
-                str = "FUNCTION: %s -- Inverse: %s" %\
-                (self.calibrations[channel][1], self.calibrations[channel][2])
-            elif self.calibrations[channel][0] == DEFAULT:
-                str = "DEFAULT"
-            else:
-                raise Exception('Invalid calibration for channel %s: "%s"' %\
-                                   (channel, str))
+            compiled = self.compiled[channel]
+            str = "DEFAULT" if compiled is None else compiled.__str__()
         except Exception as e:
             str += e.__str__()
             
         return str
+
+    def calibration(self, channel):
+        """The compiled calibration for a channel.
+
+        Channels without a calibration use the device default, and if there
+        is none of those either, the server default (res2temp).
+        """
+        for index in (channel, 0):
+            if index < len(self.compiled) and self.compiled[index] is not None:
+                return self.compiled[index]
+        return DEFAULT_CALIBRATION
     
     @inlineCallbacks
     def reloadCalibrations(self, dir):
@@ -309,6 +450,7 @@ class RuOxWrapper(GPIBDeviceWrapper):
                 print "%s -- found FUNCTION calibration for channel %d." % (self.addr, i+1)
             else:
                 raise Exception("Calibration loader messed up. This shouldn't have happened.")
+        self.compiled = [compileCalibration(cal) for cal in self.calibrations]
     
     def shutdown(self):
         self.alive = False
@@ -381,39 +523,8 @@ class RuOxWrapper(GPIBDeviceWrapper):
         if calIndex == -1:
             calIndex = channel
         try:
-            #print("lakeshore370: Computing temperature for channel %d"%channel)
-            #print("Resistance is %s"%str(self.readings[channel][0]))
-            #print("Calibration type %s" % (self.calibrations[calIndex][0],))
-            #print self.calibrations[calIndex]
-            if self.calibrations[calIndex][0] == INTERPOLATION:
-                # log-log interpolation
-                return (np.exp(np.interp(np.log(self.readings[channel][0]['Ohm']),
-                              np.log(np.array(self.calibrations[calIndex][1])),
-                              np.log(np.array(self.calibrations[calIndex][2]))
-                              ))) * K
-            elif self.calibrations[calIndex][0] == VRHOPPING:
-                T0 = self.calibrations[calIndex][2]
-                R0 = self.calibrations[calIndex][1]
-                res = self.readings[channel][0]
-                T = T0 / (np.log(R0/res)**4)
-                return T
-            elif self.calibrations[calIndex][0] == FUNCTION:
-                # hack alert--using eval is bad:
-                # (1) This depends on the function string being good python
-                #     code.
-                # (2) It also depends on it having "r" as the variable for 
-                #     resistance, in ohms.
-                # (3) very unsafe if anyone ever hacks the registry. of course,
-                #     then we have bigger problems
-                r = self.readings[channel][0][units.Ohm]
-                return eval(self.calibrations[calIndex][1]) * units.K
-            elif self.calibrations[calIndex][0] == DEFAULT:
-                if calIndex > 0:
-                    # use calibration 0--the device calibration
-                    return self.getSingleTemp(channel, 0) 
-                else:
-                    #If there is no calibration at all use res2temp
-                    return res2temp(self.readings[channel][0])
+            r = self.readings[channel][0]['Ohm']
+            return float(self.calibration(calIndex).temperatures(r)) * K
         except Exception as e:
             print "Exception getting temperature: ", e
             return 0.0*K
@@ -454,23 +565,7 @@ class RuOxWrapper(GPIBDeviceWrapper):
         if calIndex == -1:
             calIndex = channel
         try:
-            if self.calibrations[calIndex][0] == INTERPOLATION:
-                # do the log-log interpolation in reverse
-                return (np.exp(np.interp(np.log(temp),
-                                            np.log(np.array(self.calibrations[calIndex][2][::-1])),
-                                            np.log(np.array(self.calibrations[calIndex][1][::-1]))
-                                            )))
-            elif self.calibrations[calIndex][0] == VRHOPPING:
-                return self.calibrations[calIndex][1]['K'] * np.exp((self.calibrations[calIndex][2]['K']/temp)**.25)
-            elif self.calibrations[calIndex][0] == FUNCTION:
-                # same as getSingleTemp, but use inverse instead of function
-                t = temp
-                return eval(self.calibrations[calIndex][2])
-            elif eslf.calibrations[calIndex][0] == DEFAULT:
-                if calIndex > 0:
-                    return self.singleTempToRes(temp, channel, 0) # use calibration 0
-                else:
-                    return temp2res(temp) # if no calibration for the device either, use old-fashioned temp2res
+            return float(self.calibration(calIndex).resistances(temp))
         except Exception as e:
             print "Exception converting temp to res: %s" % e.__str__()
             return 0.0
@@ -566,6 +661,27 @@ class LakeshoreRuOxServer(GPIBManagedServer):
         dev = self.selectedDevice(c)
         dev.reloadCalibrations()
     
+    @setting(24, 'Convert Resistances', channel='w', resistances='*v[Ohm]',
+             returns='*v[K]')
+    def convert_resistances(self, c, channel, resistances):
+        """Convert resistances to temperatures with a channel's calibration.
+
+        Use channel 0 for the device default calibration. Resistances that
+        cannot be converted give 0 K.
+        """
+        dev = self.selectedDevice(c)
+        return dev.calibration(channel).temperatures(resistances['Ohm']) * K
+
+    @setting(25, 'Convert Temperatures', channel='w', temperatures='*v[K]',
+             returns='*v[Ohm]')
+    def convert_temperatures(self, c, channel, temperatures):
+        """Convert temperatures to resistances with a channel's calibration.
+
+        The inverse of Convert Resistances.
+        """
+        dev = self.selectedDevice(c)
+        return dev.calibration(channel).resistances(temperatures['K']) * Ohm
+    
     @setting(23, 'Print Settings', returns='s')
     def print_settings(self, c):
         """Prints the settings loaded from the registry for this device."""
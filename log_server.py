@@ -17,8 +17,8 @@
 ### BEGIN NODE INFO
 [info]
 name = Logger
-version = 1.0
-description = Manages log files with the data vault and registry.
+version = 1.2
+description = Stores and retrieves time-stamped log entries.
 
 [startup]
 cmdline = %PYTHON% %FILE%
@@ -30,40 +30,113 @@ timeout = 5
 ### END NODE INFO
 """
 
-from labrad.server import LabradServer, setting, inlineCallbacks, returnValue
-from labrad.units import degC, K, psi, torr, min as minutes, A
+from __future__ import with_statement
+
+import os
+
+from twisted.internet.task import LoopingCall
+
+from labrad import types as T
+from labrad.server import LabradServer, Signal, setting, inlineCallbacks, returnValue
+from labrad.units import Value
+import labrad.util
 
 from datetime import datetime
 
-# registry (metadata about logs and nonnumeric logs)
-# Logs -> {logPath} -> {YYYY} -> {MM} -> {DD}
+import logstore
+from logstore import errors
 
-# data vault (for logging of numerical data)
-# Logs -> {logPath} -> {YYYY} -> {MM} -> {DD}
+# logs are stored in the repository directory, see the logstore module:
+# {logPath}.dir -> log.ini, {YYYY} -> {MM} -> {DD} -> {channel}.time, .data
 
-class Log(object):
-    def __new__(self):
-        pass
 
-    def __getitem__(self, key):
-        """Get or create a variable with the specified key."""
+def logPathOf(logPath):
+    """Log path as a tuple, from a '/' separated string or a list."""
+    if isinstance(logPath, str):
+        return tuple(p for p in logPath.split('/') if p)
+    return tuple(logPath)
 
-class Channel(object):
-    def __new__(self):
-        pass
-    
-    def __init__(self):
-        pass
+def unitOf(tag):
+    """Units of a type tag, e.g. 'K' for 'v[K]', or '' if it has none."""
+    if '[' in tag:
+        return tag.split('[', 1)[1].rstrip(']')
+    return ''
+
+def toStored(tag, value):
+    """Convert a value to the stored type of a channel with the given tag."""
+    base = logstore.baseType(tag)
+    if base == 'v':
+        unit = unitOf(tag)
+        return value[unit] if unit else float(value)
+    if base == 't':
+        return logstore.toSeconds(value)
+    if base in ('i', 'w'):
+        return int(value)
+    if base == 'b':
+        return bool(value)
+    return str(value)
+
+def fromStored(tag, values):
+    """Convert stored values back to a list of LabRAD values."""
+    base = logstore.baseType(tag)
+    if base == 'v':
+        unit = unitOf(tag)
+        if unit:
+            return [Value(v, unit) for v in values.tolist()]
+    if base == 't':
+        return [logstore.fromSeconds(s) for s in values.tolist()]
+    if base == 's':
+        return values
+    return values.tolist()
 
-    def addEntry(self, time, value):
-        """Add an entry for this channel."""
 
 class Logger(LabradServer):
     name = 'Logger'
+    # seconds between writes of the entries kept in memory
+    flushInterval = 1.0
 
     @inlineCallbacks
     def initServer(self):
-        pass
+        root = yield self.loadRepository()
+        if not os.path.exists(root):
+            os.makedirs(root)
+        self.store = logstore.LogStore(root)
+        self.flushLoop = LoopingCall(self.store.flush)
+        self.flushLoop.start(self.flushInterval, now=False)
+
+    @inlineCallbacks
+    def loadRepository(self):
+        """Get the repository directory from the registry, as the data vault does."""
+        path = ['', 'Servers', self.name, 'Repository']
+        reg = self.client.registry
+        root = None
+        for key in (labrad.util.getNodeName(), '__default__'):
+            try:
+                p = reg.packet()
+                p.cd(path)
+                p.get(key, 's')
+                ans = yield p.send()
+                root = ans.get
+                break
+            except Exception:
+                pass
+        if root is None:
+            root = os.path.join(os.path.split(__file__)[0], '__logs__')
+            print 'Could not load repository location from registry.'
+            print 'Using', root
+            print 'To change this, set the registry keys at', path
+        returnValue(root)
+
+    def stopServer(self):
+        if hasattr(self, 'flushLoop') and self.flushLoop.running:
+            self.flushLoop.stop()
+        if hasattr(self, 'store'):
+            self.store.flush()
+
+    def expireContext(self, c):
+        """Stop sending any signals to this context."""
+        for log in self.store.logs.values():
+            log.listeners.discard(c.ID)
 
     onNewLog = Signal(654321, 'signal: new log', '*s')
     onNewVar = Signal(654322, 'signal: new channel', 'ss')
@@ -71,19 +144,36 @@ class Logger(LabradServer):
 
     def getLog(self, c):
         if 'log' not in c:
-            raise Exception('No log opened in this context.')
+            raise errors.NoLogError()
         return c['log']
 
-    @setting(1, 'list', filters=['s', '*s'])
-    def get_log_list(self, c, filters):
+    def describeLog(self, log):
+        channels = []
+        for ch in log.channels.values():
+            start = ch.start if ch.start is not None else log.created
+            last = ch.last if ch.last is not None else log.created
+            channels.append((ch.name, ch.tag, logstore.fromSeconds(start),
+                             logstore.fromSeconds(last)))
+        return (logstore.fromSeconds(log.created),
+                logstore.fromSeconds(log.last), channels)
+
+    @setting(1, 'list', filters=['s', '*s'], returns='*s')
+    def get_log_list(self, c, filters=[]):
         """Get a list of available logs matching the given filters.
+
+        A log matches if its path, joined with '/', contains
+        every one of the filter strings.
         """
+        if isinstance(filters, str):
+            filters = [filters]
+        return ['/'.join(path) for path in self.store.list(filters)]
 
     @setting(2, 'describe', logPath=['s', '*s'],
-             returns='t{start} t{last} *(s{name} s{type} t{start} t{last}')
+             returns='t{start} t{last} *(s{name} s{type} t{start} t{last})')
     def describe(self, c, logPath):
         """Get information about the specified log.
         """
+        return self.describeLog(self.store.get(logPathOf(logPath)))
     
     @setting(100, 'open', logPath=['s', '*s'], create='b',
              returns='t{start} t{last} *(s{name} s{type} t{start} t{last})')
@@ -96,6 +186,16 @@ class Logger(LabradServer):
         Returns the start time of the log, as well as a list
         with the name and type tag of each channel in the log.
         """
+        path = logPathOf(logPath)
+        new = not self.store.exists(path)
+        log = self.store.get(path, create)
+        if 'log' in c and c['log'] is not log:
+            c['log'].listeners.discard(c.ID)
+        c['log'] = log
+        c.pop('get', None)
+        if new:
+            self.onNewLog(list(path))
+        return self.describeLog(log)
 
     @setting(300, 'log', data='?: ((s?)(s?)...)', returns='')
     def log_data(self, c, data):
@@ -110,9 +210,17 @@ class Logger(LabradServer):
         name must have the same type.
         """
         log = self.getLog(c)
-        t = datetime.now()
+        t = logstore.toSeconds(datetime.now())
         for key, value in data:
-            log[key].addEntry(t, value)
+            if key in log.channels:
+                channel = log.channels[key]
+            else:
+                channel = log.channel(key, str(T.getType(value)))
+                self.onNewVar(('/'.join(log.path), key))
+            channel.add(t, toStored(channel.tag, value))
+        listeners, log.listeners = log.listeners, set()
+        if listeners:
+            self.onNewData(None, listeners)
 
     @setting(400, 'get',
              channels=['s', '*s'], range=['t', 'tt'], limit='w',
@@ -134,9 +242,101 @@ class Logger(LabradServer):
         given list.  If there is more data available beyond the limit,
         a 'new data' message will be fired to listeners signed up for
         the message.  This is the same 'streaming' protocol used by
-        clients of the data vault.
+        clients of the data vault.  Use 'get next' to read the rest.
+        """
+        log = self.getLog(c)
+        if isinstance(channels, str):
+            channels = [channels]
+        if isinstance(range, tuple):
+            start, end = range
+            end = logstore.toSeconds(end)
+        else:
+            start, end = range, None
+        start = logstore.toSeconds(start)
+        chans = [log.channel(name) for name in channels]
+        c['get'] = {
+            'channels': chans,
+            'cursors': [ch.seek(start) for ch in chans],
+            'end': end,
+            'limit': limit,
+        }
+        return self.readMore(c, log)
+
+    @setting(401, 'get next', limit='w', returns='?: (*(t?)*(t?)...)')
+    def get_next(self, c, limit=None):
+        """Get the log entries after those returned by the last get.
+
+        Returns entries up to the end of the range of the last get in
+        this context, or all new entries if it was left open, with at
+        most limit entries in each list (by default the limit of the get).
+        """
+        log = self.getLog(c)
+        if 'get' not in c:
+            raise Exception('No get in progress in this context.')
+        if limit is not None:
+            c['get']['limit'] = limit
+        return self.readMore(c, log)
+
+    @setting(402, 'get rollup',
+             channels=['s', '*s'], range='tt', points='w',
+             returns='v[s]{resolution} ?{(*(t{time} v{min} v{max} v{mean})...)}')
+    def get_rollup(self, c, channels, range, points=1000):
+        """Get a summary of numeric log entries in the specified range of time.
+
+        Returns the resolution used, and a cluster with a list of
+        (time, min, max, mean) for each channel requested.  The
+        resolution is the finest of the entries themselves (0 s) and
+        the 1 min, 10 min and 1 h rollups with at most the given number
+        of points in every list, so that long ranges can be plotted
+        without sending every entry.  Times are the start of each bucket.
         """
-        
+        log = self.getLog(c)
+        if isinstance(channels, str):
+            channels = [channels]
+        start, end = [logstore.toSeconds(t) for t in range]
+        chans = [log.channel(name) for name in channels]
+        for channel in chans:
+            if not channel.rolledUp:
+                raise errors.NoRollupsError(channel.name)
+        res = max(channel.resolution(start, end, points) for channel in chans)
+        result = []
+        for channel in chans:
+            if res:
+                records = channel.rollups(res, start, end)
+                times = records['time']
+                columns = [records['min'], records['max'], records['mean']]
+            else:
+                times, values, cursor, more = channel.read(channel.seek(start), end)
+                columns = [values.astype(float)] * 3
+            unit = unitOf(channel.tag)
+            tag = 'v[%s]' % unit if unit else 'v'
+            times = [logstore.fromSeconds(s) for s in times.tolist()]
+            result.append(zip(times, *[fromStored(tag, col) for col in columns]))
+        return Value(res, 's'), tuple(result)
+
+    def readMore(self, c, log):
+        """Read from the cursors of the current get and move them on.
+
+        If entries were left unread because of the limit, 'new data'
+        is sent to this context right away, as the data vault does
+        when streaming.  Otherwise, if the get is open, this context
+        is notified when more entries are logged.
+        """
+        get = c['get']
+        result = []
+        more = False
+        for i, channel in enumerate(get['channels']):
+            times, values, get['cursors'][i], chMore = \
+                channel.read(get['cursors'][i], get['end'], get['limit'])
+            more = more or chMore
+            times = [logstore.fromSeconds(s) for s in times.tolist()]
+            result.append(zip(times, fromStored(channel.tag, values)))
+        if more:
+            self.onNewData(None, [c.ID])
+        elif get['end'] is None:
+            log.listeners.add(c.ID)
+        return tuple(result)
+
 #####
 # Create a server instance and run it
 
@@ -145,5 +345,3 @@ __server__ = Logger()
 if __name__ == '__main__':
     from labrad import util
     util.runServer(__server__)
-
-
@@ -0,0 +1,503 @@
+"""Append-only time series storage for the Logger server.
+
+Each log is a directory in the repository, with one level per element of
+its path as in the data vault. It holds log.ini, with the type and time
+range of each channel, and one directory per day, YYYY/MM/DD, with the
+entries logged on that day. There each channel has two columns of fixed
+size binary records:
+
+    <channel>.time  float64 seconds since 1970-01-01, in local time
+    <channel>.data  the values, with the dtype for the channel's type tag
+
+String channels keep their text in <channel>.text, and <channel>.data
+holds the offset and length of each string in it.
+
+Entries are only ever appended, in time order, so the entries in a time
+range are found by bisecting the list of days and then the times of each
+day, which are memory mapped rather than read.
+
+Numeric channels also keep rollups, the min, max and mean of the entries
+in each bucket of 1 min, 10 min and 1 h, in <channel>.rollup<seconds>.
+A bucket is written once an entry falls in a later one, so long ranges
+can be read at a coarser resolution without reading every entry.
+"""
+
+import bisect
+from collections import OrderedDict
+import ConfigParser
+from datetime import date, datetime, timedelta
+import os
+from urllib import quote, unquote
+
+import numpy as np
+
+from . import errors
+
+EPOCH = datetime(1970, 1, 1)
+DAY = 24 * 60 * 60
+
+INFO_FILE = 'log.ini'
+
+TIME_DTYPE = np.dtype('<f8')
+TEXT_DTYPE = np.dtype([('offset', '<i8'), ('length', '<i4')])
+# dtype of the stored values for each type tag, without units
+DTYPES = {
+    'v': np.dtype('<f8'),
+    'i': np.dtype('<i4'),
+    'w': np.dtype('<u4'),
+    'b': np.dtype('?'),
+    't': np.dtype('<f8'),
+    's': TEXT_DTYPE,
+}
+
+# entries kept in memory per channel before they are written to disk
+FLUSH_SIZE = 1000
+
+# bucket sizes in seconds of the rollups of numeric channels, finest first;
+# each divides a day so that no bucket spans two days
+ROLLUP_RESOLUTIONS = [60, 600, 3600]
+ROLLUP_TYPES = ('v', 'i', 'w')
+# time is the start of the bucket
+ROLLUP_DTYPE = np.dtype([('time', '<f8'), ('min', '<f8'), ('max', '<f8'),
+                         ('mean', '<f8'), ('count', '<u4')])
+
+
+def toSeconds(t):
+    """Seconds since the epoch of a naive datetime."""
+    return (t - EPOCH).total_seconds()
+
+def fromSeconds(s):
+    return EPOCH + timedelta(seconds=s)
+
+def baseType(tag):
+    """The type tag without units, e.g. 'v' for 'v[K]'."""
+    return tag.split('[', 1)[0]
+
+def dayOf(seconds):
+    """Days since the epoch."""
+    return int(seconds // DAY)
+
+def dayDir(day):
+    d = date.fromordinal(EPOCH.toordinal() + day)
+    return os.path.join('%04d' % d.year, '%02d' % d.month, '%02d' % d.day)
+
+def quoteName(name):
+    """Quote a log path element or channel name for use as a filename."""
+    return quote(name, safe=' ')
+
+def logDir(root, path):
+    return os.path.join(root, *[quoteName(p) + '.dir' for p in path])
+
+
+def rollupExt(res):
+    return '.rollup%d' % res
+
+def rollup(times, values, res):
+    """Rollup records of entries, which must be in time order."""
+    if not len(times):
+        return np.zeros(0, ROLLUP_DTYPE)
+    values = np.asarray(values, float)
+    buckets = np.floor(np.asarray(times) / res) * res
+    starts = np.concatenate(([0], np.nonzero(np.diff(buckets))[0] + 1))
+    records = np.zeros(len(starts), ROLLUP_DTYPE)
+    records['time'] = buckets[starts]
+    records['min'] = np.minimum.reduceat(values, starts)
+    records['max'] = np.maximum.reduceat(values, starts)
+    records['count'] = np.diff(np.append(starts, len(values)))
+    records['mean'] = np.add.reduceat(values, starts) / records['count']
+    return records
+
+def mergeRollups(a, b):
+    """Combine two rollup records of the same bucket."""
+    merged = a.copy()
+    merged['min'] = np.minimum(a['min'], b['min'])
+    merged['max'] = np.maximum(a['max'], b['max'])
+    merged['count'] = a['count'] + b['count']
+    merged['mean'] = (a['mean'] * a['count'] + b['mean'] * b['count']) / merged['count']
+    return merged
+
+
+def readColumn(filename, dtype):
+    """Memory map a column file, which may not exist yet."""
+    n = os.path.getsize(filename) // dtype.itemsize if os.path.exists(filename) else 0
+    if n == 0:
+        return np.zeros(0, dtype)
+    return np.memmap(filename, dtype, 'r', shape=(n,))
+
+def appendColumn(filename, data):
+    with open(filename, 'ab') as f:
+        f.write(data.tostring())
+
+
+class Channel(object):
+    """One named and typed series of (time, value) entries in a log."""
+
+    def __init__(self, log, name, tag, start=None, last=None):
+        self.log = log
+        self.name = name
+        self.tag = tag
+        self.dtype = DTYPES[baseType(tag)]
+        self.text = baseType(tag) == 's'
+        # times of the first and last entries, in seconds
+        self.start = start
+        self.last = last
+        # time of the last entry written to disk
+        self.flushed = last
+        # entries that are not written yet
+        self._times = []
+        self._values = []
+        self.rolledUp = baseType(tag) in ROLLUP_TYPES
+        # the last bucket of each rollup, which may get more entries,
+        # loaded from disk when first needed
+        self._open = None
+
+    def filename(self, day, ext):
+        return os.path.join(self.log.dir, dayDir(day), quoteName(self.name) + ext)
+
+    def add(self, t, value):
+        """Add an entry at t seconds.
+
+        Times must not go backwards, so that they can be bisected. If they
+        do, e.g. because the clock was set back, the entry is logged at the
+        time of the last one.
+        """
+        if self.last is not None and t < self.last:
+            t = self.last
+        if self.start is None:
+            self.start = t
+        self.last = t
+        self._times.append(t)
+        self._values.append(value)
+        if len(self._times) >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Write the entries kept in memory. Returns whether there were any."""
+        if self.rolledUp and self._open is None:
+            self._open = self._loadRollups()
+        if not self._times:
+            return False
+        times = np.array(self._times, TIME_DTYPE)
+        values = self._values
+        self._times, self._values = [], []
+        if not self.text:
+            values = np.array(values, self.dtype)
+        days = (times // DAY).astype(int)
+        for day in np.unique(days):
+            day = int(day)
+            selected = np.nonzero(days == day)[0]
+            self.log.addDay(day)
+            appendColumn(self.filename(day, '.time'), times[selected])
+            if self.text:
+                self._appendText(day, [values[i] for i in selected])
+            else:
+                appendColumn(self.filename(day, '.data'), values[selected])
+            if self.rolledUp:
+                self._rollUp(times[selected], values[selected])
+        self.flushed = times[-1]
+        return True
+
+    def _loadRollups(self):
+        """Find the last bucket of each rollup from the written entries.
+
+        Buckets are only written once they are complete, so the entries
+        after the last written bucket of the last day are rolled up again.
+        """
+        buckets = {}
+        if self.flushed is None:
+            return buckets
+        day = dayOf(self.flushed)
+        t = self.times(day)
+        for res in ROLLUP_RESOLUTIONS:
+            written = readColumn(self.filename(day, rollupExt(res)), ROLLUP_DTYPE)
+            since = written['time'][-1] + res if len(written) else day * DAY
+            i = int(np.searchsorted(t, since, 'left'))
+            if i < len(t):
+                records = rollup(t[i:], self.values(day, i, len(t)), res)
+                self._writeRollups(res, records[:-1])
+                buckets[res] = records[-1:]
+        return buckets
+
+    def _rollUp(self, times, values):
+        """Add entries from one day to the rollups.
+
+        Writes the buckets before the one of the last entry, which is kept
+        in memory as it may get more entries.
+        """
+        for res in ROLLUP_RESOLUTIONS:
+            records = rollup(times, values, res)
+            last = self._open.get(res)
+            if last is not None:
+                if last['time'][0] == records['time'][0]:
+                    records[:1] = mergeRollups(last, records[:1])
+                else:
+                    self._writeRollups(res, last)
+            self._writeRollups(res, records[:-1])
+            self._open[res] = records[-1:]
+
+    def _writeRollups(self, res, records):
+        if len(records):
+            day = dayOf(records['time'][0])
+            appendColumn(self.filename(day, rollupExt(res)), records)
+
+    def _appendText(self, day, strings):
+        textFile = self.filename(day, '.text')
+        offset = os.path.getsize(textFile) if os.path.exists(textFile) else 0
+        records = np.zeros(len(strings), TEXT_DTYPE)
+        records['length'] = [len(s) for s in strings]
+        records['offset'] = offset + np.cumsum(records['length']) - records['length']
+        with open(textFile, 'ab') as f:
+            f.write(''.join(strings))
+        appendColumn(self.filename(day, '.data'), records)
+
+    def times(self, day):
+        return readColumn(self.filename(day, '.time'), TIME_DTYPE)
+
+    def values(self, day, start, stop):
+        data = np.array(readColumn(self.filename(day, '.data'), self.dtype)[start:stop])
+        if not self.text:
+            return data
+        if not len(data):
+            return []
+        first = data['offset'][0]
+        with open(self.filename(day, '.text'), 'rb') as f:
+            f.seek(first)
+            text = f.read(data['offset'][-1] + data['length'][-1] - first)
+        return [text[o - first:o - first + n] for o, n in data]
+
+    def seek(self, t):
+        """A cursor at the first entry at or after t seconds.
+
+        A cursor is a (day, index) pair, and stays valid as entries are
+        added, so reading can carry on from it later.
+        """
+        self.flush()
+        day = dayOf(t)
+        return (day, int(np.searchsorted(self.times(day), t, 'left')))
+
+    def read(self, cursor, end=None, limit=None):
+        """Read entries from cursor up to and including time end.
+
+        Reads at most limit entries. Returns (times, values, cursor, more)
+        where cursor is where to carry on reading and more tells whether
+        entries up to end were left unread because of the limit.
+        """
+        self.flush()
+        cursorDay, index = cursor
+        days = self.log.days
+        times, values = [], []
+        n = 0
+        for day in days[bisect.bisect_left(days, cursorDay):]:
+            if end is not None and day * DAY > end:
+                break
+            if limit is not None and n >= limit:
+                break
+            start = index if day == cursorDay else 0
+            t = self.times(day)
+            stop = len(t)
+            if end is not None:
+                stop = int(np.searchsorted(t, end, 'right'))
+            if limit is not None:
+                stop = min(stop, start + limit - n)
+            if stop > start:
+                times.append(np.array(t[start:stop]))
+                values.append(self.values(day, start, stop))
+                n += stop - start
+            cursor = (day, max(start, stop))
+        more = limit is not None and n >= limit and self._hasMore(cursor, end)
+        times = np.concatenate(times) if times else np.zeros(0, TIME_DTYPE)
+        if self.text:
+            values = sum(values, [])
+        elif values:
+            values = np.concatenate(values)
+        else:
+            values = np.zeros(0, self.dtype)
+        return times, values, cursor, more
+
+    def count(self, start, end):
+        """Number of entries from start to end seconds, inclusive."""
+        self.flush()
+        n = 0
+        for day in self._days(start, end):
+            t = self.times(day)
+            n += int(np.searchsorted(t, end, 'right') - np.searchsorted(t, start, 'left'))
+        return n
+
+    def rollups(self, res, start, end):
+        """Rollup records of the buckets of res seconds that overlap start to end.
+
+        The last bucket is included even though it may not be complete.
+        """
+        self.flush()
+        records = []
+        for day in self._days(start, end):
+            written = readColumn(self.filename(day, rollupExt(res)), ROLLUP_DTYPE)
+            i = np.searchsorted(written['time'], start - res, 'right')
+            j = np.searchsorted(written['time'], end, 'right')
+            records.append(np.array(written[i:j]))
+        last = self._open.get(res)
+        if last is not None and last['time'][0] + res > start and last['time'][0] <= end:
+            records.append(last)
+        if not records:
+            return np.zeros(0, ROLLUP_DTYPE)
+        return np.concatenate(records)
+
+    def resolution(self, start, end, points):
+        """The finest resolution with at most points entries from start to end.
+
+        Returns 0 if the entries themselves fit, otherwise the size of the
+        smallest rollup bucket that does, or failing that the largest.
+        """
+        if not self.rolledUp or self.count(start, end) <= points:
+            return 0
+        for res in ROLLUP_RESOLUTIONS:
+            if (end // res - start // res) + 1 <= points:
+                return res
+        return ROLLUP_RESOLUTIONS[-1]
+
+    def _days(self, start, end):
+        days = self.log.days
+        return days[bisect.bisect_left(days, dayOf(start)):
+                    bisect.bisect_right(days, dayOf(end))]
+
+    def _hasMore(self, cursor, end):
+        cursorDay, index = cursor
+        days = self.log.days
+        for day in days[bisect.bisect_left(days, cursorDay):]:
+            if end is not None and day * DAY > end:
+                return False
+            t = self.times(day)
+            start = index if day == cursorDay else 0
+            if start < len(t):
+                return end is None or t[start] <= end
+        return False
+
+
+class Log(object):
+    """A set of channels logged together, stored in one directory."""
+
+    def __init__(self, root, path, create=False):
+        self.path = tuple(path)
+        self.dir = logDir(root, path)
+        self.infofile = os.path.join(self.dir, INFO_FILE)
+        self.channels = OrderedDict()
+        # contexts to notify when entries are added
+        self.listeners = set()
+        if os.path.exists(self.infofile):
+            self.load()
+        elif create:
+            if not os.path.exists(self.dir):
+                os.makedirs(self.dir)
+            self.created = toSeconds(datetime.now())
+            self.save()
+        else:
+            raise errors.LogNotFoundError(self.path)
+        self.days = self._findDays()
+
+    def load(self):
+        S = ConfigParser.RawConfigParser()
+        S.read(self.infofile)
+        self.created = S.getfloat('Log', 'Created')
+        for i in range(S.getint('Log', 'Channels')):
+            sec = 'Channel %d' % (i + 1)
+            start = last = None
+            if S.has_option(sec, 'Start'):
+                start = S.getfloat(sec, 'Start')
+                last = S.getfloat(sec, 'Last')
+            name = S.get(sec, 'Name', raw=True)
+            self.channels[name] = Channel(self, name, S.get(sec, 'Type', raw=True),
+                                          start, last)
+
+    def save(self):
+        S = ConfigParser.RawConfigParser()
+        S.add_section('Log')
+        S.set('Log', 'Created', repr(self.created))
+        S.set('Log', 'Channels', repr(len(self.channels)))
+        for i, channel in enumerate(self.channels.values()):
+            sec = 'Channel %d' % (i + 1)
+            S.add_section(sec)
+            S.set(sec, 'Name', channel.name)
+            S.set(sec, 'Type', channel.tag)
+            if channel.start is not None:
+                S.set(sec, 'Start', repr(channel.start))
+                S.set(sec, 'Last', repr(channel.last))
+        with open(self.infofile, 'w') as f:
+            S.write(f)
+
+    def _findDays(self):
+        days = []
+        for y in os.listdir(self.dir):
+            if not (y.isdigit() and len(y) == 4):
+                continue
+            for m in os.listdir(os.path.join(self.dir, y)):
+                for d in os.listdir(os.path.join(self.dir, y, m)):
+                    day = date(int(y), int(m), int(d))
+                    days.append(day.toordinal() - EPOCH.toordinal())
+        return sorted(days)
+
+    def addDay(self, day):
+        i = bisect.bisect_left(self.days, day)
+        if i == len(self.days) or self.days[i] != day:
+            os.makedirs(os.path.join(self.dir, dayDir(day)))
+            self.days.insert(i, day)
+
+    def channel(self, name, tag=None):
+        """Get a channel, creating it if a type tag is given."""
+        if name in self.channels:
+            channel = self.channels[name]
+            if tag is not None and tag != channel.tag:
+                raise errors.ChannelTypeError(name, channel.tag, tag)
+            return channel
+        if tag is None:
+            raise errors.ChannelNotFoundError(name)
+        if baseType(tag) not in DTYPES:
+            raise errors.BadTypeError(tag)
+        channel = self.channels[name] = Channel(self, name, tag)
+        self.save()
+        return channel
+
+    @property
+    def last(self):
+        """Time of the last entry, or creation if there are none."""
+        times = [ch.last for ch in self.channels.values() if ch.last is not None]
+        return max(times) if times else self.created
+
+    def flush(self):
+        """Write all entries kept in memory."""
+        written = [ch.flush() for ch in self.channels.values()]
+        if any(written):
+            self.save()
+
+
+class LogStore(object):
+    """The logs in a repository directory."""
+
+    def __init__(self, root):
+        self.root = root
+        self.logs = {}
+
+    def exists(self, path):
+        return os.path.exists(os.path.join(logDir(self.root, path), INFO_FILE))
+
+    def get(self, path, create=False):
+        path = tuple(path)
+        if path not in self.logs:
+            self.logs[path] = Log(self.root, path, create)
+        return self.logs[path]
+
+    def list(self, filters=()):
+        """Paths of all logs that contain every one of the filter strings."""
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            # day directories have no .dir suffix and hold no logs
+            dirnames[:] = sorted(d for d in dirnames if d.endswith('.dir'))
+            if INFO_FILE in filenames:
+                rel = os.path.relpath(dirpath, self.root).split(os.sep)
+                path = tuple(unquote(d[:-len('.dir')]) for d in rel)
+                if all(f in '/'.join(path) for f in filters):
+                    paths.append(path)
+        return paths
+
+    def flush(self):
+        for log in self.logs.values():
+            log.flush()
@@ -0,0 +1,30 @@
+from labrad import types as T
+
+class NoLogError(T.Error):
+    """Please open a log first."""
+    code = 2
+
+class LogNotFoundError(T.Error):
+    code = 3
+    def __init__(self, path):
+        self.msg = "Log '{0}' not found!".format('/'.join(path))
+
+class ChannelNotFoundError(T.Error):
+    code = 4
+    def __init__(self, name):
+        self.msg = "Channel '{0}' not found!".format(name)
+
+class ChannelTypeError(T.Error):
+    code = 5
+    def __init__(self, name, tag, gotTag):
+        self.msg = "Channel '{0}' has type {1}, not {2}.".format(name, tag, gotTag)
+
+class BadTypeError(T.Error):
+    code = 6
+    def __init__(self, tag):
+        self.msg = "Cannot log values of type {0}.".format(tag)
+
+class NoRollupsError(T.Error):
+    code = 7
+    def __init__(self, name):
+        self.msg = "Channel '{0}' is not numeric and has no rollups.".format(name)
@@ -30,7 +30,6 @@ timeout = 5
 ### END NODE INFO
 """
 
-import struct
 import re
 
 import numpy as np
@@ -138,10 +137,7 @@ class SamplingScope(GPIBManagedServer):
         for trace in splits:
             ofs, incr, vals = _parseBinaryData(trace)
             traces.append(vals)
-        #ofs1, incr1, vals1 = _parseBinaryData(t1)
-        #ofs2, incr2, vals2 = _parseBinaryData(t2)
-        #traces = np.vstack((vals1, vals2))
-        returnValue((ofs, incr, traces))
+        returnValue((ofs, incr, np.vstack(traces)))
     
     @setting(241, 'Send Trace To Data Vault',
                   server=['s'], session=['*s'], dataset=['s'], trace=['w'],
@@ -323,7 +319,7 @@ def _parseBinaryData(data):
     """Parse the data coming back from the scope"""
     hdr, dat = data.split(';CURVE')
     dat = dat[dat.find('%')+3:-1]
-    dat = np.array(struct.unpack('h'*(len(dat)/2), dat))
+    dat = np.frombuffer(dat[:len(dat)//2*2], '<i2')
     xzero = float(_xzero.findall(hdr)[0])
     xincr = float(_xincr.findall(hdr)[0])
     yzero = float(_yzero.findall(hdr)[0])
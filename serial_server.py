@@ -17,7 +17,7 @@
 ### BEGIN NODE INFO
 [info]
 name = Serial Server
-version = 1.0
+version = 1.1
 description = 
 instancename = %LABRADNODE% Serial Server
 
@@ -31,14 +31,21 @@ timeout = 20
 ### END NODE INFO
 """
 
-from time import sleep
-import time
+import sys
+
+if sys.platform == 'win32' and 'twisted.internet.reactor' not in sys.modules:
+    # Twisted's SerialPort waits for win32 events on Windows, which the
+    # default select reactor can't do.
+    from twisted.internet import win32eventreactor
+    win32eventreactor.install()
 
 from labrad import types as T
 from labrad.errors import Error
 from labrad.server import LabradServer, setting
-from twisted.internet import reactor, threads
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, returnValue
+from twisted.internet.protocol import Protocol
+from twisted.internet.serialport import SerialPort
 from twisted.internet.task import deferLater
 from serial import Serial
 from serial.serialutil import SerialException
@@ -54,6 +61,102 @@ class NoPortsAvailableError(Error):
     code = 3
 
 
+class SerialBuffer(Protocol):
+    """Buffers data arriving on a serial port until it is read.
+
+    The reactor delivers data as soon as the port has it, so reads are
+    answered from the buffer or from a Deferred that fires when enough data
+    has arrived. No read polls the port or ties up a thread.
+    """
+
+    def __init__(self):
+        self.buffer = ''
+        self.waiters = []
+
+    def dataReceived(self, data):
+        self.buffer += data
+        self._serviceWaiters()
+
+    def connectionLost(self, reason):
+        for waiter in self.waiters:
+            waiter[3] = True
+        self._serviceWaiters()
+
+    def read(self, find, timeout):
+        """Read data from the buffer, waiting up to timeout seconds.
+
+        find(buffer, final) returns (n, result) to consume n bytes from the
+        buffer and return result, or None if the read needs more data. It
+        must return a result when final is True, which happens once timeout
+        has run out. Reads are answered in the order they are made, so a
+        read that times out while earlier reads are waiting is answered
+        after them.
+
+        Returns a Deferred that fires with the result.
+        """
+        # [deferred, find, timeout call, timed out]
+        waiter = [Deferred(), find, None, timeout <= 0]
+        self.waiters.append(waiter)
+        if timeout > 0:
+            waiter[2] = reactor.callLater(timeout, self._expire, waiter)
+        self._serviceWaiters()
+        return waiter[0]
+
+    def _expire(self, waiter):
+        waiter[2] = None
+        waiter[3] = True
+        self._serviceWaiters()
+
+    def _serviceWaiters(self):
+        """Answer reads from the front of the queue while data allows."""
+        while self.waiters:
+            d, find, timer, final = self.waiters[0]
+            found = find(self.buffer, final)
+            if found is None:
+                return
+            n, result = found
+            self.buffer = self.buffer[n:]
+            self.waiters.pop(0)
+            if timer is not None and timer.active():
+                timer.cancel()
+            d.callback(result)
+
+
+def _findCount(count):
+    """Find function for SerialBuffer.read to read count bytes.
+
+    If count is 0 everything in the buffer is read.
+    """
+    def find(buf, final):
+        if count and len(buf) >= count:
+            return count, buf[:count]
+        if final or not count:
+            return len(buf), buf
+        return None
+    return find
+
+
+def _findLine(delim, skip):
+    """Find function for SerialBuffer.read to read up to delim.
+
+    The delimiter is consumed but not returned, and skip characters are
+    dropped from the result. If no delimiter arrives, everything received
+    is returned when the read times out.
+    """
+    def find(buf, final):
+        i = buf.find(delim)
+        if i >= 0:
+            n, line = i + len(delim), buf[:i]
+        elif final:
+            n, line = len(buf), buf
+        else:
+            return None
+        if skip:
+            line = line.replace(skip, '')
+        return n, line
+    return find
+
+
 class SerialServer(LabradServer):
     """Provides access to a computer's serial (COM) ports."""
     name = '%LABRADNODE% Serial Server'
@@ -77,14 +180,25 @@ class SerialServer(LabradServer):
 
     def expireContext(self, c):
         if 'PortObject' in c:
-            c['PortObject'].close()
+            c['PortObject'].transport.loseConnection()
 
-    def getPort(self, c):
+    def getConnection(self, c):
+        """Get the SerialBuffer for the port open in this context."""
         try:
             return c['PortObject']
-        except:
+        except KeyError:
             raise NoPortSelectedError()
 
+    def getPort(self, c):
+        """Get the pyserial Serial object for the port open in this context."""
+        return self.getConnection(c).transport._serial
+
+    def openPort(self, port):
+        """Open a port, returning the SerialBuffer receiving from it."""
+        conn = SerialBuffer()
+        SerialPort(conn, '\\\\.\\' + port, reactor)
+        return conn
+
     @setting(1, 'List Serial Ports',
              returns=['*s: List of serial ports'])
     def list_serial_ports(self, c):
@@ -103,32 +217,33 @@ class SerialServer(LabradServer):
         """Opens a serial port in the current context."""
         c['Timeout'] = 0
         if 'PortObject' in c:
-            c['PortObject'].close()
+            c['PortObject'].transport.loseConnection()
             del c['PortObject']
         if not port:
             for i in range(len(self.SerialPorts)):
                 try:
-                    c['PortObject'] = Serial('\\\\.\\' + self.SerialPorts[i], timeout=0)
+                    c['PortObject'] = self.openPort(self.SerialPorts[i])
                     break
-                except SerialException:
+                except Exception:
                     pass
             if 'PortObject' not in c:
                 raise NoPortsAvailableError()
         else:
             try:
-                c['PortObject'] = Serial('\\\\.\\' + port, timeout=0)
-            except SerialException, e:
-                if e.message.find('cannot find') >= 0:
-                    raise Error(code=1, msg=e.message)
+                c['PortObject'] = self.openPort(port)
+            except Exception, e:
+                msg = str(e) or e.__class__.__name__
+                if isinstance(e, SerialException) and msg.find('cannot find') >= 0:
+                    raise Error(code=1, msg=msg)
                 else:
-                    raise Error(code=2, msg=e.message)
-        return c['PortObject'].portstr.replace('\\\\.\\', '')
+                    raise Error(code=2, msg=msg)
+        return self.getPort(c).portstr.replace('\\\\.\\', '')
 
     @setting(11, 'Close', returns=[''])
     def close(self, c):
         """Closes the current serial port."""
         if 'PortObject' in c:
-            c['PortObject'].close()
+            c['PortObject'].transport.loseConnection()
             del c['PortObject']
 
     @setting(20, 'Baudrate',
@@ -224,18 +339,18 @@ class SerialServer(LabradServer):
              returns=['w: Bytes sent'])
     def write(self, c, data):
         """Sends data over the port."""
-        ser = self.getPort(c)
+        conn = self.getConnection(c)
         if not isinstance(data, str):
             data = ''.join(chr(x & 255) for x in data)
-        ser.write(data)
+        conn.transport.write(data)
         return long(len(data))
 
     @setting(41, 'Write Line', data=['s: Data to send'],
              returns=['w: Bytes sent'])
     def write_line(self, c, data):
         """Sends data over the port appending CR LF."""
-        ser = self.getPort(c)
-        ser.write(data + '\r\n')
+        conn = self.getConnection(c)
+        conn.transport.write(data + '\r\n')
         return long(len(data) + 2)
 
     @setting(42, 'Pause', duration='v[s]: Time to pause', returns=[])
@@ -243,71 +358,14 @@ class SerialServer(LabradServer):
         _ = yield deferLater(reactor, duration['s'], lambda: None)
         return
 
-    @inlineCallbacks
-    def _deferredRead(self, ser, timeout, count=1):
-        stop_time = time.time() + timeout
-
-        def doRead(count):
-            while True:
-                d = ser.read(count)
-                if d:
-                    return d
-                sleep(0.01)
-                if time.time() > stop_time:
-                    return ''
-
-        data = yield threads.deferToThread(doRead, count)
-        returnValue(data)
-
-    @inlineCallbacks
-    def deferredRead(self, ser, timeout, count=1):
-        killit = False
-
-        def doRead(count):
-            d = ''
-            while not killit:
-                d = ser.read(count)
-                if d:
-                    break
-                sleep(0.010)
-            return d
-
-        data = threads.deferToThread(doRead, count)
-        timeout_object = []
-        start_time = time.time()
-        r = yield util.maybeTimeout(data, min(timeout, 300), timeout_object)
-        killit = True
-
-        if r == timeout_object:
-            print "deferredRead timed out after %f seconds" % (time.time() - start_time,)
-            r = ''
-        if r == '':
-            r = ser.read(count)
-
-        returnValue(r)
-
-    @inlineCallbacks
     def readSome(self, c, count=0):
-        ser = self.getPort(c)
+        """Read count bytes, or all buffered bytes if count is 0.
 
-        if count == 0:
-            returnValue(ser.read(10000))
-
-        timeout = c['Timeout']
-        if timeout == 0:
-            returnValue(ser.read(count))
-
-        recd = ''
-        while len(recd) < count:
-            r = ser.read(count - len(recd))
-            if r == '':
-                r = yield self.deferredRead(ser, timeout, count - len(recd))
-                if r == '':
-                    ser.close()
-                    ser.open()
-                    break
-            recd += r
-        returnValue(recd)
+        Waits up to the context's timeout for count bytes to arrive, and
+        returns whatever has arrived if they don't.
+        """
+        conn = self.getConnection(c)
+        return conn.read(_findCount(count), c['Timeout'] if count else 0)
 
     @setting(50, 'Read', count=[': Read all bytes in buffer',
                                 'w: Read this many bytes'],
@@ -331,25 +389,12 @@ class SerialServer(LabradServer):
              returns=['s: Received data'])
     def read_line(self, c, data=''):
         """Read data from the port, up to but not including the specified delimiter."""
-        ser = self.getPort(c)
-        timeout = c['Timeout']
-
+        conn = self.getConnection(c)
         if data:
             delim, skip = data, ''
         else:
             delim, skip = '\n', '\r'
-
-        recd = ''
-        while True:
-            r = ser.read(1)
-            if r == '' and timeout > 0:
-                # only try a deferred read if there is a timeout
-                r = yield self.deferredRead(ser, timeout)
-            if r in ('', delim):
-                break
-            if r != skip:
-                recd += r
-        returnValue(recd)
+        return conn.read(_findLine(delim, skip), c['Timeout'])
 
 
 __server__ = SerialServer()
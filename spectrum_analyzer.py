@@ -20,7 +20,7 @@
 ### BEGIN NODE INFO
 [info]
 name = Spectrum Analyzer Server
-version = 2.1
+version = 2.2
 description = 
 
 [startup]
@@ -33,24 +33,35 @@ timeout = 20
 ### END NODE INFO
 """
 
-from labrad import types as T, errors
+from labrad import types as T
 from labrad.server import setting
 from labrad.gpib import GPIBManagedServer, GPIBDeviceWrapper
-from struct import unpack
 from twisted.internet.defer import inlineCallbacks, returnValue
 from labrad import util
 from labrad.units import MHz
+import numpy as np
 
 __QUERY__ = """\
-:FORM INT,32
+:FORM %s
 :FORM:BORD NORM
 :TRAC? TRACE%s"""
 
+# numpy dtype of each trace transfer format, None for ASCII
+TRACE_FORMATS = {
+    'ASCII': None,
+    'INT,32': '>i4',
+    'REAL,32': '>f4',
+    'REAL,64': '>f8',
+}
+
 class SpectrumAnalyzer(GPIBManagedServer):
     name = 'Spectrum Analyzer Server'
     deviceName = ['Hewlett-Packard E4407B', 'Agilent Technologies N9010A']
     deviceWrapper = GPIBDeviceWrapper
 
+    def initContext(self, c):
+        c['traceFormat'] = 'INT,32'
+
     @setting(10, 'Get Trace',
                  data=['{Query TRACE1}',
                           'w {Specify trace to query: 1, 2, or 3}'],
@@ -66,8 +77,7 @@ class SpectrumAnalyzer(GPIBManagedServer):
         maxRetries = 10
         for i in range(maxRetries):
             try:
-                resp = yield dev.query(__QUERY__ % trace)
-                vals = _parseBinaryData(resp)
+                vals = yield self.queryTrace(dev, trace, c['traceFormat'])
                 break
             except Exception:
                 pass
@@ -78,6 +88,36 @@ class SpectrumAnalyzer(GPIBManagedServer):
         n = len(vals)
         returnValue((start/1.0e6*MHz, span/1.0e6/(n-1)*MHz, vals))
         
+    @setting(11, 'Trace Format', fmt='s', returns='s')
+    def trace_format(self, c, fmt=None):
+        """Get or set the trace transfer format for this context.
+
+        One of 'ASCII', 'INT,32' (the default, in units of 0.001 dBm),
+        'REAL,32' or 'REAL,64'.
+        """
+        if fmt is not None:
+            fmt = fmt.upper()
+            if fmt not in TRACE_FORMATS:
+                raise Exception('allowed formats are: %s' % sorted(TRACE_FORMATS))
+            c['traceFormat'] = fmt
+        return c['traceFormat']
+
+    @inlineCallbacks
+    def queryTrace(self, dev, trace, fmt):
+        """Query one trace in the given format and return a numpy array."""
+        query = __QUERY__ % (fmt, trace)
+        if fmt == 'ASCII':
+            resp = yield dev.query(query)
+            returnValue(np.fromstring(resp, sep=','))
+        # the bus server reads and decodes the binary block
+        p = dev._packet()
+        p.query_array(query, TRACE_FORMATS[fmt])
+        resp = yield p.send()
+        vals = np.asarray(resp.query_array, dtype=float)
+        if fmt == 'INT,32':
+            vals /= 1000.0
+        returnValue(vals)
+
     @setting(12, 'Get Averaged Trace',
                  data=['{Query TRACE1}',
                           'w {Specify trace to query: 1, 2, or 3}'],
@@ -281,20 +321,6 @@ class SpectrumAnalyzer(GPIBManagedServer):
 
 
     
-def _parseBinaryData(data):
-    """Parse binary trace data."""
-    h = int(data[1]) #length of header
-    d = int(data[2:2+h]) #header, tells us how many bytes of data
-    s = data[2+h:]
-    if len(s) != d:
-        raise errors.HandlerError('Could not decode binary response.')
-    n = d/4 # 4 bytes per data point
-
-    data = unpack('>'+'l'*n, s)
-    data = [d/1000.0 for d in data]
-
-    return data
-
 __server__ = SpectrumAnalyzer()
 
 if __name__ == '__main__':
@@ -18,7 +18,7 @@
 ### BEGIN NODE INFO
 [info]
 name = Tektronix TDS 5104B Oscilloscope
-version = 0.4
+version = 0.5
 description = Talks to the Tektronix 5104B oscilloscope
 
 [startup]
@@ -51,6 +51,65 @@ HORZ_DIVISIONS = 10.0
 VERT_SCALES_MV = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
 
 class Tektronix5104BWrapper(GPIBDeviceWrapper):
+
+    def initialize(self):
+        # (position, volts per div) by channel, seconds per div and the
+        # (start, stop) points set up for transfer, kept until a setting
+        # changes
+        self.channelInfo = {}
+        self.secPerDiv = None
+        self.dataRange = None
+        # number of FastFrame frames per acquisition, 0 when off
+        self.frames = 0
+
+    def write(self, data, *args, **kw):
+        # any command other than a waveform transfer one may change the
+        # scales used to convert the data, so forget them
+        if not data.lstrip(':').upper().startswith(('DAT', 'CURV', 'WFMP')):
+            self.channelInfo.clear()
+            self.secPerDiv = None
+            self.dataRange = None
+        return GPIBDeviceWrapper.write(self, data, *args, **kw)
+
+    @inlineCallbacks
+    def getWaveforms(self, channels, start, stop):
+        """Read the waveforms of several channels in one request to the bus.
+
+        The transfer format, scales and positions are only sent or queried
+        when they are not known already. Returns (secPerDiv, waveforms)
+        where waveforms has a (position, voltsPerDiv, raw data) tuple for
+        each channel.
+        """
+        ops = []
+        if self.dataRange != (start, stop):
+            cmd = 'DAT:ENC RIB;:DAT:WID 2;:DAT:STAR %d;:DAT:STOP %d' %(start, stop)
+            if self.frames:
+                cmd += ';:DAT:FRAMESTAR 1;:DAT:FRAMESTOP %d' %self.frames
+            ops.append(('write', cmd))
+        if self.secPerDiv is None:
+            ops.append(('query', 'HOR:SCA?'))
+        infoOps = {}
+        dataOps = []
+        for channel in channels:
+            ops.append(('write', 'DAT:SOU CH%d' %channel))
+            if channel not in self.channelInfo:
+                infoOps[channel] = len(ops)
+                ops.append(('query', 'CH%d:POSITION?;SCA?' %channel))
+            dataOps.append(len(ops))
+            ops.append(('query block', 'CURV?'))
+        p = self._packet()
+        p.batch(ops)
+        resp = yield p.send()
+        replies = resp.batch
+        self.dataRange = (start, stop)
+        if self.secPerDiv is None:
+            self.secPerDiv = float(replies[ops.index(('query', 'HOR:SCA?'))])
+        for channel, i in infoOps.items():
+            position, voltsPerDiv = replies[i].split(';')
+            self.channelInfo[channel] = (float(position), float(voltsPerDiv))
+        waveforms = [self.channelInfo[channel] + (numpy.frombuffer(replies[i], '>i2'),)
+                     for channel, i in zip(channels, dataOps)]
+        returnValue((self.secPerDiv, waveforms))
     
     @inlineCallbacks
     def reset(self):
@@ -453,6 +512,25 @@ class Tektronix5104BServer(GPIBManagedServer):
         position = float(resp)
         returnValue(position)
 
+    @setting(152, frames = 'w', returns = ['w'])
+    def fast_frame(self, c, frames = None):
+        """Get or set the number of FastFrame frames per acquisition, 0 to
+        turn FastFrame off.
+        """
+        dev = self.selectedDevice(c)
+        if frames is not None:
+            if frames:
+                yield dev.write('HOR:FAST:COUN %d;:HOR:FAST:STATE ON' %frames)
+            else:
+                yield dev.write('HOR:FAST:STATE OFF')
+        state = yield dev.query('HOR:FAST:STATE?')
+        if int(state):
+            frames = int((yield dev.query('HOR:FAST:COUN?')))
+        else:
+            frames = 0
+        dev.frames = frames
+        returnValue(frames)
+
         
     
     #Data acquisition settings
@@ -504,6 +582,29 @@ class Tektronix5104BServer(GPIBManagedServer):
 
         returnValue((time, traceVolts))
 
+    @setting(202, channels = '*i', start = 'i', stop = 'i', returns='*v[ns] {time axis} *2v[mV] {scope traces}')
+    def get_traces(self, c, channels, start=1, stop=10000):
+        """Get the traces of several channels from the current acquisition.
+
+        All channels are read in one request to the GPIB bus, and scales and
+        positions are reused until a setting is changed through this server.
+        Returns one row per channel, or with FastFrame one row per frame,
+        ordered by channel and then by frame.
+        """
+        if not channels:
+            raise Exception('No channels given')
+        dev = self.selectedDevice(c)
+        secPerDiv, waveforms = yield dev.getWaveforms(channels, start, stop)
+        voltUnitScaler = 1000.0
+        timeUnitScaler = 1.0e9
+        rows = []
+        for position, voltsPerDiv, trace in waveforms:
+            traceVolts = (trace * (1/32768.0) * VERT_DIVISIONS/2 * voltsPerDiv - position * voltsPerDiv) * voltUnitScaler
+            rows.append(traceVolts.reshape(max(dev.frames, 1), -1))
+        traces = numpy.vstack(rows)
+        time = numpy.linspace(0, HORZ_DIVISIONS * secPerDiv * timeUnitScaler, traces.shape[1])
+        returnValue((time, traces))
+
 def _parsePreamble(preamble):
     ###TODO: parse the rest of the preamble and return the results as a useful dictionary
     preamble = preamble.split(';')
@@ -0,0 +1,106 @@
+"""Benchmark concurrent queries through the GPIB Bus server.
+
+The server runs without a LabRAD connection, talking to fake instruments
+that take a fixed time to answer each query, like a slow instrument on the
+bus. Queries to independent addresses should all finish in about the time
+of one query, while queries to a single address are serialized.
+
+Usage: python benchmark_gpib_server.py [n_devices] [query_time_s]
+"""
+
+import sys
+import threading
+import time
+
+from twisted.internet import defer, reactor
+
+import servers.gpib_server as gpib_server
+
+
+class SlowInstrument(object):
+    """Stand-in for a pyvisa instrument that takes time to respond."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.active = 0
+        self.maxActive = 0
+
+    def _enter(self):
+        with self.lock:
+            self.active += 1
+            self.maxActive = max(self.maxActive, self.active)
+
+    def _exit(self):
+        with self.lock:
+            self.active -= 1
+
+    def write(self, data):
+        self._enter()
+        try:
+            self.last = data
+            time.sleep(self.delay / 2.0)
+        finally:
+            self._exit()
+
+    def read_raw(self):
+        self._enter()
+        try:
+            time.sleep(self.delay / 2.0)
+            return self.last + '\n'
+        finally:
+            self._exit()
+
+
+@defer.inlineCallbacks
+def timeQueries(server, contexts):
+    start = time.time()
+    answers = yield defer.gatherResults(
+        [server.query(c, '*IDN?{}'.format(i)) for i, c in enumerate(contexts)])
+    elapsed = time.time() - start
+    assert answers == ['*IDN?{}'.format(i) for i in range(len(contexts))]
+    defer.returnValue(elapsed)
+
+
+@defer.inlineCallbacks
+def run(nDevices, delay):
+    server = gpib_server.GPIBBusServer()
+    server.refreshDevices = lambda: None  # no VISA bus here
+    server.poolSize = nDevices
+    server.initServer()
+    instruments = {}
+    for i in range(nDevices):
+        addr = 'GPIB0::{}'.format(i + 1)
+        instruments[addr] = server.devices[addr] = SlowInstrument(delay)
+    contexts = []
+    for addr in sorted(instruments):
+        c = {'addr': addr}
+        server.initContext(c)
+        contexts.append(c)
+
+    try:
+        parallel = yield timeQueries(server, contexts)
+        serial = yield timeQueries(server, [contexts[0]] * nDevices)
+    finally:
+        yield server.stopServer()
+
+    print '{} queries of {:.3f} s each'.format(nDevices, delay)
+    print '  independent addresses: {:.3f} s'.format(parallel)
+    print '  same address:          {:.3f} s'.format(serial)
+    print '  speedup:               {:.1f}x'.format(serial / parallel)
+    assert all(instr.maxActive == 1 for instr in instruments.values()), \
+        "I/O to one device overlapped"
+    assert parallel < serial / 2, "independent queries did not overlap"
+
+
+def main(argv):
+    nDevices = int(argv[1]) if len(argv) > 1 else 8
+    delay = float(argv[2]) if len(argv) > 2 else 0.2
+    d = run(nDevices, delay)
+    d.addErrback(lambda failure: failure.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
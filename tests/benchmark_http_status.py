@@ -0,0 +1,89 @@
+"""Load test of the HTTP status pages with many concurrent clients.
+
+Serves a status page whose renderers each wait a fixed time, like the
+LabRAD queries of the cryo status page, and has the given number of
+clients fetch it over HTTP as fast as they can. This is done with the
+render cache off, with coalescing of simultaneous requests only (a ttl of
+zero), and with the default ttl.
+
+Usage: python benchmark_http_status.py [n_clients] [requests_per_client] [query_time_s]
+"""
+
+import sys
+import time
+
+from twisted.internet import defer, reactor, task
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from twisted.web.server import Site
+from twisted.web.template import Element, XMLString, renderer
+
+import servers.http.http_server as http_server
+
+TEMPLATE = """<html xmlns:t="http://twistedmatrix.com/ns/twisted.web.template/0.1">
+<body>
+  <table><tr t:render="rows"><td><t:slot name="name"/></td><td><t:slot name="value"/></td></tr></table>
+</body>
+</html>"""
+
+
+class SlowPage(Element):
+    """Page with a renderer that waits like a LabRAD query."""
+    loader = XMLString(TEMPLATE)
+    delay = 0.05
+    renders = 0
+
+    def __init__(self, cxn, request):
+        super(SlowPage, self).__init__()
+        SlowPage.renders += 1
+
+    @renderer
+    def rows(self, request, tag):
+        d = task.deferLater(reactor, self.delay, lambda: None)
+        d.addCallback(lambda _: [tag.clone().fillSlots(name='ch%d' % i, value=str(i))
+                                 for i in range(20)])
+        return d
+
+
+@defer.inlineCallbacks
+def client(agent, url, n):
+    for _ in range(n):
+        response = yield agent.request('GET', url)
+        body = yield readBody(response)
+        assert 'ch19' in body
+
+
+@defer.inlineCallbacks
+def run(nClients, nRequests):
+    pool = HTTPConnectionPool(reactor)
+    pool.maxPersistentPerHost = nClients
+    agent = Agent(reactor, pool=pool)
+    print '{} clients, {} requests each, {:.0f} ms per render'.format(
+        nClients, nRequests, 1e3 * SlowPage.delay)
+    for label, ttl in [('no cache', None), ('coalescing', 0), ('ttl 2 s', 2.0)]:
+        resource = http_server.StatusResource(SlowPage, cxn=object(), ttl=ttl)
+        port = reactor.listenTCP(0, Site(resource), interface='127.0.0.1')
+        url = 'http://127.0.0.1:{}/?cryo=Vince'.format(port.getHost().port)
+        SlowPage.renders = 0
+        start = time.time()
+        yield defer.gatherResults([client(agent, url, nRequests) for _ in range(nClients)])
+        elapsed = time.time() - start
+        yield port.stopListening()
+        total = nClients * nRequests
+        print '  {:<11} {:7.0f} requests/s  {:5d} renders'.format(
+            label, total / elapsed, SlowPage.renders)
+    yield pool.closeCachedConnections()
+
+
+def main(argv):
+    nClients = int(argv[1]) if len(argv) > 1 else 50
+    nRequests = int(argv[2]) if len(argv) > 2 else 20
+    if len(argv) > 3:
+        SlowPage.delay = float(argv[3])
+    d = run(nClients, nRequests)
+    d.addErrback(lambda failure: failure.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
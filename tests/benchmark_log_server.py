@@ -0,0 +1,65 @@
+"""Benchmark writing to and reading from the Logger server's store.
+
+Logs the given number of points per second, spread across channels, for a
+simulated stretch of time, directly through logstore as the server's 'log'
+setting does, flushing once per simulated second like the server. Then
+reads back one channel over the whole range, in chunks as a client of the
+streaming 'get' would. The rates must comfortably exceed the target rate
+for the server to keep up.
+
+Usage: python benchmark_log_server.py [n_channels] [points_per_s] [seconds]
+"""
+
+import shutil
+import sys
+import tempfile
+import time
+
+from datetime import datetime
+
+import servers.logstore as logstore
+
+
+def main(argv):
+    nChannels = int(argv[1]) if len(argv) > 1 else 100
+    rate = int(argv[2]) if len(argv) > 2 else 10000
+    seconds = int(argv[3]) if len(argv) > 3 else 30
+    perChannel = rate // nChannels
+    root = tempfile.mkdtemp()
+    try:
+        store = logstore.LogStore(root)
+        log = store.get(['benchmark'], create=True)
+        channels = [log.channel('ch{}'.format(i), 'v[K]') for i in range(nChannels)]
+        t0 = logstore.toSeconds(datetime(2015, 3, 1, 23, 59, 50))
+
+        start = time.time()
+        for s in range(seconds):
+            for i in range(perChannel):
+                t = t0 + s + float(i) / perChannel
+                for j, ch in enumerate(channels):
+                    ch.add(t, j + 0.001 * i)
+            store.flush()
+        elapsed = time.time() - start
+        total = seconds * perChannel * nChannels
+        print '{} channels, {} points/s for {} s across {} days'.format(
+            nChannels, perChannel * nChannels, seconds, len(log.days))
+        print '  write: {:.0f} points/s ({:.1f}x target)'.format(
+            total / elapsed, total / elapsed / rate)
+
+        ch = channels[0]
+        start = time.time()
+        cursor = ch.seek(t0)
+        n = 0
+        more = True
+        while more:
+            times, values, cursor, more = ch.read(cursor, t0 + seconds, limit=1000)
+            n += len(times)
+        elapsed = time.time() - start
+        assert n == seconds * perChannel
+        print '  read:  {:.0f} points/s'.format(n / elapsed)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,110 @@
+"""Benchmark ASCII against binary transfer of instrument traces.
+
+For each trace length the same trace is encoded the way an instrument sends
+it in ASCII (comma separated, as for FORM ASCii or DSPY?) and as IEEE 488.2
+REAL,32 and REAL,64 blocks, then decoded by:
+
+  ascii         splitting and calling float on each value
+  struct        unpacking each point with struct, as the servers used to
+  frombuffer    gpib_server.readBlock and np.frombuffer, as they do now
+
+Blocks are read from a fake instrument in chunks, like pyvisa's read_raw.
+The bus time is estimated from the number of bytes at the given bus rate,
+since without hardware only the decoding can be timed.
+
+Usage: python benchmark_trace_transfer.py [bus_rate_bytes_per_s]
+"""
+
+import struct
+import sys
+import time
+
+import numpy as np
+
+import servers.gpib_server as gpib_server
+
+LENGTHS = [1000, 10000, 100000]
+CHUNK_SIZE = 20 * 1024
+FORMATS = [('REAL,32', '>f4'), ('REAL,64', '>f8')]
+
+
+class BlockInstrument(object):
+    """Stand-in for a pyvisa instrument that sends a response in chunks."""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read_raw(self):
+        chunk = self.data[self.pos:self.pos + CHUNK_SIZE]
+        self.pos += len(chunk)
+        return chunk
+
+
+def encodeBlock(values, dtype):
+    payload = np.asarray(values, dtype=dtype).tostring()
+    length = str(len(payload))
+    return '#{}{}{}\n'.format(len(length), length, payload)
+
+
+def encodeASCII(values):
+    return ','.join('%+.10E' % v for v in values) + '\n'
+
+
+def decodeASCII(data):
+    return [float(v) for v in data.split(',')]
+
+
+def decodeStruct(data, dtype):
+    fmt = '>d' if dtype == '>f8' else '>f'
+    size = struct.calcsize(fmt)
+    offset, length = gpib_server.parseBlockHeader(data)
+    payload = data[offset:offset + length]
+    return [struct.unpack(fmt, payload[i:i + size])[0]
+            for i in range(0, length, size)]
+
+
+def decodeFrombuffer(data, dtype):
+    return np.frombuffer(gpib_server.readBlock(BlockInstrument(data)), dtype)
+
+
+def timeit(func, *args):
+    """Best of a few runs, in seconds."""
+    best = None
+    for _ in range(3):
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main(argv):
+    rate = float(argv[1]) if len(argv) > 1 else 1e6
+    print 'bus rate {:.2g} bytes/s'.format(rate)
+    print '{:>7} {:>8} {:>10} {:>11} {:>10} {:>10}'.format(
+        'points', 'format', 'bytes', 'bus (est)', 'decoder', 'decode')
+    for n in LENGTHS:
+        values = np.random.uniform(-100, 0, n)
+
+        data = encodeASCII(values)
+        t, result = timeit(decodeASCII, data)
+        assert np.allclose(result, values)
+        rows = [('ASCII', len(data), 'ascii', t)]
+
+        for fmt, dtype in FORMATS:
+            data = encodeBlock(values, dtype)
+            t_struct, result = timeit(decodeStruct, data, dtype)
+            t_np, result_np = timeit(decodeFrombuffer, data, dtype)
+            assert np.array_equal(result, result_np)
+            assert np.allclose(result_np, values, rtol=1e-6)
+            rows.append((fmt, len(data), 'struct', t_struct))
+            rows.append((fmt, len(data), 'frombuffer', t_np))
+
+        for fmt, size, decoder, t in rows:
+            print '{:>7} {:>8} {:>10} {:>9.1f}ms {:>10} {:>8.2f}ms'.format(
+                n, fmt, size, 1e3 * size / rate, decoder, 1e3 * t)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
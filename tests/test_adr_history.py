@@ -0,0 +1,49 @@
+import os
+import sys
+
+import numpy as np
+
+# ADR.py is a script in the ADR directory, not part of a package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ADR'))
+import ADR
+
+VARIABLES = [('temperatures', 'K', 2), ('magCurrent', 'A', 1)]
+
+
+def reading(i):
+    return {'temperatures': [i, 10 * i], 'magCurrent': 0.5 * i}
+
+
+def make_history(n, length=5):
+    history = ADR.History(VARIABLES, length)
+    for i in range(n):
+        history.add(100.0 + i, reading(i))
+    return history
+
+
+def test_empty():
+    times, values = make_history(0).since(0)
+    assert len(times) == 0
+    assert values['temperatures'].shape == (0, 2)
+    assert values['magCurrent'].shape == (0, 1)
+
+
+def test_since():
+    times, values = make_history(3).since(100.0)
+    assert times.tolist() == [101.0, 102.0]
+    assert values['temperatures'].tolist() == [[1, 10], [2, 20]]
+    assert values['magCurrent'][:, 0].tolist() == [0.5, 1.0]
+    assert len(make_history(3).since(102.0)[0]) == 0
+
+
+def test_wrap_around():
+    history = make_history(12, length=5)
+    assert history.count == 12
+    # only the last five readings are kept, oldest first
+    times, values = history.since(0)
+    assert times.tolist() == [107.0, 108.0, 109.0, 110.0, 111.0]
+    assert values['temperatures'][:, 0].tolist() == [7, 8, 9, 10, 11]
+    # readings since a time spanning the wrap in the buffer
+    times, values = history.since(108.5)
+    assert times.tolist() == [109.0, 110.0, 111.0]
+    assert values['magCurrent'][:, 0].tolist() == [4.5, 5.0, 5.5]
@@ -0,0 +1,85 @@
+from twisted.internet import defer, task
+
+import servers.cryo_notifier as cryo_notifier
+
+
+class RecordingTransport(object):
+    """Stand-in transport that keeps the messages it is asked to send."""
+
+    def __init__(self):
+        self.messages = []
+
+    def send(self, kind, recipient, subject, msg):
+        self.messages.append((kind, recipient, msg))
+        return defer.succeed(None)
+
+
+def make_queue(**kw):
+    clock = task.Clock()
+    transport = RecordingTransport()
+    queue = cryo_notifier.AlertQueue(transport, delay=30, clock=clock, **kw)
+    return queue, transport, clock
+
+
+def test_digest_and_dedup():
+    queue, transport, clock = make_queue()
+    queue.add('sms', ['alice', 'bob'], ['Vince:Mix1'])
+    queue.add('sms', ['alice'], ['Vince:Mix1', 'LN2'])
+    queue.add('email', ['bob@lab'], ['LN2'])
+    clock.advance(29)
+    assert transport.messages == []
+    clock.advance(1)
+    assert transport.messages == [
+        ('email', 'bob@lab', 'LN2 need attention.'),
+        ('sms', 'alice', 'Vince:Mix1, LN2 need attention.'),
+        ('sms', 'bob', 'Vince:Mix1 need attention.'),
+    ]
+    assert queue.pending == {}
+    assert not clock.getDelayedCalls()
+
+
+def test_rate_limit():
+    queue, transport, clock = make_queue(limit=2, window=3600)
+    for i in range(3):
+        queue.add('sms', ['alice'], ['timer%d' % i])
+        clock.advance(30)
+    assert len(transport.messages) == 2
+    assert queue.pending == {('sms', 'alice'): ['timer2']}
+    # more alerts wait with the held ones and are not repeated
+    queue.add('sms', ['alice'], ['timer2', 'timer3'])
+    clock.advance(3600 - 60 - 1)
+    assert len(transport.messages) == 2
+    clock.advance(1)
+    assert transport.messages[-1] == ('sms', 'alice', 'timer2, timer3 need attention.')
+    assert queue.pending == {}
+
+
+def test_failed_send_does_not_stop_others():
+    queue, transport, clock = make_queue()
+
+    def send(kind, recipient, subject, msg):
+        if recipient == 'alice':
+            raise IOError('no route')
+        return RecordingTransport.send(transport, kind, recipient, subject, msg)
+    transport.send = send
+    queue.add('sms', ['alice', 'bob'], ['LN2'])
+    results = []
+    queue.flush().addCallback(results.append)
+    assert transport.messages == [('sms', 'bob', 'LN2 need attention.')]
+    assert results and not clock.getDelayedCalls()
+
+
+def test_rate_limit_does_not_hold_others():
+    queue, transport, clock = make_queue(limit=1, window=3600)
+    queue.add('sms', ['alice'], ['LN2'])
+    clock.advance(30)
+    queue.add('sms', ['alice'], ['Vince:Mix1'])
+    clock.advance(30)
+    assert len(transport.messages) == 1
+    # alice's retry is due in an hour, but bob's alert goes out as usual
+    queue.add('sms', ['bob'], ['LN2'])
+    clock.advance(30)
+    assert transport.messages[-1] == ('sms', 'bob', 'LN2 need attention.')
+    assert queue.pending == {('sms', 'alice'): ['Vince:Mix1']}
+    clock.advance(3630 - 90)
+    assert transport.messages[-1] == ('sms', 'alice', 'Vince:Mix1 need attention.')
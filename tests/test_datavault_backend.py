@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from servers.datavault import backend
+
+
+@pytest.fixture
+def csvfile(tmpdir):
+    """A data file with 1000 rows of 3 columns, written as the data vault does."""
+    data = np.arange(3000, dtype=float).reshape(1000, 3) / 7.0
+    filename = str(tmpdir.join('00001 - test.csv'))
+    with open(filename, 'wb') as f:
+        np.savetxt(f, data, fmt=backend.DATA_FORMAT, delimiter=',', newline='\r\n')
+    return filename, data
+
+
+@pytest.mark.parametrize('chunk_bytes', [100, 4096, backend.READ_CHUNK_BYTES])
+def test_read_chunks(csvfile, chunk_bytes):
+    filename, data = csvfile
+    chunks = list(backend.readChunks(filename, 3, chunk_bytes=chunk_bytes))
+    assert all(chunk.shape[1] == 3 for chunk in chunks)
+    assert np.allclose(np.vstack(chunks), data)
+
+
+@pytest.mark.parametrize('start, stop', [(0, 10), (5, 995), (990, None), (500, 500)])
+def test_read_chunks_range(csvfile, start, stop):
+    filename, data = csvfile
+    chunks = list(backend.readChunks(filename, 3, start, stop, chunk_bytes=256))
+    rows = np.vstack(chunks) if chunks else np.zeros((0, 3))
+    assert np.allclose(rows, data[start:stop])
+
+
+def test_read_chunks_ignores_partial_line(csvfile):
+    filename, data = csvfile
+    with open(filename, 'ab') as f:
+        f.write('1.0,2.0')  # the data vault is part way through a row
+    assert np.allclose(np.vstack(backend.readChunks(filename, 3)), data)
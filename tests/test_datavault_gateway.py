@@ -0,0 +1,30 @@
+import json
+
+import numpy as np
+
+from servers.datavault import backend
+from servers.http import datavault_gateway as gateway
+
+
+def strict_loads(text):
+    """Parse JSON as a browser would, rejecting NaN and Infinity."""
+    def reject(name):
+        raise ValueError('invalid JSON constant %s' % name)
+    return json.loads(text, parse_constant=reject)
+
+
+def test_json_rows():
+    chunk = np.array([[0.0, 1.5], [2.0, 3.25]])
+    assert strict_loads('[%s]' % gateway.json_rows(chunk)) == chunk.tolist()
+
+
+def test_json_rows_non_finite(tmpdir):
+    data = np.array([[0.0, 1.0, 2.0],
+                     [1.0, np.nan, 3.0],
+                     [2.0, np.inf, -np.inf]])
+    filename = str(tmpdir.join('00001 - test.csv'))
+    with open(filename, 'wb') as f:
+        np.savetxt(f, data, fmt=backend.DATA_FORMAT, delimiter=',', newline='\r\n')
+    chunks = gateway.select_rows(backend.readChunks(filename, 3), 0, 1, None)
+    rows = strict_loads('[%s]' % ', '.join(gateway.json_rows(c) for c in chunks))
+    assert rows == [[0.0, 1.0, 2.0], [1.0, None, 3.0], [2.0, None, None]]
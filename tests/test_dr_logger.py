@@ -0,0 +1,136 @@
+import math
+import time
+
+import pytest
+from twisted.internet import defer, task
+
+from labrad import types as T
+from labrad.units import Value
+
+import servers.dr_logger as dr_logger
+
+
+class FakeWatcher(dr_logger.WatchedServer):
+    """Watcher whose points are Deferreds the test fires."""
+    server_name = 'fake'
+
+    def __init__(self, timeout=5):
+        dr_logger.WatchedServer.__init__(self, 'fake', None, None, {'timeout': timeout})
+        self.clock = task.Clock()
+        self.requests = []
+
+    def take_point(self):
+        d = defer.Deferred()
+        self.requests.append(d)
+        return d
+
+
+def results(d):
+    """Successes and failures of a Deferred that has fired."""
+    out = []
+    d.addCallbacks(lambda r: out.append(('ok', r)), lambda f: out.append(('fail', f)))
+    return out
+
+
+def test_poll():
+    w = FakeWatcher()
+    out = results(w.poll())
+    w.clock.advance(1)
+    w.requests[0].callback([Value(1.0, 'K')])
+    assert out == [('ok', [Value(1.0, 'K')])]
+    assert w.latency is not None
+    assert not w.clock.getDelayedCalls()
+
+
+def test_poll_timeout():
+    w = FakeWatcher(timeout=5)
+    out = results(w.poll())
+    w.clock.advance(4.9)
+    assert out == []
+    w.clock.advance(0.1)
+    assert out[0][0] == 'fail'
+    assert out[0][1].check(dr_logger.WatcherTimeoutError)
+    assert w.latency is None
+
+
+def test_poll_pending():
+    w = FakeWatcher(timeout=5)
+    results(w.poll())
+    w.clock.advance(5)
+    # the hung request is not asked for again
+    out = results(w.poll())
+    assert out[0][0] == 'fail'
+    assert out[0][1].check(dr_logger.WatcherTimeoutError)
+    assert len(w.requests) == 1
+    # once it answers, polling starts again
+    w.requests[0].callback([Value(1.0, 'K')])
+    out = results(w.poll())
+    assert len(w.requests) == 2
+    w.requests[1].callback([Value(2.0, 'K')])
+    assert out == [('ok', [Value(2.0, 'K')])]
+
+
+class FakeDataVault(object):
+    def __init__(self):
+        self.rows = []
+        self.fail = False
+
+    def add(self, rows, context=None):
+        if self.fail:
+            return defer.fail(T.Error('Data Vault unavailable'))
+        self.rows.extend(rows)
+        return defer.succeed(None)
+
+
+def make_logger(watchers=()):
+    logger = dr_logger.DRLogger(1, 'Test')
+    logger.watchers = list(watchers)
+    logger.ctx = None
+    logger.notify = None
+    logger.data_vault = FakeDataVault()
+    logger.buffer = []
+    logger.errors = []
+    logger.writeErrors = []
+    logger.lastRow = 0
+    logger.currentDay = time.strftime("%d")
+    return logger
+
+
+def test_flush_requeues_on_error():
+    logger = make_logger()
+    dv = logger.data_vault
+    logger.buffer = [[1.0, 2.0], [2.0, 3.0]]
+    dv.fail = True
+    logger.flush()
+    assert logger.buffer == [[1.0, 2.0], [2.0, 3.0]]
+    assert logger.writeErrors
+    # rows taken meanwhile go after the ones that failed
+    logger.buffer.append([3.0, 4.0])
+    dv.fail = False
+    logger.flush()
+    assert dv.rows == [[1.0, 2.0], [2.0, 3.0], [3.0, 4.0]]
+    assert logger.buffer == []
+    assert logger.writeErrors == []
+
+
+def test_flush_buffer_limit(monkeypatch):
+    monkeypatch.setattr(dr_logger, 'MAX_BUFFERED_ROWS', 3)
+    logger = make_logger()
+    logger.data_vault.fail = True
+    logger.buffer = [[float(i)] for i in range(5)]
+    logger.flush()
+    assert logger.buffer == [[2.0], [3.0], [4.0]]
+
+
+def test_record_row_with_failed_watcher():
+    good, bad = FakeWatcher(), FakeWatcher()
+    now = time.time()
+    good.values, good.acquired, good.error = [Value(1.0, 'K')], now, None
+    bad.values, bad.acquired, bad.error = [Value(5.0, 'torr'), Value(6.0, 'torr')], now - 60, 'timed out'
+    logger = make_logger([good, bad])
+    logger.record_row()
+    [row] = logger.buffer
+    assert row[1] == 1.0
+    assert all(math.isnan(x) for x in row[2:4])
+    assert row[5] == pytest.approx(-60, abs=5)
+    assert ('fake', 'timed out') in logger.errors
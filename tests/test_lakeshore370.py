@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+import servers.lakeshore370 as lakeshore370
+
+# the function used for Jules' resistors, see the lakeshore370 module
+JULES = '((math.log(r) - 6.02) / 1.76) ** (-1/.345)'
+JULES_INVERSE = 'math.exp(1.76*(t**(-0.345)) + 6.02)'
+
+
+def test_default_matches_res2temp():
+    cal = lakeshore370.DEFAULT_CALIBRATION
+    r = np.array([1000.0, 2000.0, 5000.0])
+    expected = [lakeshore370.res2temp(x)['K'] for x in r]
+    assert np.allclose(cal.temperatures(r), expected)
+    # res2temp gives 0 K where the formula fails
+    assert cal.temperatures([1.0, -1.0]).tolist() == [0.0, 0.0]
+
+
+def test_function_is_vectorised():
+    cal = lakeshore370.FunctionCalibration(JULES, JULES_INVERSE)
+    r = np.logspace(3, 5, 50)
+    t = cal.temperatures(r)
+    assert np.allclose(t, lakeshore370.DEFAULT_CALIBRATION.temperatures(r))
+    assert np.allclose(cal.resistances(t), r)
+
+
+def test_function_falls_back_to_math():
+    # math.factorial has no numpy counterpart
+    cal = lakeshore370.FunctionCalibration('math.factorial(int(r))', 't')
+    assert cal.temperatures([3.0, 4.0]).tolist() == [6.0, 24.0]
+
+
+def test_interpolation():
+    res = [3000.0, 1000.0, 2000.0]
+    temps = [0.01, 1.0, 0.1]
+    cal = lakeshore370.InterpolationCalibration(res, temps)
+    assert np.allclose(cal.temperatures(res), temps)
+    assert np.allclose(cal.resistances(temps), res)
+    # log-log interpolation halfway between two points
+    r = np.sqrt(1000.0 * 2000.0)
+    assert np.allclose(cal.temperatures(r), np.sqrt(1.0 * 0.1))
+
+
+def test_vr_hopping():
+    cal = lakeshore370.VRHoppingCalibration(100.0, 5.0)
+    t = np.array([0.01, 0.1, 1.0])
+    assert np.allclose(cal.temperatures(cal.resistances(t)), t)
+
+
+def test_compile():
+    assert lakeshore370.compileCalibration([lakeshore370.DEFAULT]) is None
+    cal = lakeshore370.compileCalibration(
+        [lakeshore370.FUNCTION, JULES, JULES_INVERSE])
+    assert isinstance(cal, lakeshore370.FunctionCalibration)
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
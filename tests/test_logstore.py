@@ -0,0 +1,162 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+import servers.logstore as logstore
+from servers.logstore import errors
+
+DAY = logstore.DAY
+T0 = logstore.toSeconds(datetime(2015, 3, 1, 12))
+
+
+@pytest.fixture
+def store(tmpdir):
+    return logstore.LogStore(str(tmpdir))
+
+
+def test_round_trip(store, tmpdir):
+    log = store.get(['fridge', 'temps'], create=True)
+    ch = log.channel('mix', 'v[K]')
+    for i in range(10):
+        ch.add(T0 + i, 0.01 * i)
+    store.flush()
+
+    # read back from disk with a new store
+    log = logstore.LogStore(str(tmpdir)).get(['fridge', 'temps'])
+    ch = log.channel('mix')
+    assert ch.tag == 'v[K]'
+    assert (ch.start, ch.last) == (T0, T0 + 9)
+    times, values, cursor, more = ch.read(ch.seek(T0))
+    assert times.tolist() == [T0 + i for i in range(10)]
+    assert np.allclose(values, [0.01 * i for i in range(10)])
+    assert not more
+
+
+def test_list(store):
+    store.get(['fridge', 'temps'], create=True)
+    store.get(['fridge', 'pressures'], create=True)
+    store.get(['adr'], create=True)
+    assert store.list() == [('adr',), ('fridge', 'pressures'), ('fridge', 'temps')]
+    assert store.list(['fridge', 'temp']) == [('fridge', 'temps')]
+
+
+def test_missing(store):
+    with pytest.raises(errors.LogNotFoundError):
+        store.get(['nothing'])
+    log = store.get(['log'], create=True)
+    with pytest.raises(errors.ChannelNotFoundError):
+        log.channel('x')
+    log.channel('x', 'v')
+    with pytest.raises(errors.ChannelTypeError):
+        log.channel('x', 's')
+    with pytest.raises(errors.BadTypeError):
+        log.channel('y', '*v')
+
+
+def test_day_partitions(store):
+    log = store.get(['log'], create=True)
+    ch = log.channel('x', 'i')
+    times = T0 + np.arange(0, 3 * DAY, 3600.0)
+    for i, t in enumerate(times):
+        ch.add(t, i)
+    ch.flush()
+    assert len(log.days) == 4  # starts at noon
+
+    start, end = T0 + DAY, T0 + 2 * DAY
+    t, v, cursor, more = ch.read(ch.seek(start), end)
+    assert t.tolist() == [s for s in times if start <= s <= end]
+    assert v.tolist() == [i for i, s in enumerate(times) if start <= s <= end]
+
+
+def test_limit_and_cursor(store):
+    log = store.get(['log'], create=True)
+    ch = log.channel('x', 'v')
+    times = T0 + np.arange(0, 2 * DAY, 600.0)
+    for t in times:
+        ch.add(t, t - T0)
+    end = times[-10]
+
+    cursor = ch.seek(T0)
+    chunks = []
+    more = True
+    while more:
+        t, v, cursor, more = ch.read(cursor, end, limit=50)
+        assert len(t) <= 50
+        chunks.append(t)
+    assert np.concatenate(chunks).tolist() == times[:-9].tolist()
+
+    # an open ended read picks up entries added later
+    t, v, cursor, more = ch.read(cursor)
+    assert t.tolist() == times[-9:].tolist()
+    ch.add(times[-1] + 1, 0.0)
+    t, v, cursor, more = ch.read(cursor)
+    assert t.tolist() == [times[-1] + 1]
+
+
+def test_times_do_not_go_backwards(store):
+    ch = store.get(['log'], create=True).channel('x', 'v')
+    ch.add(T0, 1.0)
+    ch.add(T0 - 10, 2.0)
+    t, v, cursor, more = ch.read(ch.seek(T0 - 100))
+    assert t.tolist() == [T0, T0]
+
+
+def test_text(store):
+    ch = store.get(['log'], create=True).channel('msg', 's')
+    messages = ['start', '', 'fill LN2', 'unicode? no, bytes \xff']
+    for i, msg in enumerate(messages):
+        ch.add(T0 + i, msg)
+    t, v, cursor, more = ch.read(ch.seek(T0 + 1), T0 + 3)
+    assert v == messages[1:]
+    t, v, cursor, more = ch.read(ch.seek(T0), limit=2)
+    assert v == messages[:2]
+    assert more
+
+
+def expectedRollups(times, values, res):
+    buckets = {}
+    for t, v in zip(times, values):
+        buckets.setdefault(t // res * res, []).append(v)
+    return [(b, min(vs), max(vs), np.mean(vs), len(vs))
+            for b, vs in sorted(buckets.items())]
+
+
+def test_rollups(store, tmpdir):
+    log = store.get(['log'], create=True)
+    ch = log.channel('x', 'v[K]')
+    times = T0 - 3600 + np.arange(0, 2 * DAY, 10.0)
+    values = np.random.uniform(0, 1, len(times))
+    # written in several flushes, and reloaded part way through
+    half = len(times) // 2
+    for t, v in zip(times[:half], values[:half]):
+        ch.add(t, v)
+    store.flush()
+    ch = logstore.LogStore(str(tmpdir)).get(['log']).channel('x')
+    for t, v in zip(times[half:], values[half:]):
+        ch.add(t, v)
+
+    for res in logstore.ROLLUP_RESOLUTIONS:
+        records = ch.rollups(res, times[0], times[-1])
+        expected = expectedRollups(times, values, res)
+        assert records['time'].tolist() == [e[0] for e in expected]
+        assert records['count'].tolist() == [e[4] for e in expected]
+        assert np.allclose(records['min'], [e[1] for e in expected])
+        assert np.allclose(records['max'], [e[2] for e in expected])
+        assert np.allclose(records['mean'], [e[3] for e in expected])
+
+    # only buckets that overlap the range
+    records = ch.rollups(3600, T0 + 1800, T0 + 7200)
+    assert records['time'].tolist() == [T0, T0 + 3600, T0 + 7200]
+
+
+def test_resolution(store):
+    ch = store.get(['log'], create=True).channel('x', 'v')
+    for t in T0 + np.arange(0, DAY, 10.0):
+        ch.add(t, 1.0)
+    assert ch.resolution(T0, T0 + 600, 100) == 0
+    assert ch.resolution(T0, T0 + 3600, 100) == 60
+    assert ch.resolution(T0, T0 + DAY, 200) == 600
+    assert ch.resolution(T0, T0 + DAY, 25) == 3600
+    assert ch.resolution(T0, T0 + DAY, 2) == 3600
+    assert not store.get(['log']).channel('s', 's').rolledUp